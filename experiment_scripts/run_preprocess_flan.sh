@@ -15,33 +15,21 @@ echo OUTPUT DIR: $FLAN_DIR
 
 read -p "Are you sure you want to proceed? (y/n) " CONFIRMATION
 if [[ $CONFIRMATION =~ ^[Yy]$ ]]; then
-    # for t5 models
+    # t5 (BERT wordpiece) and gpt (GPT-2 BPE) datasets in a single pass
     python3 tools/preprocess_data.py \
             --input $FLAN_INPUT_PATH \
+            --tokenizer-type BertWordPieceLowerCase GPT2BPETokenizer \
+            --vocab-file ./vocabs/t5-base-vocab.txt ./vocabs/gpt2-vocab.json \
+            --merge-file none ./vocabs/gpt2-merges.txt \
+            --append-eod false true \
             --output-prefix ${FLAN_DIR}/${FILE_NAME_WITHOUT_EXT}_t5 \
-            --vocab ./vocabs/t5-base-vocab.txt \
+                            ${FLAN_DIR}/${FILE_NAME_WITHOUT_EXT}_gpt \
             --dataset-impl mmap \
-            --tokenizer-type BertWordPieceLowerCase \
             --workers 64 \
             --chunk-size 100 \
             --json-keys inputs targets \
             --is-supervised \
             --n-samples 1000000
-
-    # for gpt models
-    python3 tools/preprocess_data.py \
-            --input $FLAN_INPUT_PATH \
-            --output-prefix ${FLAN_DIR}/${FILE_NAME_WITHOUT_EXT}_gpt \
-            --vocab ./vocabs/gpt2-vocab.json \
-            --merge-file ./vocabs/gpt2-merges.txt \
-            --dataset-impl mmap \
-            --tokenizer-type GPT2BPETokenizer \
-            --workers 64 \
-            --chunk-size 100 \
-            --json-keys inputs targets \
-            --is-supervised \
-            --append-eod \
-            --n-samples 1000000
 else
     echo "Aborted."
 fi
\ No newline at end of file
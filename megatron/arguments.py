@@ -216,6 +216,29 @@ def validate_args(args, defaults={}):
         assert args.dataloader_type == 'ordered', \
             'pack dataset is only supported with ordered dataloader'
 
+    if args.dataloader_type == 'bucketed':
+        assert not args.use_dynapipe, \
+            'bucketed dataloader is not supported with dynapipe'
+        assert args.length_bucket_width > 0, \
+            'length bucket width should be positive'
+
+    assert args.mmap_prefetch_lookahead >= 0, \
+        'mmap prefetch lookahead should not be negative'
+    if args.mmap_prefetch_lookahead > 0 and args.mmap_warmup:
+        # the prefetcher only reads the ranges that are about to be used
+        args.mmap_warmup = False
+        if args.rank == 0:
+            print('disabling --mmap-warmup since --mmap-prefetch-lookahead '
+                  'is set', flush=True)
+
+    if args.isolate_packed_samples:
+        assert args.pack_dataset or args.dynapipe_enable_packing, \
+            'isolate packed samples requires --pack-dataset or ' \
+            '--dynapipe-enable-packing'
+        assert args.transformer_impl == 'local', \
+            'isolate packed samples is only supported by the local ' \
+            'transformer implementation'
+
     if args.dynamic_batchsize:
         assert args.tokens_per_global_batch is not None, \
             'dynamic batch size requires tokens-per-global-batch to be set'
@@ -737,12 +760,35 @@ def _add_training_args(parser):
                        choices=['adam', 'sgd'],
                        help='Optimizer function')
     group.add_argument('--dataloader-type', type=str, default=None,
-                       choices=['single', 'cyclic', 'ordered'],
+                       choices=['single', 'cyclic', 'ordered', 'bucketed'],
                        help='Single pass vs multiple pass data loader')
+    group.add_argument('--length-bucket-width', type=int, default=64,
+                       help='Width of the sequence length buckets used by '
+                       'the bucketed dataloader.')
+    group.add_argument('--shuffle-within-bucket', action='store_true',
+                       help='Shuffle the samples of every length bucket '
+                       'each epoch in the bucketed dataloader. By default '
+                       'they are kept in dataset order.')
     group.add_argument('--sort-dataset', action='store_true',
                        help='Sort the dataset by sequence length')
     group.add_argument('--pack-dataset', action='store_true',
                         help='Pack multiple samples in to a single sequence.')
+    group.add_argument('--pack-dataset-strategy', type=str, default='next_fit',
+                       choices=['next_fit', 'first_fit_decreasing',
+                                'best_fit', 'best_fit_2d'],
+                       help='Strategy used to pack samples into sequences '
+                       'when --pack-dataset is set.')
+    group.add_argument('--mapping-build-threads', type=int, default=1,
+                       help='Number of threads used to build the samples '
+                       'mapping of supervised datasets.')
+    group.add_argument('--isolate-packed-samples', action='store_true',
+                       help='Prevent samples packed into the same sequence '
+                       'from attending to each other, and restart the '
+                       'position ids of every packed sample.')
+    group.add_argument('--compact-attention-mask', action='store_true',
+                       help='Do not build dense T5 attention masks in the '
+                       'data loader. The masks are instead built on the GPU '
+                       'from the padded token ids of each batch.')
     group.add_argument('--dynamic-batchsize', action="store_true",
                        help='Use dynamic batch size for training')
     group.add_argument('--profile-with-nsys', action="store_true",
@@ -1003,6 +1049,10 @@ def _add_data_args(parser):
                        '--*-data-path args')
     group.add_argument('--targets-data-path', type=str, default=None,
                        help='Path to targets dataset used for supervised T5')
+    group.add_argument('--data-manifest', type=str, default=None,
+                       help='Manifest written by tools/prepare_training_data.py. '
+                       'The dataset caches it lists are checked and loaded '
+                       'without building them on start.')
     group.add_argument('--split', type=str, default='969, 30, 1',
                        help='Comma-separated list of proportions for training,'
                        ' validation, and test split. For example the split '
@@ -1050,6 +1100,11 @@ def _add_data_args(parser):
                        help='Probability of producing a short sequence.')
     group.add_argument('--mmap-warmup', action='store_true',
                        help='Warm up mmap files.')
+    group.add_argument('--mmap-prefetch-lookahead', type=int, default=0,
+                       help='Number of batches ahead of the dataloader whose '
+                       'tokens are read ahead from the mmap data files in '
+                       'a background thread (madvise WILLNEED), instead of '
+                       'warming up the whole files. 0 disables it.')
     group.add_argument('--num-workers', type=int, default=2,
                        help="Dataloader number of workers.")
     group.add_argument('--tokenizer-type', type=str,
@@ -1270,6 +1325,21 @@ def _add_dynapipe_args(parser):
                         help='Use our modified memory allocator.')
     group.add_argument('--dynapipe-reserve-all-memory', action='store_true',
                         help='Reserve all memory before training starts.')
+    group.add_argument('--dynapipe-recv-buffer-pool', action='store_true',
+                        help='Reuse the buffers of received activations and '
+                             'gradients across microbatches and iterations, '
+                             'bucketed by size class, instead of allocating '
+                             'a new tensor per message.')
+    group.add_argument('--dynapipe-batch-p2p', action='store_true',
+                        help='Launch adjacent send/recv start instructions '
+                             'of the execution plan together with one '
+                             'batch_isend_irecv instead of one isend/irecv '
+                             'per tensor.')
+    group.add_argument('--dynapipe-plan-cache-size', type=int, default=64,
+                        help='Number of recent execution plans each tensor '
+                             'parallel rank keeps. A plan already in the '
+                             'cache is broadcast by its digest only. '
+                             '0 disables the cache.')
     group.add_argument('--dynapipe-zero-stage', type=int, default=0, choices=[0,1,2,3],
                         help='Zero stage to use. This must match the stage in '
                               'the DeepSpeed config.')
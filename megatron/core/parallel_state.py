@@ -10,6 +10,9 @@ from megatron import get_args
 
 # Intra-layer model parallel group that the current rank belongs to.
 _TENSOR_MODEL_PARALLEL_GROUP = None
+# Gloo group with the same ranks, for CPU-side metadata (only created with
+# dynapipe and tensor parallelism, to broadcast execution plans).
+_TENSOR_MODEL_PARALLEL_GROUP_GLOO = None
 # Inter-layer model parallel group that the current rank belongs to.
 _PIPELINE_MODEL_PARALLEL_GROUP = None
 # Model parallel group (both intra- and pipeline) that the current rank belongs to.
@@ -146,14 +149,21 @@ def initialize_model_parallel(
 
     # Build the tensor model-parallel groups.
     global _TENSOR_MODEL_PARALLEL_GROUP
+    global _TENSOR_MODEL_PARALLEL_GROUP_GLOO
     assert _TENSOR_MODEL_PARALLEL_GROUP is None, \
         'tensor model parallel group is already initialized'
+    # the same on all ranks, since new_group is collective
+    build_gloo_groups = args.use_dynapipe and tensor_model_parallel_size > 1
     for i in range(num_tensor_model_parallel_groups):
         ranks = range(i * tensor_model_parallel_size,
                       (i + 1) * tensor_model_parallel_size)
         group = torch.distributed.new_group(ranks)
         if rank in ranks:
             _TENSOR_MODEL_PARALLEL_GROUP = group
+        if build_gloo_groups:
+            group_gloo = torch.distributed.new_group(ranks, backend="gloo")
+            if rank in ranks:
+                _TENSOR_MODEL_PARALLEL_GROUP_GLOO = group_gloo
 
     # Build the pipeline model-parallel groups and embedding groups
     # (first and last rank in each pipeline model-parallel group).
@@ -239,6 +249,14 @@ def get_tensor_model_parallel_group():
     return _TENSOR_MODEL_PARALLEL_GROUP
 
 
+def get_tensor_model_parallel_group_gloo():
+    """Get the gloo tensor model parallel group the caller rank belongs to."""
+    assert _TENSOR_MODEL_PARALLEL_GROUP_GLOO is not None, \
+        'intra_layer_model parallel group (gloo) is not initialized, it ' \
+        'is only built with dynapipe and tensor model parallel size > 1'
+    return _TENSOR_MODEL_PARALLEL_GROUP_GLOO
+
+
 def get_pipeline_model_parallel_group():
     """Get the pipeline model parallel group the caller rank belongs to."""
     assert _PIPELINE_MODEL_PARALLEL_GROUP is not None, \
@@ -536,6 +554,8 @@ def destroy_model_parallel():
     _MODEL_PARALLEL_GROUP = None
     global _TENSOR_MODEL_PARALLEL_GROUP
     _TENSOR_MODEL_PARALLEL_GROUP = None
+    global _TENSOR_MODEL_PARALLEL_GROUP_GLOO
+    _TENSOR_MODEL_PARALLEL_GROUP_GLOO = None
     global _PIPELINE_MODEL_PARALLEL_GROUP
     _PIPELINE_MODEL_PARALLEL_GROUP = None
     global _DATA_PARALLEL_GROUP
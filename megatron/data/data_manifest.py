@@ -0,0 +1,114 @@
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+
+"""Manifest of the dataset caches built ahead of training.
+
+`tools/prepare_training_data.py` builds the index maps, packed layouts and
+batch boundaries of a training job and records them, together with the
+arguments they depend on, in a manifest. A training job started with
+`--data-manifest` checks the manifest against its own arguments and then
+loads the caches without building them or waiting on barriers.
+"""
+
+import glob
+import json
+import os
+
+
+MANIFEST_VERSION = 1
+
+# Arguments that change the names or the content of the caches.
+MANIFEST_ARGS = [
+    'data_path',
+    'targets_data_path',
+    'split',
+    'encoder_seq_length',
+    'decoder_seq_length',
+    'seed',
+    'train_epochs',
+    'sort_dataset',
+    'pack_dataset',
+    'pack_dataset_strategy',
+    'dataloader_type',
+    'dynamic_batchsize',
+    'tokens_per_global_batch',
+    'micro_batch_size',
+    'use_dynapipe',
+]
+
+DATASET_SPLIT_NAMES = ['train', 'valid', 'test']
+
+
+def get_data_prefixes(data_path):
+    """Data prefixes of a `--data-path`, with or without blending weights."""
+    if len(data_path) == 1:
+        return [data_path[0]]
+    return [prefix.strip() for prefix in data_path[1::2]]
+
+
+def get_cache_files(data_prefixes):
+    """Cache files of the train, valid and test datasets of data_prefixes."""
+    filenames = set()
+    for prefix in data_prefixes:
+        for name in DATASET_SPLIT_NAMES:
+            pattern = '{}_{}_*'.format(glob.escape(prefix), name)
+            filenames.update(filename for filename in glob.glob(pattern)
+                             if '.tmp' not in os.path.basename(filename))
+    return sorted(filenames)
+
+
+def _get_manifest_args(args):
+    return {name: getattr(args, name, None) for name in MANIFEST_ARGS}
+
+
+def write_data_manifest(filename, args, model, train_valid_test_num_samples):
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'model': model,
+        'args': _get_manifest_args(args),
+        'train_valid_test_num_samples': list(train_valid_test_num_samples),
+        'files': {
+            cache_filename: os.path.getsize(cache_filename)
+            for cache_filename in get_cache_files(
+                get_data_prefixes(args.data_path))
+        },
+    }
+    tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_filename, filename)
+    return manifest
+
+
+def verify_data_manifest(filename, args, model, train_valid_test_num_samples):
+    """Check that the manifest was written for this model and these
+    arguments and that its caches are in place, raise ValueError if not."""
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    errors = []
+    if manifest.get('version') != MANIFEST_VERSION:
+        errors.append('manifest version {} is not {}'.format(
+            manifest.get('version'), MANIFEST_VERSION))
+    if manifest.get('model') != model:
+        errors.append('manifest was built for model {}, not {}'.format(
+            manifest.get('model'), model))
+    # round trip through json so that tuples compare equal to lists
+    expected_args = json.loads(json.dumps(_get_manifest_args(args)))
+    for name, value in expected_args.items():
+        if manifest['args'].get(name) != value:
+            errors.append('--{} is {} in the manifest but {} now'.format(
+                name.replace('_', '-'), manifest['args'].get(name), value))
+    if manifest.get('train_valid_test_num_samples') != \
+            list(train_valid_test_num_samples):
+        errors.append('manifest was built for {} train/valid/test samples, '
+                      'not {}'.format(manifest.get('train_valid_test_num_samples'),
+                                      list(train_valid_test_num_samples)))
+    for cache_filename, size in manifest['files'].items():
+        if not os.path.isfile(cache_filename):
+            errors.append('missing {}'.format(cache_filename))
+        elif os.path.getsize(cache_filename) != size:
+            errors.append('{} has changed since the manifest was '
+                          'written'.format(cache_filename))
+    if errors:
+        raise ValueError('data manifest {} does not match this job:\n  {}'.format(
+            filename, '\n  '.join(errors)))
+    return manifest
@@ -2,6 +2,8 @@
 
 """Dataloaders."""
 
+import collections
+import hashlib
 import os
 import random
 import torch
@@ -18,6 +20,15 @@ from typing import Union
 from dynapipe.model import DynaPipeCluster, TransformerModelSpec
 from dynapipe.pipe.data_loader import DynaPipeDataLoader, TrainingSpec
 
+# datasets read ahead by a PrefetchingBatchSampler in this process
+_PREFETCHED_DATASETS = []
+
+
+def _collate_prebatched(batch):
+    """Batches returned by `__getitems__` are already collated."""
+    return batch
+
+
 def build_pretraining_data_loader(dataset, consumed_samples, virtual_pp_rank=0, n_virtual_pp_ranks=1, is_training=False):
     """Buld dataloader given an input dataset."""
 
@@ -57,10 +68,29 @@ def build_pretraining_data_loader(dataset, consumed_samples, virtual_pp_rank=0,
             use_dynapipe=args.use_dynapipe,
             is_training=is_training,
         )
+    elif args.dataloader_type == "bucketed":
+        batch_sampler = MegatronPretrainingBucketedSampler(
+            dataset,
+            total_samples=len(dataset),
+            consumed_samples=consumed_samples,
+            micro_batch_size=args.micro_batch_size,
+            data_parallel_rank=mpu.get_data_parallel_rank(),
+            data_parallel_size=mpu.get_data_parallel_world_size(),
+            data_sharding=args.data_sharding,
+            dynamic_batchsize=args.dynamic_batchsize,
+            bucket_width=args.length_bucket_width,
+            shuffle_within_bucket=args.shuffle_within_bucket,
+            seed=args.seed,
+        )
     else:
         raise Exception('{} dataloader type is not supported.'.format(
                 args.dataloader_type))
 
+    if args.mmap_prefetch_lookahead > 0 and hasattr(dataset, 'prefetch'):
+        batch_sampler = PrefetchingBatchSampler(
+            batch_sampler, dataset, args.mmap_prefetch_lookahead)
+        _PREFETCHED_DATASETS.append(dataset)
+
     if args.use_dynapipe and is_training:
         assert isinstance(dataset, T5SupervisedDataset)
         dataset: T5SupervisedDataset
@@ -131,9 +161,21 @@ def build_pretraining_data_loader(dataset, consumed_samples, virtual_pp_rank=0,
         return joint_dataloader
 
     # Torch dataloader.
+    if hasattr(dataset, 'enable_padded_batches'):
+        # Workers fetch and collate a whole microbatch with one
+        # __getitems__ call.
+        dataset.enable_padded_batches()
+    if args.dataloader_type == "bucketed" and \
+            isinstance(dataset, T5SupervisedDataset) and \
+            args.pipeline_model_parallel_size == 1:
+        # samples of a microbatch have similar lengths, only pad them to
+        # the longest one (pipelining needs fixed shapes)
+        dataset.pad_to_longest = True
     if isinstance(dataset, T5SupervisedDataset):
         # dynamic microbatching
         collate_fn = dataset.non_dynapipe_collate_fn
+    elif getattr(dataset, 'padded_batches', False):
+        collate_fn = _collate_prebatched
     else:
         collate_fn = None
     return torch.utils.data.DataLoader(
@@ -145,6 +187,58 @@ def build_pretraining_data_loader(dataset, consumed_samples, virtual_pp_rank=0,
         )
 
 
+def get_prefetch_stats():
+    """Page cache hits and misses of the tokens read ahead so far for the
+    data loaders of this process, or None if nothing is read ahead."""
+    stats = None
+    for dataset in _PREFETCHED_DATASETS:
+        dataset_stats = dataset.prefetch_stats() \
+            if hasattr(dataset, 'prefetch_stats') else None
+        if dataset_stats is None:
+            continue
+        if stats is None:
+            stats = collections.Counter()
+        stats.update(dataset_stats)
+    return None if stats is None else dict(stats)
+
+
+def _flatten_batch(batch):
+    """Sample indices of a (possibly nested) batch as one flat array."""
+    if len(batch) > 0 and isinstance(batch[0], (list, tuple, range, np.ndarray)):
+        return np.concatenate([_flatten_batch(b) for b in batch])
+    return np.asarray(batch, dtype=np.int64)
+
+
+class PrefetchingBatchSampler:
+    """Wraps a batch sampler and, `lookahead` batches before yielding a
+    batch, passes its sample indices to `dataset.prefetch` so that their
+    tokens are read into the page cache by then."""
+
+    def __init__(self, batch_sampler, dataset, lookahead):
+        assert lookahead > 0
+        self.batch_sampler = batch_sampler
+        self.dataset = dataset
+        self.lookahead = lookahead
+
+    def __getattr__(self, name):
+        # expose the attributes of the wrapped sampler
+        if name == 'batch_sampler':
+            raise AttributeError(name)
+        return getattr(self.batch_sampler, name)
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        upcoming = collections.deque()
+        for batch in self.batch_sampler:
+            self.dataset.prefetch(_flatten_batch(batch))
+            upcoming.append(batch)
+            if len(upcoming) > self.lookahead:
+                yield upcoming.popleft()
+        yield from upcoming
+
+
 class MegatronPretrainingSampler:
 
     def __init__(self, total_samples, consumed_samples, micro_batch_size,
@@ -341,56 +435,118 @@ class MegatronPretrainingOrderedSampler(MegatronPretrainingRandomSampler):
             self._tokens_per_global_batch = tokens_per_global_batch
         self._is_supervised_dataset = isinstance(dataset, T5SupervisedDataset)
         self.use_dynapipe = use_dynapipe
+        # start index of every dynamic batch of an epoch, built lazily
+        self._batch_boundaries = None
+        self._prefix_sums = None
         # handle skip iters
         self.skip_iters = skip_iters
         if self.skip_iters > 0 and is_training:
             current_epoch_samples, _ = self._calc_sample_offsets()
-            start_idx = current_epoch_samples
-            for _ in range(self.skip_iters):
-                if self._dynamic_batchsize:
-                    # assume dataset is pre_divided among data parallel groups
-                    next_batch_end_idx = self._get_next_batch(start_idx, self.total_samples)
-                    assert next_batch_end_idx > start_idx
-                    batch = list(range(start_idx, next_batch_end_idx))
-                    self.consumed_samples += len(batch)
-                    start_idx = next_batch_end_idx
-
-    def _get_next_batch(self, start_idx, end_idx):
-        assert self._dynamic_batchsize
-        current_batch_tokens = 0
-        current_batch_end_idx = None
+            if self._dynamic_batchsize:
+                # assume dataset is pre_divided among data parallel groups
+                self.consumed_samples += self.get_consumed_samples(
+                    self.skip_iters, start_idx=current_epoch_samples)
 
-        for idx in range(start_idx, end_idx):
-            input_seq_len = min(
-                self.dataset.get_seq_len(idx), self.dataset.max_seq_length
-            )
-            target_seq_len = min(
-                self.dataset.get_dec_seq_len(idx),
-                self.dataset.max_seq_length_dec,
-            )
-            # here we count both input and target tokens
-            # another option is to count only input tokens
-            tokens_if_added = current_batch_tokens + input_seq_len + target_seq_len
+    def __len__(self):
+        """Number of batches per epoch."""
+        if self._dynamic_batchsize:
+            return len(self._get_batch_boundaries()) - 1
+        return self.total_samples // self.micro_batch_times_data_parallel_size
+
+    def get_consumed_samples(self, num_batches, start_idx=0):
+        """Number of samples in the `num_batches` batches starting at
+        sample `start_idx` of an epoch."""
+        if not self._dynamic_batchsize:
+            return num_batches * self.micro_batch_times_data_parallel_size
+        boundaries = self._get_batch_boundaries(start_idx)
+        return int(boundaries[min(num_batches, len(boundaries) - 1)]) - start_idx
+
+    def _get_sample_tokens(self):
+        # here we count both input and target tokens
+        # another option is to count only input tokens
+        input_seq_lens = np.minimum(self.dataset.get_seq_lens(),
+                                    self.dataset.max_seq_length)
+        target_seq_lens = np.minimum(self.dataset.get_dec_seq_lens(),
+                                     self.dataset.max_seq_length_dec)
+        return (input_seq_lens + target_seq_lens)[:self.total_samples]
+
+    def _get_batch_boundaries_filename(self, sample_tokens):
+        data_prefix = getattr(self.dataset, "data_prefix", None)
+        if data_prefix is None:
+            return None
+        tokens_hash = hashlib.sha1(
+            np.ascontiguousarray(sample_tokens).tobytes()).hexdigest()[:16]
+        return "{}_{}_{}tpgb_{}mbs{}_{}_batchidx.npy".format(
+            data_prefix, self.dataset.name, self._tokens_per_global_batch,
+            self.micro_batch_size, "_dynapipe" if self.use_dynapipe else "",
+            tokens_hash)
+
+    def _build_batch_boundaries(self, prefix_sums, start_idx):
+        """Greedily split the samples from `start_idx` on into batches of
+        roughly `_tokens_per_global_batch` tokens. A batch ends before the
+        first sample that makes it exceed the budget (unless the batch is
+        still empty), rounded up to a microbatch boundary if not using
+        dynapipe. `prefix_sums[i]` is the number of tokens in samples
+        [0, i)."""
+        end_idx = self.total_samples
+        boundaries = [start_idx]
+        while start_idx < end_idx:
+            start_tokens = prefix_sums[start_idx]
+            # first sample added to a non-empty batch
+            first_non_empty = np.searchsorted(
+                prefix_sums, start_tokens, side="right")
+            # first sample that exceeds the budget when added
+            first_over_budget = np.searchsorted(
+                prefix_sums, start_tokens + self._tokens_per_global_batch,
+                side="right") - 1
+            batch_end_idx = max(first_non_empty, first_over_budget)
             # if not using dynapipe, each microbatch should have fixed shape
             # so the number pf samples in a minibatch should be a multiple of
             # microbatch size
-            is_microbatch_boundary = (
-                (idx - start_idx) % self.micro_batch_size == 0 if not self.use_dynapipe else True
-            )
-            if (
-                # current batch is not empty
-                current_batch_tokens
-                # contains roughly _tokens_per_global_batch tokens
-                and tokens_if_added > self._tokens_per_global_batch
-                and is_microbatch_boundary
-            ):
-                # stop adding samples to current batch
-                current_batch_end_idx = idx
-                break
-            current_batch_tokens = tokens_if_added
-        if current_batch_end_idx is None:
-            current_batch_end_idx = end_idx
-        return current_batch_end_idx
+            if not self.use_dynapipe:
+                batch_end_idx = start_idx + -(
+                    -(batch_end_idx - start_idx) // self.micro_batch_size
+                ) * self.micro_batch_size
+            start_idx = int(min(batch_end_idx, end_idx))
+            boundaries.append(start_idx)
+        return np.array(boundaries, dtype=np.int64)
+
+    def _get_batch_boundaries(self, start_idx=0):
+        """Start index of every dynamic batch from sample `start_idx` on,
+        followed by the end of the epoch. The batches of a full epoch are
+        saved next to the dataset, so resuming only needs a binary search."""
+        assert self._dynamic_batchsize
+        if self._batch_boundaries is None:
+            sample_tokens = self._get_sample_tokens()
+            filename = self._get_batch_boundaries_filename(sample_tokens)
+            if filename is not None and os.path.isfile(filename):
+                self._batch_boundaries = np.load(filename, allow_pickle=False,
+                                                 mmap_mode='r')
+            else:
+                prefix_sums = np.zeros(len(sample_tokens) + 1, dtype=np.int64)
+                np.cumsum(sample_tokens, out=prefix_sums[1:])
+                self._prefix_sums = prefix_sums
+                self._batch_boundaries = self._build_batch_boundaries(
+                    prefix_sums, 0)
+                if filename is not None:
+                    tmp_filename = filename + ".tmp{}".format(os.getpid())
+                    with open(tmp_filename, "wb") as f:
+                        np.save(f, self._batch_boundaries, allow_pickle=False)
+                    os.replace(tmp_filename, filename)
+        batch_idx = np.searchsorted(self._batch_boundaries, start_idx)
+        if batch_idx < len(self._batch_boundaries) and \
+                self._batch_boundaries[batch_idx] == start_idx:
+            return self._batch_boundaries[batch_idx:]
+        # start_idx is not the start of a batch, split again from there
+        print_rank_0(
+            "WARNING: sample {} does not start a batch, rebuilding batches "
+            "from there.".format(start_idx)
+        )
+        if self._prefix_sums is None:
+            sample_tokens = self._get_sample_tokens()
+            self._prefix_sums = np.zeros(len(sample_tokens) + 1, dtype=np.int64)
+            np.cumsum(sample_tokens, out=self._prefix_sums[1:])
+        return self._build_batch_boundaries(self._prefix_sums, start_idx)
 
     def _calc_sample_offsets(self):
         active_total_samples = self.total_samples - self.last_batch_size
@@ -413,13 +569,11 @@ class MegatronPretrainingOrderedSampler(MegatronPretrainingRandomSampler):
         g.manual_seed(epoch)
         if self._dynamic_batchsize:
             assert self.use_dynapipe, "Please use precalculated batch size for packed training."
-            start_idx = current_epoch_samples
-            while start_idx < self.total_samples:
-                next_batch_end_idx = self._get_next_batch(start_idx, self.total_samples)
-                assert next_batch_end_idx > start_idx
-                batch = list(range(start_idx, next_batch_end_idx))
+            boundaries = self._get_batch_boundaries(current_epoch_samples)
+            for start_idx, end_idx in zip(boundaries[:-1].tolist(),
+                                          boundaries[1:].tolist()):
+                batch = list(range(start_idx, end_idx))
                 self.consumed_samples += len(batch)
-                start_idx = next_batch_end_idx
                 yield batch
         else:
             # since we are using sorted dataset, data access is strided for each rank
@@ -442,3 +596,123 @@ class MegatronPretrainingOrderedSampler(MegatronPretrainingRandomSampler):
                 self.consumed_samples += self.micro_batch_times_data_parallel_size
                 yield batch
                 batch = []
+
+
+class MegatronPretrainingBucketedSampler(MegatronPretrainingRandomSampler):
+    """Groups samples with similar (encoder, decoder) lengths into the same
+    global batch, so that less of each microbatch is padding.
+
+    Samples are bucketed by their lengths rounded up to `bucket_width`.
+    Every bucket is cut into global batches of `get_num_microbatches() *
+    micro_batch_size * data_parallel_size` samples, the samples left over
+    in all buckets (kept in bucket order) form the remaining batches, and
+    the order of the batches is shuffled. Batches only depend on the seed
+    and the epoch, so training resumes from `consumed_samples`.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        total_samples,
+        consumed_samples,
+        micro_batch_size,
+        data_parallel_rank,
+        data_parallel_size,
+        data_sharding,
+        dynamic_batchsize=False,
+        bucket_width=64,
+        shuffle_within_bucket=False,
+        seed=1234,
+    ):
+        super().__init__(
+            dataset,
+            total_samples,
+            consumed_samples,
+            micro_batch_size,
+            data_parallel_rank,
+            data_parallel_size,
+            data_sharding,
+        )
+        if not (hasattr(dataset, "get_seq_lens") and
+                hasattr(dataset, "get_dec_seq_lens")):
+            raise NotImplementedError(
+                "Bucketed sampler requires a dataset with get_seq_lens and "
+                "get_dec_seq_lens."
+            )
+        if bucket_width <= 0:
+            raise ValueError("bucket_width should be positive.")
+        self._dynamic_batchsize = dynamic_batchsize
+        self.bucket_width = bucket_width
+        self.shuffle_within_bucket = shuffle_within_bucket
+        self.seed = seed
+        self._global_batch_size_per_rank = \
+            get_num_microbatches() * self.micro_batch_size
+        self._global_batch_size = \
+            self._global_batch_size_per_rank * self.data_parallel_size
+        assert self.total_samples >= self._global_batch_size, \
+            'not enough samples for a global batch: {}, {}'.format(
+                self.total_samples, self._global_batch_size)
+        self.epoch_samples = \
+            self.total_samples // self._global_batch_size * self._global_batch_size
+
+        input_seq_lens = np.minimum(dataset.get_seq_lens()[:total_samples],
+                                    dataset.max_seq_length)
+        target_seq_lens = np.minimum(
+            dataset.get_dec_seq_lens()[:total_samples],
+            dataset.max_seq_length_dec)
+        num_target_buckets = -(-dataset.max_seq_length_dec // bucket_width) + 1
+        self.bucket_ids = (
+            -(-input_seq_lens // bucket_width) * num_target_buckets
+            - (-target_seq_lens // bucket_width)
+        )
+
+    def __len__(self):
+        """Number of batches yielded per epoch."""
+        if self._dynamic_batchsize:
+            return self.epoch_samples // self._global_batch_size
+        return self.epoch_samples // self.micro_batch_times_data_parallel_size
+
+    def get_batches(self, epoch):
+        """Sample indices of the global batches of `epoch`, as a
+        [num_batches, global_batch_size] array."""
+        rng = np.random.RandomState(self.seed + epoch)
+        if self.shuffle_within_bucket:
+            order = rng.permutation(self.total_samples)
+        else:
+            order = np.arange(self.total_samples)
+        order = order[np.argsort(self.bucket_ids[order], kind="stable")]
+        _, bucket_starts, bucket_counts = np.unique(
+            self.bucket_ids[order], return_index=True, return_counts=True)
+        # position of every sample inside its bucket
+        positions = np.arange(self.total_samples) - \
+            np.repeat(bucket_starts, bucket_counts)
+        num_full = np.repeat(
+            bucket_counts // self._global_batch_size * self._global_batch_size,
+            bucket_counts)
+        in_full_batch = positions < num_full
+        samples = np.concatenate([order[in_full_batch], order[~in_full_batch]])
+        batches = samples[:self.epoch_samples].reshape(
+            -1, self._global_batch_size)
+        return batches[rng.permutation(len(batches))]
+
+    def __iter__(self):
+        self.epoch = self.consumed_samples // self.epoch_samples
+        current_epoch_samples = self.consumed_samples % self.epoch_samples
+        assert current_epoch_samples % self._global_batch_size == 0, \
+            'consumed samples should be a multiple of the global batch size'
+        if isinstance(self.dataset, RandomSeedDataset):
+            self.dataset.set_epoch(self.epoch)
+
+        batches = self.get_batches(self.epoch)
+        start_idx = self.data_parallel_rank * self._global_batch_size_per_rank
+        end_idx = start_idx + self._global_batch_size_per_rank
+        for global_batch in batches[current_epoch_samples // self._global_batch_size:]:
+            batch = global_batch[start_idx:end_idx].tolist()
+            if self._dynamic_batchsize:
+                # the collate fn splits the batch into microbatches
+                self.consumed_samples += self._global_batch_size
+                yield batch
+                continue
+            for mb_start in range(0, len(batch), self.micro_batch_size):
+                self.consumed_samples += self.micro_batch_times_data_parallel_size
+                yield batch[mb_start:mb_start + self.micro_batch_size]
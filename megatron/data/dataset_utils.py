@@ -18,6 +18,8 @@
 #   https://github.com/google-research/albert/blob/master/create_pretraining_data.py
 # with some modifications.
 
+import hashlib
+import json
 import math
 import os
 import time
@@ -33,6 +35,12 @@ from megatron import (
 from megatron.core import mpu
 from megatron.data.blendable_dataset import BlendableDataset
 from megatron.data.indexed_dataset import make_dataset as make_indexed_dataset
+from megatron.data.sample_packing import (
+    PackedSamples,
+    get_packing_strategy_name,
+    print_packing_stats,
+    run_pack_samples,
+)
 
 DSET_TYPE_BERT = 'standard_bert'
 DSET_TYPE_ICT = 'ict'
@@ -433,7 +441,10 @@ def build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
                                     targets_data_path=None,
                                     dynamic_batch_size=None,
                                     offline_build=False,
-                                    inputs_only=False,):
+                                    inputs_only=False,
+                                    compact_attention_mask=False,
+                                    isolate_packed_samples=False,
+                                    mapping_build_threads=1,):
 
     if len(data_prefix) == 1:
         return _build_train_valid_test_datasets(data_prefix[0],
@@ -451,7 +462,10 @@ def build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
                                                 targets_data_path=targets_data_path,
                                                 dynamic_batch_size=dynamic_batch_size,
                                                 offline_build=offline_build,
-                                                inputs_only=inputs_only,)
+                                                inputs_only=inputs_only,
+                                                compact_attention_mask=compact_attention_mask,
+                                                isolate_packed_samples=isolate_packed_samples,
+                                                mapping_build_threads=mapping_build_threads,)
     # Blending dataset.
     # Parse the values.
     output = get_datasets_weights_and_num_samples(data_prefix,
@@ -468,7 +482,11 @@ def build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
             datasets_train_valid_test_num_samples[i],
             max_seq_length, masked_lm_prob, short_seq_prob,
             seed, skip_warmup, binary_head, dataset_type=dataset_type, 
-            num_epochs=num_epochs, sort_samples=sort_samples, pack_samples=pack_samples)
+            num_epochs=num_epochs, sort_samples=sort_samples, pack_samples=pack_samples,
+            offline_build=offline_build,
+            compact_attention_mask=compact_attention_mask,
+            isolate_packed_samples=isolate_packed_samples,
+            mapping_build_threads=mapping_build_threads)
         if train_ds:
             train_datasets.append(train_ds)
         if valid_ds:
@@ -504,7 +522,10 @@ def _build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
                                      targets_data_path=None,
                                      dynamic_batch_size=None,
                                      offline_build=False,
-                                     inputs_only=False,):
+                                     inputs_only=False,
+                                     compact_attention_mask=False,
+                                     isolate_packed_samples=False,
+                                     mapping_build_threads=1,):
 
     if dataset_type not in DSET_TYPES:
         raise ValueError("Invalid dataset_type: ", dataset_type)
@@ -584,6 +605,7 @@ def _build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
                 kwargs["inputs_only"] = inputs_only
                 kwargs["sort_samples"] = sort_samples
                 kwargs["pack_samples"] = pack_samples
+                kwargs["compact_attention_mask"] = compact_attention_mask
                 if dataset_type == DSET_TYPE_T5_SUPERVISED:
                     nonlocal dynamic_batch_size
                     if dynamic_batch_size is None:
@@ -591,6 +613,10 @@ def _build_train_valid_test_datasets(data_prefix, data_impl, splits_string,
                         dynamic_batch_size = args.dynamic_batchsize
                         kwargs["dynamic_batchsize"] = dynamic_batch_size
                     kwargs["offline_build"] = offline_build
+                    kwargs["isolate_packed_samples"] = isolate_packed_samples
+                    kwargs["mapping_build_threads"] = mapping_build_threads
+                elif isolate_packed_samples:
+                    raise ValueError("isolate_packed_samples is only supported for T5 supervised dataset type")
             elif sort_samples or pack_samples:
                 raise ValueError("sort_samples and pack_samples are only supported for T5 dataset type")
 
@@ -743,8 +769,9 @@ def get_samples_mapping(indexed_dataset,
               'the indices on rank 0 ...'.format(indexmap_filename))
 
         # Make sure the types match the helpers input types.
+        # (v2 indexes store compact sizes, which are widened here).
         assert indexed_dataset.doc_idx.dtype == np.int64
-        assert indexed_dataset.sizes.dtype == np.int32
+        sizes = indexed_dataset.sizes.astype(np.int32, copy=False)
 
         # Build samples mapping
         verbose = torch.distributed.get_rank() == 0
@@ -755,7 +782,7 @@ def get_samples_mapping(indexed_dataset,
         from megatron.data import helpers
         samples_mapping = helpers.build_mapping(
             indexed_dataset.doc_idx,
-            indexed_dataset.sizes,
+            sizes,
             num_epochs,
             max_num_samples,
             max_seq_length,
@@ -807,8 +834,13 @@ def get_samples_mapping_supervised(
                         name,
                         sort_samples=False,
                         offline_build=False,
+                        num_threads=1,
 ):
-    """Get a list that maps a sample index to a starting sentence index, end sentence index, and length"""
+    """Get a list that maps a sample index to a starting sentence index, end sentence index, and length.
+
+    With num_threads > 1 the mapping is built by the multi-threaded
+    builder, which gives the same mapping unless sort_samples is set (samples
+    with equal lengths then stay in document order)."""
 
     if not num_epochs:
         if not max_num_samples:
@@ -848,10 +880,11 @@ def get_samples_mapping_supervised(
                 'the indices on rank 0 ...'.format(input_indexmap_filename, target_indexmap_filename))
 
             # Make sure the types match the helpers input types.
+            # (v2 indexes store compact sizes, which are widened here).
             assert indexed_dataset.doc_idx.dtype == np.int64
-            assert indexed_dataset.sizes.dtype == np.int32
+            sizes = indexed_dataset.sizes.astype(np.int32, copy=False)
             assert target_indexed_dataset.doc_idx.dtype == np.int64
-            assert target_indexed_dataset.sizes.dtype == np.int32
+            target_sizes = target_indexed_dataset.sizes.astype(np.int32, copy=False)
 
             # Build samples mapping
             verbose = torch.distributed.get_rank() == 0 if not offline_build else True
@@ -860,11 +893,11 @@ def get_samples_mapping_supervised(
                 name))
             # First compile and then import.
             from megatron.data import helpers
-            samples_mapping, target_samples_mapping = helpers.build_mapping_supervised(
+            build_args = (
                 indexed_dataset.doc_idx,
-                indexed_dataset.sizes,
+                sizes,
                 target_indexed_dataset.doc_idx,
-                target_indexed_dataset.sizes,
+                target_sizes,
                 num_epochs,
                 max_num_samples,
                 max_seq_length,
@@ -872,6 +905,13 @@ def get_samples_mapping_supervised(
                 seed,
                 verbose,
                 sort_samples)
+            if num_threads > 1:
+                samples_mapping, target_samples_mapping = \
+                    helpers.build_mapping_supervised_parallel(
+                        *build_args, num_threads)
+            else:
+                samples_mapping, target_samples_mapping = \
+                    helpers.build_mapping_supervised(*build_args)
             print_fn(' > done building samples index maping')
             np.save(input_indexmap_filename, samples_mapping, allow_pickle=True)
             print_fn(' > saved the input index mapping in {}'.format(
@@ -884,15 +924,7 @@ def get_samples_mapping_supervised(
                         '(seconds): {:4f}'.format(
                             time.time() - start_time))
     if not offline_build:
-        # This should be a barrier but nccl barrier assumes
-        # device_index=rank which is not the case for model
-        # parallel case
-        counts = torch.cuda.LongTensor([1])
-        torch.distributed.all_reduce(counts, group=mpu.get_data_parallel_group())
-        torch.distributed.all_reduce(counts, group=mpu.get_pipeline_model_parallel_group())
-        assert counts[0].item() == (
-            torch.distributed.get_world_size() //
-            torch.distributed.get_world_size(group=mpu.get_tensor_model_parallel_group()))
+        _wait_for_local_rank_0_build()
 
     print_fn = print if offline_build else print_rank_0
     # Load indexed dataset.
@@ -901,9 +933,12 @@ def get_samples_mapping_supervised(
     start_time = time.time()
     samples_mapping = np.load(input_indexmap_filename, allow_pickle=True, mmap_mode='r')
     target_samples_mapping = np.load(target_indexmap_filename, allow_pickle=True, mmap_mode='r')
-
-    samples_mapping = samples_mapping[:100000]
-    target_samples_mapping = target_samples_mapping[:100000]
+    # The mappings stay memory-mapped, slicing only creates views.
+    if samples_mapping.shape[0] > max_num_samples:
+        print_fn('    using the first {} of {} samples'.format(
+            max_num_samples, samples_mapping.shape[0]))
+        samples_mapping = samples_mapping[:max_num_samples]
+        target_samples_mapping = target_samples_mapping[:max_num_samples]
     print_fn('    loaded indexed files in {:3.3f} seconds'.format(
         time.time() - start_time))
     print_fn('    total number of input samples: {}'.format(
@@ -912,3 +947,100 @@ def get_samples_mapping_supervised(
         target_samples_mapping.shape[0]))
 
     return samples_mapping, target_samples_mapping
+
+
+def _wait_for_local_rank_0_build():
+    # This should be a barrier but nccl barrier assumes
+    # device_index=rank which is not the case for model
+    # parallel case
+    counts = torch.cuda.LongTensor([1])
+    torch.distributed.all_reduce(counts, group=mpu.get_data_parallel_group())
+    torch.distributed.all_reduce(counts, group=mpu.get_pipeline_model_parallel_group())
+    assert counts[0].item() == (
+        torch.distributed.get_world_size() //
+        torch.distributed.get_world_size(group=mpu.get_tensor_model_parallel_group()))
+
+
+def _hash_samples_mapping(samples_mapping, hasher, chunk_size=1 << 20):
+    """Feed the content of a (possibly memory-mapped) mapping to hasher."""
+    hasher.update(str((samples_mapping.dtype.str,
+                       samples_mapping.shape)).encode())
+    for start in range(0, samples_mapping.shape[0], chunk_size):
+        hasher.update(np.ascontiguousarray(
+            samples_mapping[start:start + chunk_size]).data)
+
+
+def get_packed_samples_filename_prefix(input_samples_mapping,
+                                       target_samples_mapping,
+                                       data_prefix,
+                                       name,
+                                       max_seq_length,
+                                       max_seq_length_dec,
+                                       inputs_only,
+                                       strategy):
+    """Filename prefix of a packed-sample layout, keyed by the content of
+    the samples mappings and the packing parameters."""
+    hasher = hashlib.sha1()
+    hasher.update('{}-{}-{}-{}'.format(
+        strategy, max_seq_length, max_seq_length_dec, inputs_only).encode())
+    _hash_samples_mapping(input_samples_mapping, hasher)
+    if target_samples_mapping is not None:
+        _hash_samples_mapping(target_samples_mapping, hasher)
+    return '{}_{}_packed_{}_{}'.format(data_prefix, name, strategy,
+                                       hasher.hexdigest()[:16])
+
+
+def get_packed_samples(input_samples_mapping,
+                       max_seq_length,
+                       target_samples_mapping,
+                       max_seq_length_dec,
+                       data_prefix,
+                       name,
+                       inputs_only=False,
+                       strategy=True,
+                       offline_build=False):
+    """Pack samples, caching the layout next to the index mappings.
+
+    The layout is built on local rank 0 only and memory-mapped by all
+    ranks, in the same way as the samples mappings are."""
+    strategy = get_packing_strategy_name(strategy)
+    packed_prefix = get_packed_samples_filename_prefix(
+        input_samples_mapping, target_samples_mapping, data_prefix, name,
+        max_seq_length, max_seq_length_dec, inputs_only, strategy)
+    stats_filename = packed_prefix + '_packstats.json'
+
+    print_fn = print if offline_build else print_rank_0
+    built = False
+    # Build the packed layout if not exist.
+    if int(os.environ['LOCAL_RANK']) == 0:
+        if not PackedSamples.exists(packed_prefix) or \
+                not os.path.isfile(stats_filename):
+            print_fn(' > WARNING: could not find packed samples {}, building '
+                     'on rank 0 ...'.format(packed_prefix))
+            start_time = time.time()
+            packed_samples, stats = run_pack_samples(
+                input_samples_mapping,
+                max_seq_length,
+                target_samples_mapping,
+                max_seq_length_dec,
+                inputs_only=inputs_only,
+                strategy=strategy,
+            )
+            tmp_filename = '{}.tmp{}'.format(stats_filename, os.getpid())
+            with open(tmp_filename, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp_filename, stats_filename)
+            packed_samples.save(packed_prefix)
+            built = True
+            print_fn(' > elasped time to build and save packed samples '
+                     '(seconds): {:4f}'.format(time.time() - start_time))
+    if not offline_build:
+        _wait_for_local_rank_0_build()
+
+    print_fn(' > loading packed samples from {}'.format(packed_prefix))
+    packed_samples = PackedSamples.load(packed_prefix, mmap=True)
+    with open(stats_filename, 'r') as f:
+        stats = json.load(f)
+    if not built:
+        print_packing_stats(stats, strategy=strategy)
+    return packed_samples, stats
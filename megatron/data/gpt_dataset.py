@@ -212,6 +212,7 @@ class GPTDataset(torch.utils.data.Dataset):
 
         self.name = name
         self.indexed_dataset = indexed_dataset
+        self.padded_batches = False
 
         # Checks
         assert np.min(documents) >= 0
@@ -240,6 +241,8 @@ class GPTDataset(torch.utils.data.Dataset):
             sample = self.indexed_dataset.get(self.doc_idx[doc_index_f],
                                               offset=offset_f,
                                               length=offset_l - offset_f + 1)
+        elif hasattr(self.indexed_dataset, 'get_batch'):
+            sample = self._get_samples_tokens(np.array([idx]))
         else:
             # Otherwise, get the rest of the initial document.
             sample_list = [self.indexed_dataset.get(self.doc_idx[doc_index_f],
@@ -255,6 +258,46 @@ class GPTDataset(torch.utils.data.Dataset):
 
         return {'text': np.array(sample, dtype=np.int64)}
 
+    def enable_padded_batches(self):
+        """Make `__getitems__` return a collated batch of tensors instead of
+        a list of samples."""
+        self.padded_batches = True
+
+    def __getitems__(self, indices):
+        if not self.padded_batches:
+            return [self[idx] for idx in indices]
+        if not hasattr(self.indexed_dataset, 'get_batch'):
+            return {'text': torch.from_numpy(np.stack(
+                [self[idx]['text'] for idx in indices]))}
+        idx = self.shuffle_idx[np.asarray(indices, dtype=np.int64)]
+        tokens = self._get_samples_tokens(idx)
+        return {'text': torch.from_numpy(
+            tokens.astype(np.int64).reshape(len(indices), -1))}
+
+    def _get_samples_tokens(self, idx):
+        """Tokens of the (shuffled) samples `idx`, back to back, read with
+        one gather over the pieces of all the documents they span."""
+        # Start and end documents and offsets.
+        doc_index_f = self.sample_idx[idx, 0].astype(np.int64)
+        doc_index_l = self.sample_idx[idx + 1, 0].astype(np.int64)
+        offset_f = self.sample_idx[idx, 1].astype(np.int64)
+        offset_l = self.sample_idx[idx + 1, 1].astype(np.int64)
+        # One piece per document spanned by each sample.
+        num_pieces = doc_index_l - doc_index_f + 1
+        first_piece = np.cumsum(num_pieces) - num_pieces
+        last_piece = first_piece + num_pieces - 1
+        piece_doc_index = np.arange(num_pieces.sum(), dtype=np.int64) + \
+            np.repeat(doc_index_f - first_piece, num_pieces)
+        piece_docs = self.doc_idx[piece_doc_index]
+        piece_offsets = np.zeros(piece_docs.shape[0], dtype=np.int64)
+        piece_offsets[first_piece] = offset_f
+        piece_lengths = self.indexed_dataset.sizes[piece_docs].astype(np.int64)
+        # The last piece ends at offset_l (inclusive).
+        piece_lengths[last_piece] = offset_l + 1
+        piece_lengths -= piece_offsets
+        return self.indexed_dataset.get_batch(
+            piece_docs, offsets=piece_offsets, lengths=piece_lengths)
+
 
 def _build_index_mappings(name, data_prefix, documents, sizes,
                           num_samples, seq_length, seed):
@@ -340,8 +383,9 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
             # First compile and then import.
             from megatron.data import helpers
             assert doc_idx.dtype == np.int32
-            assert sizes.dtype == np.int32
-            sample_idx = helpers.build_sample_idx(sizes, doc_idx, seq_length,
+            # v2 indexes store compact sizes, which are widened here.
+            sample_idx = helpers.build_sample_idx(sizes.astype(np.int32, copy=False),
+                                                  doc_idx, seq_length,
                                                   num_epochs, tokens_per_epoch)
             # sample_idx = _build_sample_idx(sizes, doc_idx, seq_length,
             #                               num_epochs, tokens_per_epoch)
@@ -394,7 +438,7 @@ def _build_index_mappings(name, data_prefix, documents, sizes,
 
 def _num_tokens(documents, sizes):
     """Total number of tokens in the dataset."""
-    return np.sum(sizes[documents])
+    return np.sum(sizes[documents], dtype=np.int64)
 
 
 def _num_epochs(tokens_per_epoch, seq_length, num_samples):
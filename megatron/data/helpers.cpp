@@ -7,10 +7,15 @@
 #include <pybind11/pybind11.h>
 
 #include <algorithm>
+#include <atomic>
+#include <chrono>
 #include <iostream>
 #include <limits>
 #include <random>
+#include <set>
 #include <stdexcept>
+#include <thread>
+#include <vector>
 
 namespace py = pybind11;
 using namespace std;
@@ -701,6 +706,257 @@ std::tuple<py::array, py::array> build_mapping_supervised(const py::array_t<int6
   }
 }
 
+template <typename Fn>
+void parallel_for(const int64_t begin, const int64_t end,
+                  const int32_t num_threads, const Fn &fn) {
+  /* Call fn(chunk_begin, chunk_end) on num_threads contiguous chunks of
+     [begin, end), one thread per chunk. */
+  const int64_t chunk = (end - begin + num_threads - 1) / num_threads;
+  std::vector<std::thread> threads;
+  for (int64_t chunk_begin = begin; chunk_begin < end; chunk_begin += chunk) {
+    threads.emplace_back(fn, chunk_begin, std::min(chunk_begin + chunk, end));
+  }
+  for (auto &thread : threads) {
+    thread.join();
+  }
+}
+
+template <typename DocIdx>
+std::tuple<py::array, py::array> build_mapping_supervised_parallel_impl(
+    const py::array_t<int64_t> &docs_, const py::array_t<int32_t> &sizes_,
+    const py::array_t<int64_t> &target_docs_,
+    const py::array_t<int32_t> &target_sizes_, const int32_t num_epochs,
+    const uint64_t max_num_samples, const int32_t max_seq_length,
+    const int32_t max_seq_length_dec, const int32_t seed, const bool verbose,
+    const bool sort_samples, const int32_t num_threads) {
+  /* Multi-threaded build_mapping_supervised_impl. Every document is a
+     sample, so the document lengths are computed once with the documents
+     sharded across threads and every epoch repeats them. The shuffle draws
+     the same random numbers as build_mapping_supervised_impl and gives the
+     same mapping. Sorting is a parallel stable merge sort, so samples with
+     equal lengths stay in document order (std::sort leaves their order
+     unspecified).
+  */
+
+  // Consistency checks.
+  assert(num_epochs > 0);
+  assert(max_seq_length > 1);
+  assert(seed > 0);
+  assert(num_threads > 0);
+  assert(docs_.shape(0) == target_docs_.shape(0));
+
+  auto docs = docs_.unchecked<1>();
+  auto sizes = sizes_.unchecked<1>();
+  auto target_docs = target_docs_.unchecked<1>();
+  auto target_sizes = target_sizes_.unchecked<1>();
+  const int64_t num_docs = docs_.shape(0) - 1;
+
+  if (verbose) {
+    cout << "    using:" << endl << std::flush;
+    cout << "     number of documents:              " << num_docs << endl
+         << std::flush;
+    cout << "     number of epochs:                 " << num_epochs << endl
+         << std::flush;
+    cout << "     maximum number of samples:        " << max_num_samples << endl
+         << std::flush;
+    cout << "     number of threads:                " << num_threads << endl
+         << std::flush;
+  }
+
+  // Same number of samples as build_mapping_supervised_impl: whole epochs
+  // are added until max_num_samples is reached.
+  int64_t num_used_epochs = num_epochs;
+  if (num_docs > 0) {
+    const uint64_t epochs_to_max =
+        (max_num_samples + num_docs - 1) / static_cast<uint64_t>(num_docs);
+    num_used_epochs = std::min(static_cast<uint64_t>(num_epochs), epochs_to_max);
+  }
+  const int64_t num_samples = num_used_epochs * num_docs;
+  if (num_docs > 0 &&
+      (num_samples / num_docs != num_used_epochs ||
+       num_samples > (std::numeric_limits<int64_t>::max() - 2) / 3)) {
+    cout << "number of samples exceeded maximum "
+         << "allowed by type int64: "
+         << std::numeric_limits<int64_t>::max() << endl;
+    throw std::overflow_error("Number of samples");
+  }
+  if (verbose) {
+    cout << "   will create mapping for " << num_samples << " samples" << endl
+         << std::flush;
+  }
+
+  DocIdx *input_maps = new DocIdx[3 * num_samples];
+  DocIdx *target_maps = new DocIdx[3 * num_samples];
+  {
+    py::gil_scoped_release release;
+    const auto start_time = std::chrono::steady_clock::now();
+    auto report = [&](const char *stage) {
+      if (verbose) {
+        const std::chrono::duration<double> elapsed =
+            std::chrono::steady_clock::now() - start_time;
+        cout << "    " << stage << " after " << elapsed.count() << " seconds"
+             << endl
+             << std::flush;
+      }
+    };
+
+    // Sequence lengths of every document, with progress reports.
+    std::vector<int32_t> input_seq_lens(num_docs);
+    std::vector<int32_t> target_seq_lens(num_docs);
+    std::atomic<int64_t> num_done_docs(0);
+    std::thread length_builder([&]() {
+      parallel_for(0, num_docs, num_threads, [&](int64_t begin, int64_t end) {
+        const int64_t report_every = 1 << 16;
+        for (auto doc = begin; doc < end; ++doc) {
+          auto input_seq_len = int32_t{0};
+          for (auto sent_index = docs[doc]; sent_index < docs[doc + 1];
+               ++sent_index) {
+            input_seq_len += sizes[sent_index];
+          }
+          auto target_seq_len = int32_t{0};
+          for (auto sent_index = target_docs[doc];
+               sent_index < target_docs[doc + 1]; ++sent_index) {
+            target_seq_len += target_sizes[sent_index];
+          }
+          input_seq_lens[doc] = input_seq_len;
+          target_seq_lens[doc] = target_seq_len;
+          if ((doc - begin + 1) % report_every == 0) {
+            num_done_docs += report_every;
+          }
+        }
+      });
+      num_done_docs = num_docs;
+    });
+    while (verbose && num_done_docs.load() < num_docs) {
+      std::this_thread::sleep_for(std::chrono::seconds(1));
+      cout << "    computed lengths of " << num_done_docs.load() << " / "
+           << num_docs << " documents" << endl
+           << std::flush;
+    }
+    length_builder.join();
+    report("computed document lengths");
+
+    // Sample i of the unshuffled mapping is document i % num_docs. Permute
+    // the sample indices, then gather the rows.
+    std::vector<int64_t> order(num_samples);
+    parallel_for(0, num_samples, num_threads, [&](int64_t begin, int64_t end) {
+      for (auto i = begin; i < end; ++i) {
+        order[i] = i;
+      }
+    });
+    if (sort_samples) {
+      // Sort by input sequence length, and then by target sequence length.
+      // Sorting (lengths, sample index) pairs keeps equal samples in order.
+      using SortKey = std::pair<uint64_t, int64_t>;
+      std::vector<SortKey> keys(num_samples);
+      parallel_for(0, num_samples, num_threads, [&](int64_t begin, int64_t end) {
+        for (auto i = begin; i < end; ++i) {
+          const auto doc = i % num_docs;
+          keys[i] = std::make_pair(
+              (static_cast<uint64_t>(static_cast<uint32_t>(input_seq_lens[doc])) << 32) |
+                  static_cast<uint32_t>(target_seq_lens[doc]),
+              i);
+        }
+      });
+      const int64_t chunk = (num_samples + num_threads - 1) / num_threads;
+      parallel_for(0, num_samples, num_threads, [&](int64_t begin, int64_t end) {
+        std::sort(keys.begin() + begin, keys.begin() + end);
+      });
+      std::vector<SortKey> merged(num_samples);
+      for (int64_t width = chunk; width < num_samples; width *= 2) {
+        std::vector<std::thread> threads;
+        for (int64_t begin = 0; begin < num_samples; begin += 2 * width) {
+          threads.emplace_back([&, begin]() {
+            const auto middle = std::min(begin + width, num_samples);
+            const auto end = std::min(begin + 2 * width, num_samples);
+            std::merge(keys.begin() + begin, keys.begin() + middle,
+                       keys.begin() + middle, keys.begin() + end,
+                       merged.begin() + begin);
+          });
+        }
+        for (auto &thread : threads) {
+          thread.join();
+        }
+        keys.swap(merged);
+      }
+      parallel_for(0, num_samples, num_threads, [&](int64_t begin, int64_t end) {
+        for (auto i = begin; i < end; ++i) {
+          order[i] = keys[i].second;
+        }
+      });
+      report("sorted samples");
+    } else {
+      // Shuffle, drawing the same numbers as the single threaded build.
+      std::mt19937_64 rand64_gen(seed + 1);
+      for (auto i = (num_samples - 1); i > 0; --i) {
+        const auto j = static_cast<int64_t>(rand64_gen() % (i + 1));
+        swap(order[i], order[j]);
+      }
+      report("shuffled samples");
+    }
+
+    parallel_for(0, num_samples, num_threads, [&](int64_t begin, int64_t end) {
+      for (auto i = begin; i < end; ++i) {
+        const auto doc = order[i] % num_docs;
+        const auto map_index_0 = 3 * i;
+        input_maps[map_index_0] = static_cast<DocIdx>(docs[doc]);
+        input_maps[map_index_0 + 1] = static_cast<DocIdx>(docs[doc + 1]);
+        input_maps[map_index_0 + 2] = static_cast<DocIdx>(input_seq_lens[doc]);
+        target_maps[map_index_0] = static_cast<DocIdx>(target_docs[doc]);
+        target_maps[map_index_0 + 1] = static_cast<DocIdx>(target_docs[doc + 1]);
+        target_maps[map_index_0 + 2] = static_cast<DocIdx>(target_seq_lens[doc]);
+      }
+    });
+    report("built mapping");
+  }
+
+  // Method to deallocate memory.
+  py::capsule input_free_when_done(input_maps, [](void *mem_) {
+    DocIdx *mem = reinterpret_cast<DocIdx *>(mem_);
+    delete[] mem;
+  });
+
+  py::capsule target_free_when_done(target_maps, [](void *mem_) {
+    DocIdx *mem = reinterpret_cast<DocIdx *>(mem_);
+    delete[] mem;
+  });
+
+  // Return the numpy array.
+  const auto byte_size = sizeof(DocIdx);
+  return std::make_tuple(py::array(std::vector<int64_t>{num_samples, 3},  // shape
+                                  {3 * byte_size, byte_size},  // C-style contiguous strides
+                                  input_maps,                        // the data pointer
+                                  input_free_when_done),             // numpy array references
+                          py::array(std::vector<int64_t>{num_samples, 3},  // shape
+                                    {3 * byte_size, byte_size},  // C-style contiguous strides
+                                    target_maps,                 // the data pointer
+                                    target_free_when_done));            // numpy array references
+}
+
+std::tuple<py::array, py::array> build_mapping_supervised_parallel(
+    const py::array_t<int64_t> &docs_, const py::array_t<int> &sizes_,
+    const py::array_t<int64_t> &target_docs_,
+    const py::array_t<int> &target_sizes_, const int num_epochs,
+    const uint64_t max_num_samples, const int max_seq_length,
+    const int max_seq_length_dec, const int seed, const bool verbose,
+    const bool sort_samples, const int num_threads) {
+  if (sizes_.size() > std::numeric_limits<uint32_t>::max()) {
+    if (verbose) {
+      cout << "    using uint64 for data mapping..." << endl << std::flush;
+    }
+    return build_mapping_supervised_parallel_impl<uint64_t>(
+        docs_, sizes_, target_docs_, target_sizes_, num_epochs, max_num_samples, max_seq_length,
+        max_seq_length_dec, seed, verbose, sort_samples, num_threads);
+  } else {
+    if (verbose) {
+      cout << "    using uint32 for data mapping..." << endl << std::flush;
+    }
+    return build_mapping_supervised_parallel_impl<uint32_t>(
+        docs_, sizes_, target_docs_, target_sizes_, num_epochs, max_num_samples, max_seq_length,
+        max_seq_length_dec, seed, verbose, sort_samples, num_threads);
+  }
+}
+
 template <typename DocIdx>
 py::array build_blocks_mapping_impl(
     const py::array_t<int64_t> &docs_, const py::array_t<int32_t> &sizes_,
@@ -938,10 +1194,165 @@ py::array build_blocks_mapping(
   }
 }
 
+int64_t pack_samples_first_fit(const py::array_t<int64_t> &order_,
+                               const py::array_t<int64_t> &enc_lengths_,
+                               const py::array_t<int64_t> &dec_lengths_,
+                               const int64_t max_seq_length,
+                               const int64_t max_seq_length_dec,
+                               py::array_t<int64_t> &sample_bins_) {
+  /* Visit the samples in the given order and put each of them into the
+     first packed sequence with enough encoder and decoder room. Writes the
+     sequence of each sample into sample_bins and returns the number of
+     sequences. */
+
+  auto order = order_.unchecked<1>();
+  auto enc_lengths = enc_lengths_.unchecked<1>();
+  auto dec_lengths = dec_lengths_.unchecked<1>();
+  auto sample_bins = sample_bins_.mutable_unchecked<1>();
+  const int64_t num_samples = order.shape(0);
+
+  // Segment tree over (at most num_samples) sequences holding the
+  // maximum remaining encoder and decoder room of each subtree.
+  int64_t size = 1;
+  while (size < num_samples) {
+    size *= 2;
+  }
+  std::vector<int64_t> enc_room(2 * size, max_seq_length);
+  std::vector<int64_t> dec_room(2 * size, max_seq_length_dec);
+  std::vector<int64_t> stack;
+  int64_t num_bins = 0;
+
+  for (int64_t i = 0; i < num_samples; ++i) {
+    const auto sample = order[i];
+    const auto enc = enc_lengths[sample];
+    const auto dec = dec_lengths[sample];
+    if (enc > max_seq_length || dec > max_seq_length_dec) {
+      throw std::invalid_argument("sample does not fit into a sequence");
+    }
+    // Leftmost leaf with enough room in both dimensions.
+    int64_t leaf = -1;
+    stack.clear();
+    stack.push_back(1);
+    while (!stack.empty()) {
+      const auto node = stack.back();
+      stack.pop_back();
+      if (enc_room[node] < enc || dec_room[node] < dec) {
+        continue;
+      }
+      if (node >= size) {
+        leaf = node;
+        break;
+      }
+      stack.push_back(2 * node + 1);
+      stack.push_back(2 * node);
+    }
+    assert(leaf >= 0);
+    const auto bin = leaf - size;
+    num_bins = std::max(num_bins, bin + 1);
+    sample_bins[sample] = bin;
+    enc_room[leaf] -= enc;
+    dec_room[leaf] -= dec;
+    for (auto node = leaf / 2; node >= 1; node /= 2) {
+      enc_room[node] = std::max(enc_room[2 * node], enc_room[2 * node + 1]);
+      dec_room[node] = std::max(dec_room[2 * node], dec_room[2 * node + 1]);
+    }
+  }
+  return num_bins;
+}
+
+int64_t pack_samples_best_fit(const py::array_t<int64_t> &order_,
+                              const py::array_t<int64_t> &enc_lengths_,
+                              const py::array_t<int64_t> &dec_lengths_,
+                              const int64_t max_seq_length,
+                              const int64_t max_seq_length_dec,
+                              const double enc_weight,
+                              const double dec_weight,
+                              const int64_t max_candidates,
+                              py::array_t<int64_t> &sample_bins_) {
+  /* Visit the samples in the given order and put each of them into the
+     open sequence that can hold it and leaves the least weighted remaining
+     room enc_weight * enc_room + dec_weight * dec_room. Opens a new
+     sequence if none fits. Writes the sequence of each sample into
+     sample_bins and returns the number of sequences.
+
+     Open sequences are bucketed by remaining decoder room and ordered by
+     remaining encoder room within a bucket, so for every bucket with
+     enough decoder room the tightest encoder fit is a single lookup. In the
+     bucket that may or may not have enough decoder room, at most
+     max_candidates sequences are inspected. */
+
+  auto order = order_.unchecked<1>();
+  auto enc_lengths = enc_lengths_.unchecked<1>();
+  auto dec_lengths = dec_lengths_.unchecked<1>();
+  auto sample_bins = sample_bins_.mutable_unchecked<1>();
+  const int64_t num_samples = order.shape(0);
+
+  const int64_t num_buckets = std::min((int64_t)64, max_seq_length_dec + 1);
+  auto bucket_of = [&](const int64_t dec_room) {
+    return dec_room * num_buckets / (max_seq_length_dec + 1);
+  };
+  // Open sequences as (remaining encoder room, sequence index).
+  std::vector<std::set<std::pair<int64_t, int64_t>>> open_bins(num_buckets);
+  std::vector<int64_t> enc_room;
+  std::vector<int64_t> dec_room;
+
+  for (int64_t i = 0; i < num_samples; ++i) {
+    const auto sample = order[i];
+    const auto enc = enc_lengths[sample];
+    const auto dec = dec_lengths[sample];
+    if (enc > max_seq_length || dec > max_seq_length_dec) {
+      throw std::invalid_argument("sample does not fit into a sequence");
+    }
+    int64_t best = -1;
+    double best_room = std::numeric_limits<double>::max();
+    const auto first_bucket = bucket_of(dec);
+    for (auto bucket = first_bucket; bucket < num_buckets; ++bucket) {
+      auto &bins = open_bins[bucket];
+      int64_t num_candidates = 0;
+      for (auto it = bins.lower_bound(std::make_pair(enc, (int64_t)-1));
+           it != bins.end() && num_candidates < max_candidates;
+           ++it, ++num_candidates) {
+        const auto bin = it->second;
+        if (dec_room[bin] < dec) {
+          continue;
+        }
+        const double room = enc_weight * (enc_room[bin] - enc) +
+                            dec_weight * (dec_room[bin] - dec);
+        if (room < best_room) {
+          best_room = room;
+          best = bin;
+        }
+        // Later entries of the bucket only have more encoder room.
+        break;
+      }
+    }
+    int64_t bin = best;
+    if (bin < 0) {
+      bin = enc_room.size();
+      enc_room.push_back(max_seq_length);
+      dec_room.push_back(max_seq_length_dec);
+    } else {
+      open_bins[bucket_of(dec_room[bin])].erase(
+          std::make_pair(enc_room[bin], bin));
+    }
+    sample_bins[sample] = bin;
+    enc_room[bin] -= enc;
+    dec_room[bin] -= dec;
+    if (enc_room[bin] > 0 || dec_room[bin] > 0) {
+      open_bins[bucket_of(dec_room[bin])].insert(
+          std::make_pair(enc_room[bin], bin));
+    }
+  }
+  return enc_room.size();
+}
+
 PYBIND11_MODULE(helpers, m) {
   m.def("build_mapping", &build_mapping);
   m.def("build_mapping_supervised", &build_mapping_supervised);
+  m.def("build_mapping_supervised_parallel", &build_mapping_supervised_parallel);
   m.def("build_blocks_mapping", &build_blocks_mapping);
   m.def("build_sample_idx", &build_sample_idx);
   m.def("build_blending_indices", &build_blending_indices);
+  m.def("pack_samples_first_fit", &pack_samples_first_fit);
+  m.def("pack_samples_best_fit", &pack_samples_best_fit);
 }
@@ -10,11 +10,14 @@
 # Added document index to index file and made it accessible.
 #    An empty sentence no longer separates documents.
 
-from functools import lru_cache
+import ctypes
+import mmap
 import os
+import queue
 import shutil
 import struct
-from itertools import accumulate
+import threading
+from itertools import chain
 
 import numpy as np
 import torch
@@ -48,9 +51,10 @@ def infer_dataset_impl(path):
         return None
 
 
-def make_builder(out_file, impl, vocab_size=None):
+def make_builder(out_file, impl, vocab_size=None, index_version=1):
     if impl == 'mmap':
-        return MMapIndexedDatasetBuilder(out_file, dtype=__best_fitting_dtype(vocab_size))
+        return MMapIndexedDatasetBuilder(out_file, dtype=__best_fitting_dtype(vocab_size),
+                                         index_version=index_version)
     else:
         return IndexedDatasetBuilder(out_file)
 
@@ -97,7 +101,8 @@ dtypes = {
     5: np.int64,
     6: float,
     7: np.double,
-    8: np.uint16
+    8: np.uint16,
+    9: np.uint32
 }
 
 
@@ -131,9 +136,22 @@ class IndexedDataset(torch.utils.data.Dataset):
     def __init__(self, path):
         super().__init__()
         self.path = path
-        self.data_file = None
+        self.data_buffer = None
         self.read_index(path)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the mmaps are reopened by the unpickled copy
+        for name in ['_index_buffer', 'dim_offsets', 'data_offsets', 'sizes',
+                     'doc_idx', 'data_buffer']:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data_buffer = None
+        self.read_index(self.path)
+
     def read_index(self, path):
         with open(index_file_path(path), 'rb') as f:
             magic = f.read(8)
@@ -146,45 +164,49 @@ class IndexedDataset(torch.utils.data.Dataset):
             code, self.element_size = struct.unpack('<QQ', f.read(16))
             self.dtype = dtypes[code]
             self._len, self.s = struct.unpack('<QQ', f.read(16))
-            self.doc_count = struct.unpack('<Q', f.read(8))
-            self.dim_offsets = read_longs(f, self._len + 1)
-            self.data_offsets = read_longs(f, self._len + 1)
-            self.sizes = read_longs(f, self.s)
-            self.doc_idx = read_longs(f, self.doc_count)
+            self.doc_count, = struct.unpack('<Q', f.read(8))
+            offset = f.tell()
+        # the index arrays are read-only views of an mmap of the index file
+        self._index_buffer = np.memmap(index_file_path(path), mode='r', order='C')
+        counts = [self._len + 1, self._len + 1, self.s, self.doc_count]
+        arrays = []
+        for count in counts:
+            arrays.append(np.frombuffer(self._index_buffer, dtype=np.int64,
+                                        count=count, offset=offset))
+            offset += count * 8
+        self.dim_offsets, self.data_offsets, self.sizes, self.doc_idx = arrays
 
     def read_data(self, path):
-        self.data_file = open(data_file_path(path), 'rb', buffering=0)
+        if os.path.getsize(data_file_path(path)) == 0:
+            self.data_buffer = np.empty(0, dtype=self.dtype)
+        else:
+            self.data_buffer = np.frombuffer(
+                np.memmap(data_file_path(path), mode='r', order='C'),
+                dtype=self.dtype)
 
     def check_index(self, i):
         if i < 0 or i >= self._len:
             raise IndexError('index out of range')
 
-    def __del__(self):
-        if self.data_file:
-            self.data_file.close()
-
     # @lru_cache(maxsize=8)
     def __getitem__(self, idx):
-        if not self.data_file:
+        if self.data_buffer is None:
             self.read_data(self.path)
-        if isinstance(idx, int):
+        if isinstance(idx, (int, np.integer)):
             i = idx
             self.check_index(i)
-            tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
-            a = np.empty(tensor_size, dtype=self.dtype)
-            self.data_file.seek(self.data_offsets[i] * self.element_size)
-            self.data_file.readinto(a)
-            return a
+            dim_start, dim_stop = self.dim_offsets[i:i + 2]
+            a = self.data_buffer[self.data_offsets[i]:self.data_offsets[i + 1]].copy()
+            if dim_stop - dim_start == 1:
+                return a
+            return a.reshape(self.sizes[dim_start:dim_stop])
         elif isinstance(idx, slice):
             start, stop, step = idx.indices(len(self))
             if step != 1:
                 raise ValueError("Slices into indexed_dataset must be contiguous")
             sizes = self.sizes[self.dim_offsets[start]:self.dim_offsets[stop]]
-            size = sum(sizes)
-            a = np.empty(size, dtype=self.dtype)
-            self.data_file.seek(self.data_offsets[start] * self.element_size)
-            self.data_file.readinto(a)
-            offsets = list(accumulate(sizes))
+            a = self.data_buffer[self.data_offsets[start]:self.data_offsets[stop]].copy()
+            offsets = np.cumsum(sizes)
             sents = np.split(a, offsets[:-1])
             return sents
 
@@ -222,36 +244,31 @@ class IndexedCachedDataset(IndexedDataset):
     def prefetch(self, indices):
         if all(i in self.cache_index for i in indices):
             return
-        if not self.data_file:
-            self.read_data(self.path)
-        indices = sorted(set(indices))
-        total_size = 0
-        for i in indices:
-            total_size += self.data_offsets[i + 1] - self.data_offsets[i]
-        self.cache = np.empty(total_size, dtype=self.dtype)
-        ptx = 0
-        self.cache_index.clear()
-        for i in indices:
-            self.cache_index[i] = ptx
-            size = self.data_offsets[i + 1] - self.data_offsets[i]
-            a = self.cache[ptx: ptx + size]
-            self.data_file.seek(self.data_offsets[i] * self.element_size)
-            self.data_file.readinto(a)
-            ptx += size
-        if self.data_file:
-            # close and delete data file after prefetch so we can pickle
-            self.data_file.close()
-            self.data_file = None
+        indices = np.unique(np.asarray(indices, dtype=np.int64))
+        starts = self.data_offsets[indices]
+        stops = self.data_offsets[indices + 1]
+        cache_offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(stops - starts, out=cache_offsets[1:])
+        self.cache = np.empty(cache_offsets[-1], dtype=self.dtype)
+        self.cache_index = dict(zip(indices.tolist(), cache_offsets[:-1].tolist()))
+        # items that are adjacent in the data file are read with one read
+        run_starts = np.flatnonzero(np.concatenate(
+            [[True], starts[1:] != stops[:-1]]))
+        run_stops = np.append(run_starts[1:], len(indices))
+        with open(data_file_path(self.path), 'rb') as f:
+            for first, last in zip(run_starts, run_stops):
+                f.seek(starts[first] * self.element_size)
+                f.readinto(self.cache[cache_offsets[first]:cache_offsets[last]])
 
     # @lru_cache(maxsize=8)
     def __getitem__(self, idx):
-        if isinstance(idx, int):
+        if isinstance(idx, (int, np.integer)):
             i = idx
             self.check_index(i)
             tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
             a = np.empty(tensor_size, dtype=self.dtype)
             ptx = self.cache_index[i]
-            np.copyto(a, self.cache[ptx: ptx + a.size])
+            np.copyto(a, self.cache[ptx: ptx + a.size].reshape(tensor_size))
             return a
         elif isinstance(idx, slice):
             # Hack just to make this work, can optimizer later if necessary
@@ -288,6 +305,24 @@ class IndexedDatasetBuilder(object):
             self.sizes.append(s)
         self.dim_offsets.append(self.dim_offsets[-1] + len(tensor.size()))
 
+    def add_batch(self, flat_tokens, sizes, doc_boundaries=None):
+        """Write many sentences with a single write, see
+        MMapIndexedDatasetBuilder.add_batch."""
+        np_array = np.ascontiguousarray(flat_tokens, dtype=self.dtype)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        assert sizes.sum() == np_array.size, \
+            'sizes add up to {} tokens but flat_tokens holds {}'.format(
+                sizes.sum(), np_array.size)
+        self.out_file.write(np_array.data)
+        offset = len(self.sizes)
+        begin = self.data_offsets[-1]
+        self.data_offsets.extend((begin + np.cumsum(sizes)).tolist())
+        self.sizes.extend(sizes.tolist())
+        begin = self.dim_offsets[-1]
+        self.dim_offsets.extend(range(begin + 1, begin + len(sizes) + 1))
+        if doc_boundaries is not None:
+            self.doc_idx.extend(offset + int(b) for b in doc_boundaries)
+
     def end_document(self):
         self.doc_idx.append(len(self.sizes))
 
@@ -331,24 +366,149 @@ class IndexedDatasetBuilder(object):
         index.close()
 
 
+def _compact_sizes_dtype(sizes):
+    """Smallest unsigned dtype holding every sentence size."""
+    if len(sizes) == 0 or int(np.max(sizes)) <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+
+def _align(offset, alignment=8):
+    return -(-offset // alignment) * alignment
+
+
 def _warmup_mmap_file(path):
     with open(path, 'rb') as stream:
         while stream.read(100 * 1024 * 1024):
             pass
 
 
+def _get_mincore():
+    try:
+        mincore = ctypes.CDLL(None, use_errno=True).mincore
+    except (OSError, AttributeError):
+        return None
+    mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                        ctypes.POINTER(ctypes.c_ubyte)]
+    mincore.restype = ctypes.c_int
+    return mincore
+
+
+class MMapPrefetcher(object):
+    """Background thread that asks the kernel to read ahead the byte ranges
+    of a memory mapped file that are about to be read.
+
+    Ranges are merged when less than a page apart and page aligned. Pages
+    are looked up in the page cache with mincore(2) first: resident pages
+    count as hits, the others as misses, and only ranges with misses are
+    advised with madvise(MADV_WILLNEED), or posix_fadvise(WILLNEED) where
+    madvise is not available. Without mincore every page is a miss.
+    """
+
+    def __init__(self, path, buffer_mmap):
+        self.path = path
+        self._buffer_mmap = buffer_mmap
+        self._size = len(buffer_mmap)
+        self._mincore = _get_mincore()
+        self._fd = None
+        if not hasattr(mmap, 'MADV_WILLNEED') and hasattr(os, 'posix_fadvise'):
+            self._fd = os.open(path, os.O_RDONLY)
+        self.hit_pages = 0
+        self.miss_pages = 0
+        self.advised_bytes = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def prefetch(self, starts, stops):
+        """Queue the byte ranges [starts[i], stops[i]) for readahead."""
+        self._queue.put((np.asarray(starts, dtype=np.int64),
+                         np.asarray(stops, dtype=np.int64)))
+
+    def wait(self):
+        """Block until all queued ranges have been advised."""
+        self._queue.join()
+
+    def stats(self):
+        return {'hit_pages': self.hit_pages, 'miss_pages': self.miss_pages,
+                'advised_bytes': self.advised_bytes}
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _run(self):
+        while True:
+            ranges = self._queue.get()
+            try:
+                if ranges is None:
+                    return
+                self._advise(*ranges)
+            finally:
+                self._queue.task_done()
+
+    def _advise(self, starts, stops):
+        nonempty = stops > starts
+        starts, stops = starts[nonempty], stops[nonempty]
+        if len(starts) == 0:
+            return
+        order = np.argsort(starts, kind='stable')
+        starts = starts[order] // mmap.PAGESIZE * mmap.PAGESIZE
+        stops = np.maximum.accumulate(stops[order])
+        # merge ranges that overlap or are less than a page apart
+        run_starts = np.flatnonzero(np.concatenate(
+            [[True], starts[1:] > stops[:-1] + mmap.PAGESIZE]))
+        run_stops = np.append(run_starts[1:], len(starts)) - 1
+        for start, stop in zip(starts[run_starts], stops[run_stops]):
+            stop = min(-(-int(stop) // mmap.PAGESIZE) * mmap.PAGESIZE, self._size)
+            start = int(start)
+            if stop <= start:
+                continue
+            num_pages = -(-(stop - start) // mmap.PAGESIZE)
+            resident = self._resident_pages(start, stop, num_pages)
+            self.hit_pages += resident
+            self.miss_pages += num_pages - resident
+            if resident < num_pages:
+                self.advised_bytes += stop - start
+                if self._fd is not None:
+                    os.posix_fadvise(self._fd, start, stop - start,
+                                     os.POSIX_FADV_WILLNEED)
+                elif hasattr(mmap, 'MADV_WILLNEED'):
+                    self._buffer_mmap._mmap.madvise(
+                        mmap.MADV_WILLNEED, start, stop - start)
+
+    def _resident_pages(self, start, stop, num_pages):
+        if self._mincore is None:
+            return 0
+        vec = np.zeros(num_pages, dtype=np.uint8)
+        if self._mincore(self._buffer_mmap.ctypes.data + start, stop - start,
+                         vec.ctypes.data_as(ctypes.POINTER(ctypes.c_ubyte))) != 0:
+            return 0
+        return int(np.count_nonzero(vec & 1))
+
+
 class MMapIndexedDataset(torch.utils.data.Dataset):
     class Index(object):
         _HDR_MAGIC = b'MMIDIDX\x00\x00'
+        _VERSIONS = (1, 2)
 
         @classmethod
-        def writer(cls, path, dtype):
+        def writer(cls, path, dtype, version=1):
+            """Version 1 stores int32 sizes and int64 pointers. Version 2
+            stores the sizes in the smallest unsigned dtype that fits them,
+            and no pointers: readers recompute them from the sizes."""
+            assert version in cls._VERSIONS, \
+                'unknown index version {}'.format(version)
+
             class _Writer(object):
                 def __enter__(self):
                     self._file = open(path, 'wb')
 
                     self._file.write(cls._HDR_MAGIC)
-                    self._file.write(struct.pack('<Q', 1))
+                    self._file.write(struct.pack('<Q', version))
                     self._file.write(struct.pack('<B', code(dtype)))
 
                     return self
@@ -356,31 +516,46 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                 @staticmethod
                 def _get_pointers(sizes):
                     dtype_size = dtype().itemsize
-                    address = 0
-                    pointers = []
-
-                    for size in sizes:
-                        pointers.append(address)
-                        address += size * dtype_size
-
+                    pointers = np.zeros(len(sizes), dtype=np.int64)
+                    np.cumsum(sizes[:-1], dtype=np.int64, out=pointers[1:])
+                    pointers *= dtype_size
                     return pointers
 
                 def write(self, sizes, doc_idx):
+                    if version == 2:
+                        self._write_v2(sizes, doc_idx)
+                        return
+                    sizes = np.ascontiguousarray(sizes, dtype=np.int32)
                     pointers = self._get_pointers(sizes)
 
                     self._file.write(struct.pack('<Q', len(sizes)))
                     self._file.write(struct.pack('<Q', len(doc_idx)))
 
-                    sizes = np.array(sizes, dtype=np.int32)
-                    self._file.write(sizes.tobytes(order='C'))
+                    self._file.write(sizes.data)
                     del sizes
 
-                    pointers = np.array(pointers, dtype=np.int64)
-                    self._file.write(pointers.tobytes(order='C'))
+                    self._file.write(pointers.data)
                     del pointers
 
-                    doc_idx = np.array(doc_idx, dtype=np.int64)
-                    self._file.write(doc_idx.tobytes(order='C'))
+                    doc_idx = np.ascontiguousarray(doc_idx, dtype=np.int64)
+                    self._file.write(doc_idx.data)
+
+                def _pad(self):
+                    position = self._file.tell()
+                    self._file.write(b'\x00' * (_align(position) - position))
+
+                def _write_v2(self, sizes, doc_idx):
+                    sizes_dtype = _compact_sizes_dtype(sizes)
+                    self._file.write(struct.pack('<Q', len(sizes)))
+                    self._file.write(struct.pack('<Q', len(doc_idx)))
+                    self._file.write(struct.pack('<B', code(sizes_dtype)))
+
+                    self._pad()
+                    self._file.write(np.ascontiguousarray(sizes, dtype=sizes_dtype).data)
+
+                    self._pad()
+                    doc_idx = np.ascontiguousarray(doc_idx, dtype=np.int64)
+                    self._file.write(doc_idx.data)
 
                 def __exit__(self, exc_type, exc_val, exc_tb):
                     self._file.close()
@@ -394,8 +569,9 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                     'Index file doesn\'t match expected format. '
                     'Make sure that --dataset-impl is configured properly.'
                 )
-                version = struct.unpack('<Q', stream.read(8))
-                assert (1,) == version
+                self._version, = struct.unpack('<Q', stream.read(8))
+                assert self._version in self._VERSIONS, \
+                    'unsupported index version {}'.format(self._version)
 
                 dtype_code, = struct.unpack('<B', stream.read(1))
                 self._dtype = dtypes[dtype_code]
@@ -403,6 +579,9 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
 
                 self._len = struct.unpack('<Q', stream.read(8))[0]
                 self._doc_count = struct.unpack('<Q', stream.read(8))[0]
+                sizes_dtype = np.int32
+                if self._version == 2:
+                    sizes_dtype = dtypes[struct.unpack('<B', stream.read(1))[0]]
                 offset = stream.tell()
 
             if not skip_warmup:
@@ -411,18 +590,29 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
 
             self._bin_buffer_mmap = np.memmap(path, mode='r', order='C')
             self._bin_buffer = memoryview(self._bin_buffer_mmap)
+            if self._version == 2:
+                offset = _align(offset)
             print_rank_0("    reading sizes...")
             self._sizes = np.frombuffer(
                 self._bin_buffer,
-                dtype=np.int32,
+                dtype=sizes_dtype,
                 count=self._len,
                 offset=offset)
-            print_rank_0("    reading pointers...")
-            self._pointers = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._len,
-                                           offset=offset + self._sizes.nbytes)
+            offset += self._sizes.nbytes
+            if self._version == 1:
+                print_rank_0("    reading pointers...")
+                self._pointers = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._len,
+                                               offset=offset)
+                offset += self._pointers.nbytes
+            else:
+                print_rank_0("    computing pointers...")
+                self._pointers = np.zeros(self._len, dtype=np.int64)
+                np.cumsum(self._sizes[:-1], dtype=np.int64, out=self._pointers[1:])
+                self._pointers *= self._dtype_size
+                offset = _align(offset)
             print_rank_0("    reading document index...")
             self._doc_idx = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._doc_count,
-                                          offset=offset + self._sizes.nbytes + self._pointers.nbytes)
+                                          offset=offset)
 
         def __del__(self):
             self._bin_buffer_mmap._mmap.close()
@@ -440,10 +630,14 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         def doc_idx(self):
             return self._doc_idx
 
-        @lru_cache(maxsize=8)
         def __getitem__(self, i):
             return self._pointers[i], self._sizes[i]
 
+        def get_many(self, indices):
+            """Pointers and sizes of items `indices` as numpy arrays."""
+            indices = np.asarray(indices, dtype=np.int64)
+            return self._pointers[indices], self._sizes[indices]
+
         def __len__(self):
             return self._len
 
@@ -453,6 +647,7 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         self._path = None
         self._index = None
         self._bin_buffer = None
+        self._prefetcher = None
 
         self._do_init(path, skip_warmup)
 
@@ -460,7 +655,8 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         return self._path
 
     def __setstate__(self, state):
-        self._do_init(state)
+        self._prefetcher = None
+        self._do_init(state, skip_warmup=True)
 
     def _do_init(self, path, skip_warmup):
         self._path = path
@@ -475,6 +671,8 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         self._bin_buffer = memoryview(self._bin_buffer_mmap)
 
     def __del__(self):
+        if self._prefetcher is not None:
+            self._prefetcher.close()
         self._bin_buffer_mmap._mmap.close()
         del self._bin_buffer_mmap
         del self._index
@@ -493,13 +691,9 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
             start, stop, step = idx.indices(len(self))
             if step != 1:
                 raise ValueError("Slices into indexed_dataset must be contiguous")
-            ptr = self._index._pointers[start]
             sizes = self._index._sizes[idx]
-            offsets = list(accumulate(sizes))
-            total_size = sum(sizes)
-            np_array = np.frombuffer(self._bin_buffer, dtype=self._index.dtype,
-                                     count=total_size, offset=ptr)
-            sents = np.split(np_array, offsets[:-1])
+            np_array = self.get_span(start, stop)
+            sents = np.split(np_array, np.cumsum(sizes, dtype=np.int64)[:-1])
             return sents
         else:
             raise TypeError("Unexpected type received for idx: {}".format(type(idx)))
@@ -518,6 +712,67 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
                                  count=length, offset=ptr)
         return np_array
 
+    def get_span(self, start, stop):
+        """ Retrieves items [start, stop) concatenated into a single array.
+
+        Items are stored back to back in the data file, so this is a single
+        view into the memory map without any copy.
+        """
+        if stop <= start:
+            return np.empty(0, dtype=self._index.dtype)
+        ptr = self._index._pointers[start]
+        end_ptr = self._index._pointers[stop - 1] + \
+            int(self._index._sizes[stop - 1]) * self._index._dtype_size
+        np_array = np.frombuffer(self._bin_buffer, dtype=self._index.dtype,
+                                 count=(end_ptr - ptr) // self._index._dtype_size,
+                                 offset=ptr)
+        return np_array
+
+    def get_span_sizes(self, starts, stops):
+        """ Number of tokens in each span of items [starts[i], stops[i]). """
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        nonempty = stops > starts
+        last = np.where(nonempty, stops - 1, starts)
+        end_ptrs = self._index._pointers[last] + \
+            self._index._sizes[last].astype(np.int64) * self._index._dtype_size
+        sizes = (end_ptrs - self._index._pointers[starts]) // self._index._dtype_size
+        return np.where(nonempty, sizes, 0)
+
+    def get_batch(self, indices, offsets=None, lengths=None):
+        """ Retrieves several (portions of) items with a single vectorized
+        read and returns them concatenated into one flat array.
+
+        Range i starts `offsets[i]` tokens into item `indices[i]` and is
+        `lengths[i]` tokens long. Since items are stored back to back, a
+        range may run past the end of its item into the following ones.
+        """
+        pointers, sizes = self._index.get_many(indices)
+        starts = pointers // self._index._dtype_size
+        if offsets is not None:
+            starts = starts + np.asarray(offsets, dtype=np.int64)
+        if lengths is None:
+            lengths = sizes.astype(np.int64)
+            if offsets is not None:
+                lengths = lengths - offsets
+        lengths = np.asarray(lengths, dtype=np.int64)
+        # Position of every requested token in the data file.
+        output_starts = np.cumsum(lengths) - lengths
+        positions = np.arange(lengths.sum(), dtype=np.int64) + \
+            np.repeat(starts - output_starts, lengths)
+        tokens = np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
+        return tokens[positions]
+
+    def gather(self, indices):
+        """ Items `indices` concatenated into one flat array, together with
+        the len(indices) + 1 offsets of the items in it, so that item i is
+        `tokens[offsets[i]:offsets[i + 1]]`.
+        """
+        _, sizes = self._index.get_many(indices)
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, dtype=np.int64, out=offsets[1:])
+        return self.get_batch(indices), offsets
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -536,6 +791,30 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
     def supports_prefetch(self):
         return False
 
+    def prefetch_spans(self, starts, stops):
+        """ Hint that items [starts[i], stops[i]) will be read soon.
+
+        The first call starts an MMapPrefetcher thread in this process that
+        reads the spans ahead in the background; reads never wait for it.
+        """
+        if self._prefetcher is None:
+            self._prefetcher = MMapPrefetcher(data_file_path(self._path),
+                                              self._bin_buffer_mmap)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+        nonempty = stops > starts
+        starts, stops = starts[nonempty], stops[nonempty]
+        byte_starts = self._index._pointers[starts]
+        byte_stops = self._index._pointers[stops - 1] + \
+            self._index._sizes[stops - 1].astype(np.int64) * self._index._dtype_size
+        self._prefetcher.prefetch(byte_starts, byte_stops)
+
+    def prefetch_stats(self):
+        """ Page cache hits and misses of the prefetched spans. """
+        if self._prefetcher is None:
+            return {'hit_pages': 0, 'miss_pages': 0, 'advised_bytes': 0}
+        return self._prefetcher.stats()
+
     @staticmethod
     def exists(path):
         return (
@@ -543,23 +822,80 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         )
 
 
+class _GrowableArray(object):
+    """Append-only numpy array that doubles its capacity when full."""
+
+    def __init__(self, dtype, values=(), capacity=1024):
+        self._array = np.empty(max(capacity, len(values)), dtype=dtype)
+        self._len = 0
+        self.extend(values)
+
+    def __len__(self):
+        return self._len
+
+    def _reserve(self, size):
+        if size > len(self._array):
+            array = np.empty(max(size, 2 * len(self._array)),
+                             dtype=self._array.dtype)
+            array[:self._len] = self._array[:self._len]
+            self._array = array
+
+    def append(self, value):
+        self._reserve(self._len + 1)
+        self._array[self._len] = value
+        self._len += 1
+
+    def extend(self, values):
+        values = np.asarray(values)
+        self._reserve(self._len + len(values))
+        self._array[self._len:self._len + len(values)] = values
+        self._len += len(values)
+
+    @property
+    def array(self):
+        return self._array[:self._len]
+
+
 class MMapIndexedDatasetBuilder(object):
-    def __init__(self, out_file, dtype=np.int64):
+    def __init__(self, out_file, dtype=np.int32, index_version=1):
         self._data_file = open(out_file, 'wb')
         self._dtype = dtype
-        self._sizes = []
-        self._doc_idx = [0]
+        self._index_version = index_version
+        self._sizes = _GrowableArray(np.int32)
+        self._doc_idx = _GrowableArray(np.int64, [0])
 
     def add_item(self, tensor):
-        np_array = np.array(tensor.numpy(), dtype=self._dtype)
-        self._data_file.write(np_array.tobytes(order='C'))
+        np_array = np.ascontiguousarray(tensor.numpy(), dtype=self._dtype)
+        self._data_file.write(np_array.data)
         self._sizes.append(np_array.size)
 
     def add_doc(self, tensor, sizes):
-        np_array = np.array(tensor, dtype=self._dtype)
-        self._data_file.write(np_array.tobytes(order='C'))
+        self.add_batch(tensor, sizes, [len(sizes)])
+
+    def add_batch(self, flat_tokens, sizes, doc_boundaries=None):
+        """Write many sentences with a single write.
+
+        flat_tokens holds the tokens of all sentences back to back and sizes
+        the number of tokens of each sentence. doc_boundaries are the number
+        of sentences of the batch before each document end, e.g. [2, 5] for
+        two documents of 2 and 3 sentences. Without doc_boundaries the
+        sentences are added to the current document, as by add_item.
+        """
+        np_array = np.ascontiguousarray(flat_tokens, dtype=self._dtype)
+        sizes = np.asarray(sizes, dtype=np.int64)
+        assert sizes.sum() == np_array.size, \
+            'sizes add up to {} tokens but flat_tokens holds {}'.format(
+                sizes.sum(), np_array.size)
+        self._data_file.write(np_array.data)
+        offset = len(self._sizes)
         self._sizes.extend(sizes)
-        self._doc_idx.append(len(self._sizes))
+        if doc_boundaries is not None:
+            doc_boundaries = np.asarray(doc_boundaries, dtype=np.int64)
+            assert len(doc_boundaries) == 0 or (
+                np.all(np.diff(doc_boundaries) >= 0)
+                and 0 <= doc_boundaries[0] and doc_boundaries[-1] <= len(sizes)), \
+                'doc_boundaries must be sorted sentence counts of the batch'
+            self._doc_idx.extend(offset + doc_boundaries)
 
     def end_document(self):
         self._doc_idx.append(len(self._sizes))
@@ -580,7 +916,48 @@ class MMapIndexedDatasetBuilder(object):
     def finalize(self, index_file):
         self._data_file.close()
 
-        with MMapIndexedDataset.Index.writer(index_file, self._dtype) as index:
-            index.write(self._sizes, self._doc_idx)
+        with MMapIndexedDataset.Index.writer(index_file, self._dtype,
+                                             self._index_version) as index:
+            index.write(self._sizes.array, self._doc_idx.array)
+
+        print("Written index file with {} entries".format(len(self._doc_idx)))
+
+
+class DocumentBatcher(object):
+    """Buffers documents and writes them to a builder with add_batch once
+    max_tokens tokens are buffered. Call flush() before finalizing the
+    builder."""
 
-        print("Written index file with {} entries".format(len(self._doc_idx)))
\ No newline at end of file
+    def __init__(self, builder, max_tokens=1 << 22):
+        self.builder = builder
+        self.max_tokens = max_tokens
+        self._tokens = []
+        self._sizes = []
+        self._doc_boundaries = []
+        self._num_tokens = 0
+
+    def add_document(self, tokens, sizes):
+        """Add a document given its tokens back to back and the number of
+        tokens of each of its sentences."""
+        self._tokens.append(tokens)
+        self._sizes.extend(sizes)
+        self._doc_boundaries.append(len(self._sizes))
+        self._num_tokens += sum(sizes)
+        if self._num_tokens >= self.max_tokens:
+            self.flush()
+
+    def add_sentences(self, sentences):
+        """Add a document given as a list of token lists."""
+        self.add_document(chain.from_iterable(sentences),
+                          [len(sentence) for sentence in sentences])
+
+    def flush(self):
+        if self._doc_boundaries:
+            flat_tokens = np.fromiter(chain.from_iterable(self._tokens),
+                                      dtype=np.int64, count=self._num_tokens)
+            self.builder.add_batch(flat_tokens, self._sizes,
+                                   self._doc_boundaries)
+        self._tokens = []
+        self._sizes = []
+        self._doc_boundaries = []
+        self._num_tokens = 0
@@ -144,8 +144,10 @@ def get_block_samples_mapping(block_dataset, title_dataset, data_prefix, num_epo
               'the indices on rank 0 ...'.format(indexmap_filename))
 
         # Make sure the types match the helpers input types.
+        # (v2 indexes store compact sizes, which are widened here).
         assert block_dataset.doc_idx.dtype == np.int64
-        assert block_dataset.sizes.dtype == np.int32
+        sizes = block_dataset.sizes.astype(np.int32, copy=False)
+        title_sizes = title_dataset.sizes.astype(np.int32, copy=False)
 
         # Build samples mapping
         verbose = torch.distributed.get_rank() == 0
@@ -156,8 +158,8 @@ def get_block_samples_mapping(block_dataset, title_dataset, data_prefix, num_epo
         from megatron.data import helpers
         mapping_array = helpers.build_blocks_mapping(
             block_dataset.doc_idx,
-            block_dataset.sizes,
-            title_dataset.sizes,
+            sizes,
+            title_sizes,
             num_epochs,
             max_num_samples,
             max_seq_length - 3,  # account for added tokens
@@ -0,0 +1,363 @@
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+
+"""Array-backed sample packing."""
+
+import os
+
+import numpy as np
+
+from megatron import print_rank_0
+
+
+# Packing strategies, indexed by name. Each strategy takes the (truncated)
+# per-sample encoder and decoder lengths together with the encoder and
+# decoder budgets and returns a PackedSamples.
+PACKING_STRATEGIES = {}
+DEFAULT_PACKING_STRATEGY = 'next_fit'
+
+
+def register_packing_strategy(name):
+    def _register(fn):
+        assert name not in PACKING_STRATEGIES, \
+            'packing strategy {} is already registered'.format(name)
+        PACKING_STRATEGIES[name] = fn
+        return fn
+    return _register
+
+
+def get_packing_strategy_name(name):
+    if name is True:
+        return DEFAULT_PACKING_STRATEGY
+    return name
+
+
+def get_packing_strategy(name):
+    name = get_packing_strategy_name(name)
+    if name not in PACKING_STRATEGIES:
+        raise ValueError('Unknown packing strategy {}, expected one of {}'.format(
+            name, sorted(PACKING_STRATEGIES.keys())))
+    return PACKING_STRATEGIES[name]
+
+
+class PackedSamples(object):
+    """Packed sequences stored in CSR layout.
+
+    Packed sequence `i` consists of the samples
+    `sample_indices[offsets[i]:offsets[i + 1]]`, where each sample index
+    refers to a row of the (input and target) samples mapping. Both arrays
+    are plain int64 numpy arrays so they can be saved with `np.save` and
+    memory-mapped by data loader workers.
+    """
+
+    def __init__(self, offsets, sample_indices):
+        assert offsets.ndim == 1 and offsets.shape[0] >= 1
+        assert sample_indices.ndim == 1
+        assert offsets[-1] == sample_indices.shape[0]
+        self.offsets = offsets
+        self.sample_indices = sample_indices
+
+    def __len__(self):
+        return self.offsets.shape[0] - 1
+
+    def __getitem__(self, idx):
+        return self.sample_indices[self.offsets[idx]:self.offsets[idx + 1]]
+
+    @property
+    def num_samples(self):
+        return self.sample_indices.shape[0]
+
+    def samples_per_sequence(self):
+        return np.diff(self.offsets)
+
+    def sequence_lengths(self, sample_lengths):
+        """Sum of `sample_lengths` over the samples of each packed sequence."""
+        cumsum = np.zeros(self.num_samples + 1, dtype=np.int64)
+        np.cumsum(sample_lengths[self.sample_indices], out=cumsum[1:])
+        return cumsum[self.offsets[1:]] - cumsum[self.offsets[:-1]]
+
+    @staticmethod
+    def filenames(prefix):
+        return prefix + '_packoffsets.npy', prefix + '_packindices.npy'
+
+    def save(self, prefix):
+        """Save both arrays. Each file is written under a temporary name and
+        atomically renamed, so readers never see a partial file. The offsets
+        file is written last and marks a complete layout."""
+        offsets_filename, indices_filename = self.filenames(prefix)
+        for filename, array in ((indices_filename, self.sample_indices),
+                                (offsets_filename, self.offsets)):
+            tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+            with open(tmp_filename, 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(tmp_filename, filename)
+
+    @classmethod
+    def exists(cls, prefix):
+        return all(os.path.isfile(f) for f in cls.filenames(prefix))
+
+    @classmethod
+    def load(cls, prefix, mmap=True):
+        offsets_filename, indices_filename = cls.filenames(prefix)
+        mmap_mode = 'r' if mmap else None
+        return cls(np.load(offsets_filename, allow_pickle=True, mmap_mode=mmap_mode),
+                   np.load(indices_filename, allow_pickle=True, mmap_mode=mmap_mode))
+
+
+def get_samples_mapping_lengths(samples_mapping, window_size=1 << 20):
+    """Sample lengths (the third column) of a possibly memory-mapped samples
+    mapping, as a contiguous int64 array. The mapping is read one window of
+    rows at a time."""
+    lengths = np.empty(samples_mapping.shape[0], dtype=np.int64)
+    for start in range(0, samples_mapping.shape[0], window_size):
+        lengths[start:start + window_size] = \
+            samples_mapping[start:start + window_size, 2]
+    return lengths
+
+
+def get_packing_lengths(input_samples_mapping, max_seq_len_input,
+                        target_samples_mapping=None, max_seq_len_target=None,
+                        inputs_only=False):
+    """Untruncated and truncated per-sample encoder/decoder lengths."""
+    enc_lengths = get_samples_mapping_lengths(input_samples_mapping)
+    if target_samples_mapping is not None:
+        assert len(input_samples_mapping) == len(target_samples_mapping), \
+            "input and target samples mapping should have the same length"
+        dec_lengths = get_samples_mapping_lengths(target_samples_mapping)
+    else:
+        dec_lengths = np.zeros_like(enc_lengths)
+    if inputs_only:
+        # use concatenated lengths for input
+        enc_lengths = enc_lengths + dec_lengths
+        dec_lengths = np.zeros_like(enc_lengths)
+    if max_seq_len_target is None:
+        max_seq_len_target = 0
+    return (enc_lengths, dec_lengths,
+            np.minimum(enc_lengths, max_seq_len_input),
+            np.minimum(dec_lengths, max_seq_len_target))
+
+
+def next_fit_offsets(enc_lengths, dec_lengths, max_seq_len_input,
+                     max_seq_len_target):
+    """Offsets of greedy next-fit packing of samples in file order.
+
+    A new sequence is started whenever adding the next sample would
+    exceed either the encoder or the decoder budget. Lengths must already
+    be truncated to the budgets.
+    """
+    num_samples = enc_lengths.shape[0]
+    if num_samples == 0:
+        return np.zeros(1, dtype=np.int64)
+    enc_cumsum = np.zeros(num_samples + 1, dtype=np.int64)
+    np.cumsum(enc_lengths, out=enc_cumsum[1:])
+    dec_cumsum = np.zeros(num_samples + 1, dtype=np.int64)
+    np.cumsum(dec_lengths, out=dec_cumsum[1:])
+    # next_start[i]: first sample of the next sequence if one starts at i
+    next_start = np.minimum(
+        np.searchsorted(enc_cumsum, enc_cumsum[:-1] + max_seq_len_input,
+                        side='right'),
+        np.searchsorted(dec_cumsum, dec_cumsum[:-1] + max_seq_len_target,
+                        side='right'),
+    ) - 1
+    next_start = np.maximum(next_start, np.arange(1, num_samples + 1)).tolist()
+    offsets = [0]
+    start = 0
+    while start < num_samples:
+        start = next_start[start]
+        offsets.append(start)
+    return np.array(offsets, dtype=np.int64)
+
+
+@register_packing_strategy('next_fit')
+def pack_next_fit(enc_lengths, dec_lengths, max_seq_len_input,
+                  max_seq_len_target):
+    """Greedy next-fit in file order; keeps the original sample order."""
+    offsets = next_fit_offsets(enc_lengths, dec_lengths,
+                               max_seq_len_input, max_seq_len_target)
+    return PackedSamples(offsets,
+                         np.arange(enc_lengths.shape[0], dtype=np.int64))
+
+
+def _decreasing_order(enc_lengths, dec_lengths, max_seq_len_input,
+                      max_seq_len_target):
+    """Sample order by decreasing dominant (normalized) length."""
+    enc_size = enc_lengths / max(max_seq_len_input, 1)
+    dec_size = dec_lengths / max(max_seq_len_target, 1)
+    dominant = np.maximum(enc_size, dec_size)
+    # lexsort sorts by the last key first; ties broken by sample index
+    return np.lexsort((np.arange(enc_lengths.shape[0]),
+                       -(enc_size + dec_size), -dominant))
+
+
+def _bins_to_packed_samples(sample_bins, num_bins):
+    """Build a PackedSamples from the bin assigned to each sample."""
+    sample_bins = np.asarray(sample_bins, dtype=np.int64)
+    offsets = np.zeros(num_bins + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sample_bins, minlength=num_bins),
+              out=offsets[1:])
+    # stable sort keeps samples ascending within each packed sequence
+    sample_indices = np.argsort(sample_bins, kind='stable').astype(np.int64)
+    return PackedSamples(offsets, sample_indices)
+
+
+@register_packing_strategy('first_fit_decreasing')
+def pack_first_fit_decreasing(enc_lengths, dec_lengths, max_seq_len_input,
+                              max_seq_len_target):
+    """First-fit-decreasing over both budgets.
+
+    Samples are visited by decreasing dominant length and put into the
+    first sequence with enough encoder and decoder room.
+    """
+    from megatron.data import helpers
+    order = _decreasing_order(enc_lengths, dec_lengths,
+                              max_seq_len_input, max_seq_len_target)
+    sample_bins = np.zeros(enc_lengths.shape[0], dtype=np.int64)
+    num_bins = helpers.pack_samples_first_fit(
+        order, enc_lengths, dec_lengths,
+        max_seq_len_input, max_seq_len_target, sample_bins)
+    return _bins_to_packed_samples(sample_bins, num_bins)
+
+
+def _pack_best_fit_decreasing(enc_lengths, dec_lengths, max_seq_len_input,
+                              max_seq_len_target, enc_weight, dec_weight,
+                              max_candidates=64):
+    from megatron.data import helpers
+    order = _decreasing_order(enc_lengths, dec_lengths,
+                              max_seq_len_input, max_seq_len_target)
+    sample_bins = np.zeros(enc_lengths.shape[0], dtype=np.int64)
+    num_bins = helpers.pack_samples_best_fit(
+        order, enc_lengths, dec_lengths,
+        max_seq_len_input, max_seq_len_target,
+        enc_weight, dec_weight, max_candidates, sample_bins)
+    return _bins_to_packed_samples(sample_bins, num_bins)
+
+
+@register_packing_strategy('best_fit')
+def pack_best_fit(enc_lengths, dec_lengths, max_seq_len_input,
+                  max_seq_len_target):
+    """Best-fit-decreasing on the encoder budget.
+
+    Each sample goes to the sequence with the least encoder room left
+    that can still hold it (decoder room is only checked).
+    """
+    return _pack_best_fit_decreasing(enc_lengths, dec_lengths,
+                                     max_seq_len_input, max_seq_len_target,
+                                     1.0, 0.0)
+
+
+@register_packing_strategy('best_fit_2d')
+def pack_best_fit_2d(enc_lengths, dec_lengths, max_seq_len_input,
+                     max_seq_len_target):
+    """Joint encoder/decoder best-fit-decreasing.
+
+    Among the candidate sequences that can hold a sample, pick the one
+    whose remaining encoder plus decoder room, each normalized by its
+    budget, is smallest after adding the sample.
+    """
+    return _pack_best_fit_decreasing(enc_lengths, dec_lengths,
+                                     max_seq_len_input, max_seq_len_target,
+                                     1.0 / max(max_seq_len_input, 1),
+                                     1.0 / max(max_seq_len_target, 1))
+
+
+def get_packing_stats(packed_samples, enc_lengths, dec_lengths,
+                      enc_seq_lengths, dec_seq_lengths,
+                      max_seq_len_input, max_seq_len_target):
+    """Efficiency and truncation statistics of a packing."""
+    num_sequences = max(len(packed_samples), 1)
+    enc_truncated = enc_lengths - enc_seq_lengths
+    dec_truncated = dec_lengths - dec_seq_lengths
+    truncated = (enc_truncated > 0) | (dec_truncated > 0)
+    total_enc_truncated_tokens = int(enc_truncated.sum())
+    total_dec_truncated_tokens = int(dec_truncated.sum())
+    return {
+        'num_sequences': len(packed_samples),
+        'num_samples': packed_samples.num_samples,
+        'avg_samples_per_sequence': packed_samples.num_samples / num_sequences,
+        'enc_efficiency': int(enc_seq_lengths.sum()) /
+            (num_sequences * max(max_seq_len_input, 1)),
+        'dec_efficiency': int(dec_seq_lengths.sum()) /
+            (num_sequences * max(max_seq_len_target, 1)),
+        'num_truncated_samples': int(truncated.sum()),
+        'enc_truncated_ratio': total_enc_truncated_tokens /
+            (int(enc_lengths.sum()) + 1e-6),
+        'dec_truncated_ratio': total_dec_truncated_tokens /
+            (int(dec_lengths.sum()) + 1e-6),
+        'enc_truncated_ratio_among_truncated': total_enc_truncated_tokens /
+            (int(enc_lengths[enc_truncated > 0].sum()) + 1e-6),
+        'dec_truncated_ratio_among_truncated': total_dec_truncated_tokens /
+            (int(dec_lengths[dec_truncated > 0].sum()) + 1e-6),
+    }
+
+
+def print_packing_stats(stats, strategy=DEFAULT_PACKING_STRATEGY):
+    print_rank_0(
+        ">>>> Pack samples ({}): {} sequences, avg samples per sequence: {}, enc batching eff: {}, dec batching eff: {}".format(
+            strategy,
+            stats['num_sequences'],
+            stats['avg_samples_per_sequence'],
+            stats['enc_efficiency'],
+            stats['dec_efficiency'],
+        )
+    )
+    print_rank_0(
+        ">>> Truncated {}/{} samples: enc truncated token ratio: {}, dec truncated token ratio: {}, enc ratio among truncated: {}, dec ratio among truncated: {}".format(
+            stats['num_truncated_samples'], stats['num_samples'],
+            stats['enc_truncated_ratio'],
+            stats['dec_truncated_ratio'],
+            stats['enc_truncated_ratio_among_truncated'],
+            stats['dec_truncated_ratio_among_truncated'],
+        )
+    )
+
+
+def run_pack_samples(
+    input_samples_mapping,
+    max_seq_len_input,
+    target_samples_mapping=None,
+    max_seq_len_target=None,
+    inputs_only=False,
+    strategy=DEFAULT_PACKING_STRATEGY,
+):
+    """Pack multiple samples into a single sequence.
+
+    Returns a `PackedSamples` indexing rows of the samples mappings and a
+    dict of packing statistics. `strategy` is a name registered in
+    `PACKING_STRATEGIES` (or True for the default strategy).
+    """
+    pack_fn = get_packing_strategy(strategy)
+    strategy = get_packing_strategy_name(strategy)
+    (enc_lengths, dec_lengths,
+     enc_seq_lengths, dec_seq_lengths) = get_packing_lengths(
+        input_samples_mapping, max_seq_len_input,
+        target_samples_mapping, max_seq_len_target,
+        inputs_only=inputs_only)
+    if max_seq_len_target is None:
+        max_seq_len_target = 0
+    packed_samples = pack_fn(enc_seq_lengths, dec_seq_lengths,
+                             max_seq_len_input, max_seq_len_target)
+    assert packed_samples.num_samples == enc_lengths.shape[0]
+    stats = get_packing_stats(packed_samples, enc_lengths, dec_lengths,
+                              enc_seq_lengths, dec_seq_lengths,
+                              max_seq_len_input, max_seq_len_target)
+    print_packing_stats(stats, strategy=strategy)
+    return packed_samples, stats
+
+
+def compare_packing_strategies(
+    input_samples_mapping,
+    max_seq_len_input,
+    target_samples_mapping=None,
+    max_seq_len_target=None,
+    inputs_only=False,
+    strategies=None,
+):
+    """Run several packing strategies and return their statistics by name."""
+    if strategies is None:
+        strategies = sorted(PACKING_STRATEGIES.keys())
+    results = {}
+    for strategy in strategies:
+        _, results[strategy] = run_pack_samples(
+            input_samples_mapping, max_seq_len_input,
+            target_samples_mapping, max_seq_len_target,
+            inputs_only=inputs_only, strategy=strategy)
+    return results
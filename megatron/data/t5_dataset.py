@@ -11,132 +11,35 @@ from megatron import get_tokenizer, get_args
 from megatron.data.dataset_utils import (
     create_masked_lm_predictions,
     get_samples_mapping,
+    get_packed_samples,
     get_samples_mapping_supervised,
 )
+from megatron.data.sample_packing import get_samples_mapping_lengths
 from megatron.utils import print_rank_0
 
 
-def run_pack_samples(
-    input_samples_mapping,
-    max_seq_len_input,
-    target_samples_mapping=None,
-    max_seq_len_target=None,
-    inputs_only=False,
-):
-    """Pack multiple samples into a single sequence."""
-    # each sample is a list of tuples (start_idx, end_idx, seq_len)
-    input_samples = []
-    target_samples = []
-    assert target_samples_mapping is not None, \
-        "Currently only support supervised tasks"
-    if target_samples_mapping is not None:
-        assert len(input_samples_mapping) == len(
-            target_samples_mapping
-        ), "input and target samples mapping should have the same length"
-    curr_input_seq_len = 0
-    curr_target_seq_len = 0
-    curr_input_sequence = []
-    curr_target_sequence = []
-    avg_samples_per_sequence = 0
-    total_enc_untruncated_tokens = 0
-    total_dec_untruncated_tokens = 0
-    total_enc_tokens = 0
-    total_dec_tokens = 0
-    total_enc_truncated_tokens = 0
-    total_dec_truncated_tokens = 0
-    num_truncated_samples = 0
-    total_enc_tokens_for_samples_truncated = 0
-    total_dec_tokens_for_samples_truncated = 0
-    for idx in range(len(input_samples_mapping)):
-        truncated = False
-        input_sample = input_samples_mapping[idx]
-        target_sample = target_samples_mapping[idx]
-
-        input_sample_length = input_sample[2]
-        target_sample_length = target_sample[2]
-        if inputs_only:
-            # use concatenated lengths for input
-            input_sample_length += target_sample_length
-            target_sample_length = 0
-
-        total_enc_untruncated_tokens += input_sample_length
-        total_dec_untruncated_tokens += target_sample[2]
-        if input_sample_length > max_seq_len_input:
-            truncated = True
-            total_enc_truncated_tokens += input_sample_length - max_seq_len_input
-            total_enc_tokens_for_samples_truncated += input_sample_length
-        if target_sample[2] > max_seq_len_target:
-            truncated = True
-            total_dec_truncated_tokens += target_sample[2] - max_seq_len_target
-            total_dec_tokens_for_samples_truncated += target_sample[2]
-        input_seq_len = min(input_sample_length, max_seq_len_input)
-        target_seq_len = min(target_sample_length, max_seq_len_target)
-        total_enc_tokens += input_seq_len
-        total_dec_tokens += target_seq_len
-        if truncated:
-            num_truncated_samples += 1
-        # if adding the current sample will exceed the max sequence length,
-        # then start a new sequence
-        # Note: if inputs_only, we still put target_samples into
-        # curr_target_sequence to simplify the code. Actual concatenation
-        # happens later.
-        if curr_input_seq_len + input_seq_len > max_seq_len_input or (
-           curr_target_seq_len + target_seq_len > max_seq_len_target
-        ):
-            input_samples.append(curr_input_sequence.copy())
-            avg_samples_per_sequence += len(curr_input_sequence)
-            curr_input_seq_len = 0
-            curr_input_sequence = []
-            target_samples.append(curr_target_sequence.copy())
-            curr_target_seq_len = 0
-            curr_target_sequence = []
-        curr_input_seq_len += input_seq_len
-        curr_input_sequence.append(tuple(input_sample))
-        curr_target_seq_len += target_seq_len
-        curr_target_sequence.append(tuple(target_sample))
-    # last sequence
-    if curr_input_seq_len > 0:
-        input_samples.append(curr_input_sequence)
-        target_samples.append(curr_target_sequence)
-        avg_samples_per_sequence += len(curr_input_sequence)
-    print_rank_0(
-        ">>>> Pack samples: {} input sequences, {} target sequences, avg samples per sequence: {}, enc batching eff: {}, dec batching eff: {}".format(
-            len(input_samples),
-            len(target_samples),
-            avg_samples_per_sequence / len(input_samples),
-            total_enc_tokens / (len(input_samples) * max_seq_len_input),
-            total_dec_tokens / (len(target_samples) * max_seq_len_target),
-        )
-    )
-    print_rank_0(
-        ">>> Truncated {}/{} samples: enc truncated token ratio: {}, dec truncated token ratio: {}, enc ratio among truncated: {}, dec ratio among truncated: {}".format(
-            num_truncated_samples, len(input_samples_mapping), 
-            total_enc_truncated_tokens / (total_enc_untruncated_tokens + 1e-6), 
-            total_dec_truncated_tokens / (total_dec_untruncated_tokens + 1e-6), 
-            total_enc_truncated_tokens / (total_enc_tokens_for_samples_truncated + 1e-6), 
-            total_dec_truncated_tokens / (total_dec_tokens_for_samples_truncated + 1e-6),
-        )
-    )
-    return input_samples, target_samples
-
-
 class T5UnsupervisedDataset(torch.utils.data.Dataset):
     def __init__(self, name, indexed_dataset, data_prefix,
                  num_epochs, max_num_samples, masked_lm_prob,
                  max_seq_length, max_seq_length_dec,
                  short_seq_prob, seed,
-                 sort_samples=False, pack_samples=False):
+                 sort_samples=False, pack_samples=False,
+                 compact_attention_mask=False):
 
         # Params to store.
         self.name = name
+        self.data_prefix = data_prefix
         self.seed = seed
         self.sorted = sort_samples
-        self.packed = pack_samples
+        # pack_samples is either a bool or the name of a packing strategy
+        self.packed = bool(pack_samples)
         self.supervised = False
         self.ordered = True if self.sorted or self.packed else False
         self.masked_lm_prob = masked_lm_prob
         self.max_seq_length = max_seq_length
         self.max_seq_length_dec = max_seq_length_dec
+        self.compact_attention_mask = compact_attention_mask
+        self.padded_batches = False
 
         # Dataset.
         self.indexed_dataset = indexed_dataset
@@ -152,9 +55,12 @@ class T5UnsupervisedDataset(torch.utils.data.Dataset):
                                                    self.name,
                                                    False,
                                                    sort_samples=sort_samples)
+        self.seq_lengths = get_samples_mapping_lengths(self.samples_mapping)
         if pack_samples:
-            self.packed_samples, _ = run_pack_samples(
-                self.samples_mapping, self.max_seq_length
+            self.packed_samples, self.packing_stats = get_packed_samples(
+                self.samples_mapping, self.max_seq_length,
+                None, None, data_prefix, self.name,
+                strategy=pack_samples,
             )
 
         # Vocab stuff.
@@ -174,29 +80,30 @@ class T5UnsupervisedDataset(torch.utils.data.Dataset):
         if self.packed:
             return self.max_seq_length
         else:
-            return self.samples_mapping[idx, 2]
+            return self.seq_lengths[idx]
+
+    def get_seq_lens(self):
+        """`get_seq_len` of every sample, as an array."""
+        if self.packed:
+            return np.full(len(self), self.max_seq_length, dtype=np.int64)
+        return self.seq_lengths
+
+    def get_dec_seq_lens(self):
+        """Expected number of target tokens of every sample, as an array."""
+        return (self.get_seq_lens() * self.masked_lm_prob).astype(np.int64)
 
     def get_padding_efficiency(self):
-        total_actual_input_tokens = 0
-        total_padded_input_tokens = 0
-        total_actual_target_tokens = 0
-        total_padded_target_tokens = 0
-        for idx in range(len(self)):
-            actual_input_seq_len = 0
-            if self.packed:
-                for (_, _, seq_len) in self.packed_samples[idx]:
-                    actual_input_seq_len += seq_len
-            else:
-                _, _, seq_len = self.samples_mapping[idx]
-                actual_input_seq_len += seq_len
-            actual_target_seq_len = int(actual_input_seq_len * self.masked_lm_prob)
-            total_actual_input_tokens += actual_input_seq_len
-            total_actual_target_tokens += actual_target_seq_len
-            total_padded_input_tokens += self.max_seq_length
-            total_padded_target_tokens += self.max_seq_length_dec
+        seq_lens = self.seq_lengths
+        if self.packed:
+            actual_input_seq_lens = self.packed_samples.sequence_lengths(seq_lens)
+        else:
+            actual_input_seq_lens = seq_lens
+        actual_target_seq_lens = (
+            actual_input_seq_lens * self.masked_lm_prob).astype(np.int64)
+        num_sequences = len(self)
         return (
-            total_actual_input_tokens / total_padded_input_tokens,
-            total_actual_target_tokens / total_padded_target_tokens,
+            int(actual_input_seq_lens.sum()) / (num_sequences * self.max_seq_length),
+            int(actual_target_seq_lens.sum()) / (num_sequences * self.max_seq_length_dec),
         )
 
     def __len__(self):
@@ -205,17 +112,26 @@ class T5UnsupervisedDataset(torch.utils.data.Dataset):
         else:
             return self.samples_mapping.shape[0]
 
-    def __getitem__(self, idx):
-        sample = []
+    def prefetch(self, indices):
+        """Read ahead the sentences of samples `indices` in the background,
+        if the indexed dataset supports it."""
+        if not hasattr(self.indexed_dataset, 'prefetch_spans'):
+            return
+        rows = self.samples_mapping[_get_sample_indices(self, indices)]
+        self.indexed_dataset.prefetch_spans(rows[:, 0], rows[:, 1])
+
+    def prefetch_stats(self):
+        """Page cache hits and misses of the sentences read ahead so far,
+        or None if the indexed dataset is not read ahead."""
+        return _sum_prefetch_stats([self.indexed_dataset])
+
+    def _get_sentence_ranges(self, idx):
         if self.packed:
-            for (start_index, end_index, _) in self.packed_samples[idx]:
-                sample.extend(self.indexed_dataset[start_index:end_index])
-                for index in range(start_index, end_index):
-                    sample.append(self.indexed_dataset[index])
-        else:
-            start_index, end_index, _ = self.samples_mapping[idx]
-            for index in range(start_index, end_index):
-                sample.append(self.indexed_dataset[index])
+            return [self.samples_mapping[sample_idx][:2]
+                    for sample_idx in self.packed_samples[idx]]
+        return [self.samples_mapping[idx][:2]]
+
+    def _build_sample(self, idx, sample):
         # Note that this rng state should be numpy and not python since
         # python randint is inclusive whereas the numpy one is exclusive.
         np_rng = np.random.RandomState(seed=(self.seed + idx))
@@ -228,7 +144,48 @@ class T5UnsupervisedDataset(torch.utils.data.Dataset):
                                      self.mask_id, self.pad_id,
                                      self.masked_lm_prob, np_rng,
                                      self.bos_id, self.eos_id,
-                                     self.sentinel_tokens)
+                                     self.sentinel_tokens,
+                                     self.compact_attention_mask)
+
+    def __getitem__(self, idx):
+        sentence_indices = np.concatenate([
+            np.arange(start_index, end_index, dtype=np.int64)
+            for start_index, end_index in self._get_sentence_ranges(idx)
+        ])
+        if hasattr(self.indexed_dataset, "gather"):
+            tokens, offsets = self.indexed_dataset.gather(sentence_indices)
+            sample = np.split(tokens, offsets[1:-1])
+        else:
+            sample = [self.indexed_dataset[index] for index in sentence_indices]
+        return self._build_sample(idx, sample)
+
+    def enable_padded_batches(self):
+        """Make `__getitems__` return a collated batch of tensors instead of
+        a list of samples."""
+        self.padded_batches = True
+
+    def __getitems__(self, indices):
+        if not self.padded_batches:
+            return [self[idx] for idx in indices]
+        if not hasattr(self.indexed_dataset, "gather"):
+            return collate_padded_samples([self[idx] for idx in indices])
+        # Read the sentences of all samples at once.
+        sample_ranges = [self._get_sentence_ranges(idx) for idx in indices]
+        sentence_indices = np.concatenate([
+            np.arange(start_index, end_index, dtype=np.int64)
+            for ranges in sample_ranges for start_index, end_index in ranges
+        ])
+        tokens, offsets = self.indexed_dataset.gather(sentence_indices)
+        sentences = np.split(tokens, offsets[1:-1])
+        samples = []
+        sentence_offset = 0
+        for idx, ranges in zip(indices, sample_ranges):
+            num_sentences = sum(int(end_index) - int(start_index)
+                                for start_index, end_index in ranges)
+            samples.append(self._build_sample(
+                idx, sentences[sentence_offset:sentence_offset + num_sentences]))
+            sentence_offset += num_sentences
+        return collate_padded_samples(samples)
 
 
 class T5SupervisedDataset(torch.utils.data.Dataset):
@@ -248,13 +205,18 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
         pack_samples=False,
         dynamic_batchsize=True,
         offline_build=False,
+        compact_attention_mask=False,
+        isolate_packed_samples=False,
+        mapping_build_threads=1,
     ):
 
         # Params to store.
         self.name = name
+        self.data_prefix = data_prefix
         self.seed = seed
         self.sorted = sort_samples
-        self.packed = pack_samples
+        # pack_samples is either a bool or the name of a packing strategy
+        self.packed = bool(pack_samples)
         self.supervised = True
         self.ordered = True
         self.inputs_only = inputs_only
@@ -267,6 +229,12 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
         self.adjusted_num_samples = None
         self.offline_build = offline_build
         self.dynamic_batchsize = dynamic_batchsize
+        self.compact_attention_mask = compact_attention_mask
+        self.isolate_packed_samples = isolate_packed_samples
+        self.padded_batches = False
+        # pad each microbatch only to its longest sample instead of the
+        # maximum sequence lengths, set by the bucketed sampler
+        self.pad_to_longest = False
 
         # Dataset.
         self.input_indexed_dataset = input_indexed_dataset
@@ -288,15 +256,24 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
             self.name,
             sort_samples=sort_samples,
             offline_build=offline_build,
+            num_threads=mapping_build_threads,
         )
+        self.input_seq_lengths = get_samples_mapping_lengths(
+            self.input_samples_mapping)
+        self.target_seq_lengths = get_samples_mapping_lengths(
+            self.target_samples_mapping)
 
         if pack_samples:
-            self.packed_input_samples, self.packed_target_samples = run_pack_samples(
+            self.packed_samples, self.packing_stats = get_packed_samples(
                 self.input_samples_mapping,
                 self.max_seq_length,
                 self.target_samples_mapping,
                 self.max_seq_length_dec - 2,
+                data_prefix,
+                self.name,
                 inputs_only=self.inputs_only,
+                strategy=pack_samples,
+                offline_build=offline_build,
             )
 
         # Vocab stuff.
@@ -347,8 +324,8 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
             return self.max_seq_length
         else:
             if self.inputs_only:
-                return self.input_samples_mapping[idx, 2] + self.target_samples_mapping[idx, 2]
-            return self.input_samples_mapping[idx, 2]
+                return self.input_seq_lengths[idx] + self.target_seq_lengths[idx]
+            return self.input_seq_lengths[idx]
 
     def get_dec_seq_len(self, idx):
         if self.inputs_only:
@@ -356,32 +333,80 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
         if self.packed:
             return self.max_seq_length_dec
         else:
-            return self.target_samples_mapping[idx, 2]
+            return self.target_seq_lengths[idx]
+
+    def get_seq_lens(self):
+        """`get_seq_len` of every sample, as an array."""
+        if self.packed:
+            return np.full(len(self), self.max_seq_length, dtype=np.int64)
+        if self.inputs_only:
+            return self.input_seq_lengths + self.target_seq_lengths
+        return self.input_seq_lengths
+
+    def get_dec_seq_lens(self):
+        """`get_dec_seq_len` of every sample, as an array."""
+        if self.inputs_only:
+            return np.zeros(len(self), dtype=np.int64)
+        if self.packed:
+            return np.full(len(self), self.max_seq_length_dec, dtype=np.int64)
+        return self.target_seq_lengths
 
     def set_adjusted_num_samples(self, adjusted_num_samples):
         self.adjusted_num_samples = adjusted_num_samples
 
     def __len__(self):
         if self.packed:
-            return len(self.packed_input_samples)
+            return len(self.packed_samples)
         else:
             return self.input_samples_mapping.shape[0]
 
+    def prefetch(self, indices):
+        """Read ahead the input and target sentences of samples `indices`
+        in the background, if the indexed datasets support it."""
+        if not (hasattr(self.input_indexed_dataset, 'prefetch_spans')
+                and hasattr(self.target_indexed_dataset, 'prefetch_spans')):
+            return
+        sample_indices = _get_sample_indices(self, indices)
+        input_rows = self.input_samples_mapping[sample_indices]
+        target_rows = self.target_samples_mapping[sample_indices]
+        self.input_indexed_dataset.prefetch_spans(input_rows[:, 0], input_rows[:, 1])
+        self.target_indexed_dataset.prefetch_spans(target_rows[:, 0], target_rows[:, 1])
+
+    def prefetch_stats(self):
+        """Page cache hits and misses of the input and target sentences
+        read ahead so far, or None if the indexed datasets are not read
+        ahead."""
+        return _sum_prefetch_stats([self.input_indexed_dataset,
+                                    self.target_indexed_dataset])
+
     def pack_fn(self, tensors):
+        """Concatenate samples into one sequence, separated by `sep_id`.
+
+        Also returns the segment ids of the sequence: the 1-based index of
+        the sample every token belongs to. A separator belongs to the sample
+        it precedes.
+        """
         tensors_to_cat = []
         if len(tensors) == 0 or tensors is None:
-            return tensors_to_cat, 0
+            return tensors_to_cat, []
+        segment_lengths = np.array([len(tensor) for tensor in tensors],
+                                   dtype=np.int64)
+        segment_lengths[1:] += 1
+        segment_ids = np.repeat(
+            np.arange(1, len(tensors) + 1, dtype=np.int64), segment_lengths)
         if isinstance(tensors[0], list):
             for idx, tensor in enumerate(tensors):
                 tensors_to_cat.extend(tensor)
                 if idx != len(tensors) - 1:
                     tensors_to_cat.extend([self.sep_id])
+            segment_ids = segment_ids.tolist()
         elif isinstance(tensors[0], torch.Tensor):
             for idx, tensor in enumerate(tensors):
                 tensors_to_cat.append(tensor)
                 if idx != len(tensors) - 1:
                     tensors_to_cat.append(torch.tensor([self.sep_id]))
             tensors_to_cat = torch.cat(tensors_to_cat)
+            segment_ids = torch.from_numpy(segment_ids)
         elif isinstance(tensors[0], np.ndarray):
             for idx, tensor in enumerate(tensors):
                 tensors_to_cat.append(tensor)
@@ -390,8 +415,7 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
             tensors_to_cat = np.concatenate(tensors_to_cat)
         else:
             raise ValueError("Unsupported type in pack_fn: {}".format(type(tensors[0])))
-        # currently do not return packing masks
-        return tensors_to_cat, 0
+        return tensors_to_cat, segment_ids
 
     def constructor_fn(self, encoder_input,
                             encoder_extra,
@@ -399,6 +423,9 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
                             decoder_extra,
                             encoder_seqlen,
                             decoder_seqlen):
+        # the extras are the segment ids returned by pack_fn
+        if not self.isolate_packed_samples:
+            encoder_extra = decoder_extra = None
         return build_supervised_training_sample(
             encoder_input,
             decoder_input,
@@ -408,9 +435,18 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
             self.bos_id,
             self.eos_id,
             self.sentinel_tokens,
+            self.compact_attention_mask,
+            enc_segment_ids=encoder_extra,
+            dec_segment_ids=decoder_extra,
         )
 
     def non_dynapipe_collate_fn(self, batch):
+        if self.padded_batches:
+            # already padded and collated by __getitems__
+            return batch
+        return self._collate_samples(batch)
+
+    def _collate_samples(self, batch):
         # pad to max sequence length
         from torch.utils.data import default_collate
         args = get_args()
@@ -420,6 +456,7 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
         assert len(batch) % micro_batch_size == 0, "batch size must be divisible by micro batch size"
         for sequence in batch:
             enc_key = "text" if self.inputs_only else "text_enc"
+            enc_segment_key = "segment_ids" if self.inputs_only else "enc_segment_ids"
             seqlen_offset = 1 if self.inputs_only else 0
             padded_sequence = build_supervised_training_sample(
                 sequence[enc_key],
@@ -430,6 +467,9 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
                 self.bos_id,
                 self.eos_id,
                 self.sentinel_tokens,
+                self.compact_attention_mask,
+                enc_segment_ids=sequence.get(enc_segment_key),
+                dec_segment_ids=sequence.get("dec_segment_ids"),
             )
             current_micro_batch.append(padded_sequence)
             if len(current_micro_batch) == micro_batch_size:
@@ -442,50 +482,268 @@ class T5SupervisedDataset(torch.utils.data.Dataset):
             return result[0]
         return result
 
+    def enable_padded_batches(self):
+        """Make `__getitems__` return padded, collated microbatches (as
+        `non_dynapipe_collate_fn` would) instead of a list of samples.
+        Only for the torch data loader: DynaPipe needs the raw samples."""
+        self.padded_batches = True
+
+    def __getitems__(self, indices):
+        if not self.padded_batches:
+            return [self[idx] for idx in indices]
+        if self.packed or not (
+            hasattr(self.input_indexed_dataset, "get_batch")
+            and hasattr(self.target_indexed_dataset, "get_batch")
+        ):
+            return self._collate_samples([self[idx] for idx in indices])
+        args = get_args()
+        assert len(indices) % args.micro_batch_size == 0, \
+            "batch size must be divisible by micro batch size"
+        max_seq_length = args.encoder_seq_length + (1 if self.inputs_only else 0)
+        max_seq_length_dec = args.decoder_seq_length if not self.inputs_only else 0
+        result = []
+        if self.pad_to_longest:
+            for start in range(0, len(indices), args.micro_batch_size):
+                micro_batch_indices = indices[start:start + args.micro_batch_size]
+                batch = self.get_padded_batch(
+                    micro_batch_indices,
+                    *self._get_longest_seq_lengths(
+                        micro_batch_indices, max_seq_length, max_seq_length_dec))
+                result.append({key: torch.from_numpy(value)
+                               for key, value in batch.items()})
+        else:
+            batch = self.get_padded_batch(indices, max_seq_length,
+                                          max_seq_length_dec)
+            for start in range(0, len(indices), args.micro_batch_size):
+                result.append({
+                    key: torch.from_numpy(value[start:start + args.micro_batch_size])
+                    for key, value in batch.items()
+                })
+        if not self.dynamic_batchsize:
+            # directly return a batch
+            assert len(result) == 1
+            return result[0]
+        return result
+
+    def _get_longest_seq_lengths(self, indices, max_seq_length,
+                                 max_seq_length_dec, multiple=8):
+        """Padded lengths fitting the longest sample of `indices`, rounded up
+        to `multiple` and capped at the given maximum lengths."""
+        def round_up(length, max_length):
+            return min(-(-length // multiple) * multiple, max_length)
+
+        indices = np.asarray(indices, dtype=np.int64)
+        input_rows = self.input_samples_mapping[indices]
+        target_rows = self.target_samples_mapping[indices]
+        input_lengths = self.input_indexed_dataset.get_span_sizes(
+            input_rows[:, 0], input_rows[:, 1])
+        target_lengths = self.target_indexed_dataset.get_span_sizes(
+            target_rows[:, 0], target_rows[:, 1])
+        if self.inputs_only:
+            # inputs, targets and <eos>
+            return round_up(int((input_lengths + target_lengths).max()) + 1,
+                            max_seq_length), 0
+        # <bos> + target and target + <eos>, with room for the added token
+        return (round_up(int(input_lengths.max()), max_seq_length),
+                round_up(int(target_lengths.max()) + 2, max_seq_length_dec))
+
+    def get_padded_batch(self, indices, max_seq_length, max_seq_length_dec):
+        """Padded training samples for `indices` as `[batch, ...]` arrays.
+
+        Equivalent to `build_supervised_training_sample` applied to each
+        unpacked sample, but reads the tokens of all samples with one
+        vectorized read per indexed dataset and pads in place.
+        """
+        assert not self.packed
+        indices = np.asarray(indices, dtype=np.int64)
+        input_rows = self.input_samples_mapping[indices]
+        target_rows = self.target_samples_mapping[indices]
+        input_lengths = self.input_indexed_dataset.get_span_sizes(
+            input_rows[:, 0], input_rows[:, 1])
+        target_lengths = self.target_indexed_dataset.get_span_sizes(
+            target_rows[:, 0], target_rows[:, 1])
+
+        if self.inputs_only:
+            # inputs followed by targets, truncated as in __getitem__
+            input_lengths = np.minimum(input_lengths, self.max_seq_length)
+            target_lengths = np.minimum(
+                target_lengths, self.max_seq_length - input_lengths)
+            input_lengths = np.minimum(input_lengths, max_seq_length)
+            target_lengths = np.minimum(
+                target_lengths, max_seq_length - input_lengths)
+            tokens = np.full((len(indices), max_seq_length), self.pad_id,
+                             dtype=np.int64)
+            columns = np.arange(max_seq_length)[None, :]
+            tokens[columns < input_lengths[:, None]] = \
+                self.input_indexed_dataset.get_batch(
+                    input_rows[:, 0], lengths=input_lengths)
+            num_tokens = input_lengths + target_lengths
+            tokens[(columns >= input_lengths[:, None]) &
+                   (columns < num_tokens[:, None])] = \
+                self.target_indexed_dataset.get_batch(
+                    target_rows[:, 0], lengths=target_lengths)
+            has_room = num_tokens < max_seq_length
+            tokens[np.nonzero(has_room)[0], num_tokens[has_room]] = self.eos_id
+            return {"text": tokens}
+
+        # truncate as in __getitem__, then to the requested lengths
+        input_lengths = np.minimum(input_lengths, self.max_seq_length)
+        target_lengths = np.minimum(target_lengths, self.max_seq_length_dec - 2)
+        input_truncated = input_lengths > max_seq_length
+        target_truncated = target_lengths > max_seq_length_dec - 2
+        input_lengths = np.minimum(input_lengths, max_seq_length)
+        target_lengths = np.minimum(target_lengths, max_seq_length_dec - 2)
+        batch_size = len(indices)
+        rows = np.arange(batch_size)
+
+        tokens_enc = np.full((batch_size, max_seq_length), self.pad_id,
+                             dtype=np.int64)
+        tokens_enc[np.arange(max_seq_length)[None, :] < input_lengths[:, None]] = \
+            self.input_indexed_dataset.get_batch(
+                input_rows[:, 0], lengths=input_lengths)
+
+        # Decoder input is <bos> + target, decoder output is target + <eos>.
+        target_tokens = self.target_indexed_dataset.get_batch(
+            target_rows[:, 0], lengths=target_lengths)
+        target_positions = \
+            np.arange(max_seq_length_dec)[None, :] < target_lengths[:, None]
+        tokens_dec_in = np.full((batch_size, max_seq_length_dec), self.pad_id,
+                                dtype=np.int64)
+        tokens_dec_in[:, 0] = self.bos_id
+        tokens_dec_in[:, 1:][target_positions[:, :-1]] = target_tokens
+        labels = np.full((batch_size, max_seq_length_dec), -1, dtype=np.int64)
+        labels[target_positions] = target_tokens
+        labels[rows, target_lengths] = self.eos_id
+        loss_mask = (np.arange(max_seq_length_dec)[None, :] <=
+                     target_lengths[:, None]).astype(np.int64)
+
+        batch = {
+            "text_enc": tokens_enc,
+            "text_dec": tokens_dec_in,
+            "labels": labels,
+            "loss_mask": loss_mask,
+            "input_truncated": input_truncated.astype(np.int64),
+            "target_truncated": target_truncated.astype(np.int64),
+        }
+        if not self.compact_attention_mask:
+            # Create attention masks
+            enc_mask = make_attention_mask_3d(tokens_enc, tokens_enc).astype(np.int64)
+            enc_dec_mask = make_attention_mask_3d(tokens_dec_in, tokens_enc).astype(np.int64)
+            dec_mask = make_attention_mask_3d(tokens_dec_in, tokens_dec_in).astype(np.int64)
+            dec_mask *= make_history_mask(tokens_dec_in[0])[None, :, :]
+            batch["enc_mask"] = enc_mask
+            batch["dec_mask"] = dec_mask
+            batch["enc_dec_mask"] = enc_dec_mask
+        return batch
+
     def __getitem__(self, idx):
         if idx == -1:
             # for dynamic microbatch size
             return None
-        input_sample = []
-        target_sample = []
         if self.packed:
-            for (start_index, end_index, _) in self.packed_input_samples[idx]:
-                for index in range(start_index, end_index):
-                    input_sample.append(self.input_indexed_dataset[index])
-            for (start_index, end_index, _) in self.packed_target_samples[idx]:
-                for index in range(start_index, end_index):
-                    target_sample.append(self.target_indexed_dataset[index])
+            sample_indices = self.packed_samples[idx]
         else:
-            input_start_index, input_end_index, _ = self.input_samples_mapping[idx]
-            target_start_index, target_end_index, _ = self.target_samples_mapping[idx]
-            for index in range(input_start_index, input_end_index):
-                input_sample.append(self.input_indexed_dataset[index])
-            for index in range(target_start_index, target_end_index):
-                target_sample.append(self.target_indexed_dataset[index])
+            sample_indices = [idx]
+        input_sample = []
+        target_sample = []
+        for sample_idx in sample_indices:
+            start_index, end_index, _ = self.input_samples_mapping[sample_idx]
+            input_sample.append(get_token_span(
+                self.input_indexed_dataset, start_index, end_index))
+            start_index, end_index, _ = self.target_samples_mapping[sample_idx]
+            target_sample.append(get_token_span(
+                self.target_indexed_dataset, start_index, end_index))
 
         if self.inputs_only:
-            # concat target to input
-            input_sample = input_sample + target_sample
-            target_sample = []
+            # concat the target of every sample to its input
+            input_sample = [np.concatenate([input_tokens, target_tokens])
+                            for input_tokens, target_tokens
+                            in zip(input_sample, target_sample)]
+            target_sample = None
 
-        # Note that this rng state should be numpy and not python since
-        # python randint is inclusive whereas the numpy one is exclusive.
-        # np_rng = np.random.RandomState(seed=(self.seed + idx))
         if self.packed:
             # run pack fn on the samples
-            input_sample, _ = self.pack_fn(input_sample)
-            input_sample = [input_sample]
+            input_sample, input_segment_ids = self.pack_fn(input_sample)
+            if not self.inputs_only:
+                target_sample, target_segment_ids = self.pack_fn(target_sample)
+        else:
+            input_sample = input_sample[0]
             if not self.inputs_only:
-                target_sample, _ = self.pack_fn(target_sample)
-                target_sample = [target_sample]
+                target_sample = target_sample[0]
 
-        if not self.inputs_only:
-            return build_unpadded_sample(
-                input_sample, self.max_seq_length, target_sample, self.max_seq_length_dec
-            )
-        return build_unpadded_sample(
-            input_sample, self.max_seq_length, None, self.max_seq_length_dec
+        sample = build_unpadded_sample(
+            input_sample, self.max_seq_length, target_sample, self.max_seq_length_dec
         )
+        if self.packed and self.isolate_packed_samples:
+            # segment ids are truncated along with the tokens
+            if self.inputs_only:
+                sample["segment_ids"] = \
+                    input_segment_ids[:len(sample["text"])]
+            else:
+                sample["enc_segment_ids"] = \
+                    input_segment_ids[:len(sample["text_enc"])]
+                sample["dec_segment_ids"] = \
+                    target_segment_ids[:len(sample["text_dec"])]
+        return sample
+
+
+def collate_padded_samples(samples):
+    """Stack equally shaped (padded) samples into a dict of tensors, writing
+    each field into a single preallocated array."""
+    batch = {}
+    for key, value in samples[0].items():
+        value = np.asarray(value)
+        stacked = np.empty((len(samples),) + value.shape, dtype=value.dtype)
+        for i, sample in enumerate(samples):
+            stacked[i] = sample[key]
+        batch[key] = torch.from_numpy(stacked)
+    return batch
+
+
+def _get_sample_indices(dataset, indices):
+    """Sorted rows of the samples mapping read by dataset items `indices`
+    (-1, the padding index of dynamic microbatches, is skipped)."""
+    indices = np.asarray(indices, dtype=np.int64).ravel()
+    indices = indices[indices >= 0]
+    if dataset.packed:
+        indices = np.concatenate(
+            [np.asarray(dataset.packed_samples[idx], dtype=np.int64)
+             for idx in indices] + [np.empty(0, dtype=np.int64)])
+    return np.unique(indices)
+
+
+def _sum_prefetch_stats(indexed_datasets):
+    if not all(hasattr(d, 'prefetch_stats') for d in indexed_datasets):
+        return None
+    stats = collections.Counter()
+    for indexed_dataset in indexed_datasets:
+        stats.update(indexed_dataset.prefetch_stats())
+    return dict(stats)
+
+
+def get_token_span(indexed_dataset, start_index, end_index):
+    """Tokens of sentences [start_index, end_index) as one flat array."""
+    if hasattr(indexed_dataset, 'get_span'):
+        return indexed_dataset.get_span(start_index, end_index)
+    if end_index <= start_index:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([indexed_dataset[index]
+                           for index in range(start_index, end_index)])
+
+
+def flatten_tokens(sample):
+    """Flatten a sample into a 1-D numpy array.
+
+    A sample is either a flat token sequence (list, numpy array or tensor)
+    or a list of sentences, each of which is a token sequence.
+    """
+    if isinstance(sample, torch.Tensor):
+        return sample.numpy()
+    if isinstance(sample, np.ndarray):
+        return sample
+    if len(sample) > 0 and isinstance(sample[0], (list, np.ndarray, torch.Tensor)):
+        return np.concatenate([np.asarray(sentence) for sentence in sample])
+    return np.asarray(sample, dtype=np.int64)
 
 
 def build_training_sample(sample, target_seq_length,
@@ -493,7 +751,8 @@ def build_training_sample(sample, target_seq_length,
                           vocab_id_list, vocab_id_to_token_dict,
                           cls_id, sep_id, mask_id, pad_id,
                           masked_lm_prob, np_rng, bos_id=None,
-                          eos_id=None, sentinel_tokens=None):
+                          eos_id=None, sentinel_tokens=None,
+                          compact_attention_mask=False):
     """Build training sample.
 
     Arguments:
@@ -514,6 +773,9 @@ def build_training_sample(sample, target_seq_length,
         bos_id: start of decoder example id
         eos_id: end of generation id
         sentinel_tokens: unique value to be substituted for every replaced span
+        compact_attention_mask: If set, do not build the attention masks.
+            They can be rebuilt from the padded tokens with
+            `megatron.utils.get_t5_attention_masks`.
     """
 
     assert target_seq_length <= max_seq_length
@@ -538,8 +800,11 @@ def build_training_sample(sample, target_seq_length,
     dec_mask, enc_dec_mask, loss_mask \
         = pad_and_convert_to_numpy(tokens, masked_positions,
                                    masked_labels, pad_id, max_seq_length,
-                                   max_seq_length_dec, masked_spans,
-                                   bos_id, eos_id, sentinel_tokens)
+                                   max_seq_length_dec,
+                                   masked_spans=masked_spans, bos_id=bos_id,
+                                   eos_id=eos_id,
+                                   sentinel_tokens=sentinel_tokens,
+                                   compact_attention_mask=compact_attention_mask)
 
     train_sample = {
         'text_enc': tokens_enc,
@@ -547,17 +812,21 @@ def build_training_sample(sample, target_seq_length,
         'labels': labels,
         'loss_mask': loss_mask,
         'truncated': int(truncated),
-        'enc_mask': enc_mask,
-        'dec_mask': dec_mask,
-        'enc_dec_mask': enc_dec_mask,
     }
+    if not compact_attention_mask:
+        train_sample['enc_mask'] = enc_mask
+        train_sample['dec_mask'] = dec_mask
+        train_sample['enc_dec_mask'] = enc_dec_mask
     return train_sample
 
 
 def build_supervised_training_sample(input_sample, target_sample,
                                      max_seq_length, max_seq_length_dec,
                                      pad_id, bos_id=None, eos_id=None,
-                                     sentinel_tokens=None):
+                                     sentinel_tokens=None,
+                                     compact_attention_mask=False,
+                                     enc_segment_ids=None,
+                                     dec_segment_ids=None):
     """Build training sample.
 
     Arguments:
@@ -578,18 +847,16 @@ def build_supervised_training_sample(input_sample, target_sample,
         bos_id: start of decoder example id
         eos_id: end of generation id
         sentinel_tokens: unique value to be substituted for every replaced span
+        compact_attention_mask: If set, do not build the attention masks.
+        enc_segment_ids: Optional segment ids of packed input samples, as
+            returned by `pack_fn`. Tokens of different samples do not attend
+            to each other, and the padded segment ids are returned.
+        dec_segment_ids: Segment ids of packed target samples.
     """
 
-    # flatten sentences into one list
-    if isinstance(input_sample[0], list):
-        input_tokens = [token for sentence in input_sample for token in sentence]
-    else:
-        input_tokens = input_sample
+    input_tokens = flatten_tokens(input_sample)
     if target_sample is not None:
-        if isinstance(target_sample[0], list):
-            target_tokens = [token for sentence in target_sample for token in sentence]
-        else:
-            target_tokens = target_sample
+        target_tokens = flatten_tokens(target_sample)
 
     # Truncate to `max_seq_length`.
     input_max_num_tokens = max_seq_length
@@ -611,18 +878,15 @@ def build_supervised_training_sample(input_sample, target_sample,
             dec_mask,
             enc_dec_mask,
             loss_mask,
-        ) = pad_and_convert_to_numpy(
+        ) = pad_and_convert_to_numpy_supervised(
             input_tokens,
-            [],
-            [],
+            target_tokens,
             pad_id,
             max_seq_length,
             max_seq_length_dec,
-            target_tokens,
-            [],
             bos_id,
             eos_id,
-            sentinel_tokens,
+            compact_attention_mask,
         )
         train_sample = {
             "text_enc": tokens_enc,
@@ -631,10 +895,22 @@ def build_supervised_training_sample(input_sample, target_sample,
             "loss_mask": loss_mask,
             "input_truncated": int(input_truncated),
             "target_truncated": int(target_truncated),
-            "enc_mask": enc_mask,
-            "dec_mask": dec_mask,
-            "enc_dec_mask": enc_dec_mask,
         }
+        if enc_segment_ids is not None:
+            enc_segment_ids, dec_segment_ids = pad_segment_ids_supervised(
+                enc_segment_ids, dec_segment_ids, len(input_tokens),
+                len(target_tokens), max_seq_length, max_seq_length_dec)
+            train_sample["enc_segment_ids"] = enc_segment_ids
+            train_sample["dec_segment_ids"] = dec_segment_ids
+            if not compact_attention_mask:
+                # isolate the packed samples
+                enc_mask *= make_segment_mask(enc_segment_ids, enc_segment_ids)
+                enc_dec_mask *= make_segment_mask(dec_segment_ids, enc_segment_ids)
+                dec_mask *= make_segment_mask(dec_segment_ids, dec_segment_ids)
+        if not compact_attention_mask:
+            train_sample["enc_mask"] = enc_mask
+            train_sample["dec_mask"] = dec_mask
+            train_sample["enc_dec_mask"] = enc_dec_mask
     else:
         # decoder only
         tokens_enc = pad_and_convert_to_numpy_inputs_only(
@@ -643,24 +919,52 @@ def build_supervised_training_sample(input_sample, target_sample,
         train_sample = {
             "text": tokens_enc,
         }
+        if enc_segment_ids is not None:
+            train_sample["segment_ids"] = pad_segment_ids_inputs_only(
+                enc_segment_ids, len(input_tokens), max_seq_length)
     return train_sample
 
 
+def pad_segment_ids_supervised(enc_segment_ids, dec_segment_ids,
+                               num_tokens, num_target_tokens,
+                               max_seq_length, max_seq_length_dec):
+    """Truncate and pad the segment ids of packed samples like the tokens in
+    `pad_and_convert_to_numpy_supervised`. Padding has segment id 0."""
+    enc_segment_ids = np.asarray(enc_segment_ids, dtype=np.int64)
+    dec_segment_ids = np.asarray(dec_segment_ids, dtype=np.int64)
+    padded_enc_segment_ids = np.zeros(max_seq_length, dtype=np.int64)
+    padded_enc_segment_ids[:num_tokens] = enc_segment_ids[:num_tokens]
+    # <bos> belongs to the first sample, the remaining decoder inputs are
+    # the targets shifted by one.
+    padded_dec_segment_ids = np.zeros(max_seq_length_dec, dtype=np.int64)
+    padded_dec_segment_ids[0] = 1
+    padded_dec_segment_ids[1:num_target_tokens + 1] = \
+        dec_segment_ids[:num_target_tokens]
+    return padded_enc_segment_ids, padded_dec_segment_ids
+
+
+def pad_segment_ids_inputs_only(segment_ids, num_tokens, max_seq_length):
+    """Truncate and pad the segment ids of packed samples like the tokens in
+    `pad_and_convert_to_numpy_inputs_only`. The <eos> token belongs to the
+    last sample, padding has segment id 0."""
+    segment_ids = np.asarray(segment_ids, dtype=np.int64)
+    padded_segment_ids = np.zeros(max_seq_length, dtype=np.int64)
+    padded_segment_ids[:num_tokens] = segment_ids[:num_tokens]
+    if 0 < num_tokens < max_seq_length:
+        padded_segment_ids[num_tokens] = padded_segment_ids[num_tokens - 1]
+    return padded_segment_ids
+
+
 def build_unpadded_sample(
     input_sample, max_seq_length, target_sample=None, max_seq_length_dec=None,
 ):
-    # flatten sentences into one list
-    input_tokens = [token for sentence in input_sample for token in sentence]
-    if target_sample is not None:
-        target_tokens = [token for sentence in target_sample for token in sentence]
-
     # Truncate to `max_seq_length`.
     input_max_num_tokens = max_seq_length
-    input_tokens = input_tokens[:input_max_num_tokens]
+    input_tokens = flatten_tokens(input_sample)[:input_max_num_tokens]
 
     if target_sample is not None:
         target_max_num_tokens = max_seq_length_dec - 2
-        target_tokens = target_tokens[:target_max_num_tokens]
+        target_tokens = flatten_tokens(target_sample)[:target_max_num_tokens]
 
     text_enc_key = "text_enc" if target_sample is not None else "text"
     train_sample = {
@@ -673,25 +977,65 @@ def build_unpadded_sample(
 
 def pad_and_convert_to_numpy_inputs_only(tokens, pad_id, max_seq_length, eos_id):
     num_tokens = len(tokens)
-    if len(tokens) < max_seq_length:
-        inputs = tokens + [eos_id]
-        num_tokens += 1
-    else:
-        inputs = tokens
-    # padding mask.
-    padding_length = max_seq_length - num_tokens
-    assert padding_length >= 0
-    filler = [pad_id] * padding_length
-    tokens_enc = np.array(inputs + filler, dtype=np.int64)
+    assert num_tokens <= max_seq_length
+    tokens_enc = np.full(max_seq_length, pad_id, dtype=np.int64)
+    tokens_enc[:num_tokens] = tokens
+    if num_tokens < max_seq_length:
+        tokens_enc[num_tokens] = eos_id
     return tokens_enc
 
+
+def pad_and_convert_to_numpy_supervised(tokens, decoder_tokens, pad_id,
+                                        max_seq_length, max_seq_length_dec,
+                                        bos_id, eos_id,
+                                        compact_attention_mask=False):
+    """Pad supervised input and target token arrays and convert them to
+    numpy. Equivalent to `pad_and_convert_to_numpy` without masked spans.
+    The attention masks are None if `compact_attention_mask` is set."""
+    num_tokens = len(tokens)
+    assert num_tokens <= max_seq_length
+    tokens_enc = np.full(max_seq_length, pad_id, dtype=np.int64)
+    tokens_enc[:num_tokens] = tokens
+
+    # Decoder input is <bos> + target, decoder output is target + <eos>.
+    num_target_tokens = len(decoder_tokens)
+    num_tokens_dec = num_target_tokens + 1
+    assert num_tokens_dec <= max_seq_length_dec
+    tokens_dec_in = np.full(max_seq_length_dec, pad_id, dtype=np.int64)
+    tokens_dec_in[0] = bos_id
+    tokens_dec_in[1:num_tokens_dec] = decoder_tokens
+
+    # Labels mask.
+    labels = np.full(max_seq_length_dec, -1, dtype=np.int64)
+    labels[:num_target_tokens] = decoder_tokens
+    labels[num_target_tokens] = eos_id
+
+    # Loss mask
+    loss_mask = np.zeros(max_seq_length_dec, dtype=np.int64)
+    loss_mask[:num_tokens_dec] = 1
+
+    # Create attention masks
+    if compact_attention_mask:
+        enc_mask = dec_mask = enc_dec_mask = None
+    else:
+        enc_mask = make_attention_mask(tokens_enc, tokens_enc)
+        enc_dec_mask = make_attention_mask(tokens_dec_in, tokens_enc)
+        dec_mask = make_attention_mask(tokens_dec_in, tokens_dec_in)
+        dec_mask = dec_mask * make_history_mask(tokens_dec_in)
+
+    return tokens_enc, tokens_dec_in, labels, enc_mask, \
+           dec_mask, enc_dec_mask, loss_mask
+
+
 def pad_and_convert_to_numpy(tokens, masked_positions,
                              masked_labels, pad_id,
                              max_seq_length, max_seq_length_dec,
                              decoder_tokens=None,
                              masked_spans=None, bos_id=None,
-                             eos_id=None, sentinel_tokens=None):
-    """Pad sequences and convert them to numpy."""
+                             eos_id=None, sentinel_tokens=None,
+                             compact_attention_mask=False):
+    """Pad sequences and convert them to numpy. The attention masks are
+    None if `compact_attention_mask` is set."""
 
     sentinel_tokens = collections.deque(sentinel_tokens)
     t5_input = []
@@ -748,10 +1092,13 @@ def pad_and_convert_to_numpy(tokens, masked_positions,
     tokens_dec_in = np.array(t5_decoder_in + filler_dec, dtype=np.int64)
 
     # Create attention masks
-    enc_mask = make_attention_mask(tokens_enc, tokens_enc)
-    enc_dec_mask = make_attention_mask(tokens_dec_in, tokens_enc)
-    dec_mask = make_attention_mask(tokens_dec_in, tokens_dec_in)
-    dec_mask = dec_mask * make_history_mask(tokens_dec_in)
+    if compact_attention_mask:
+        enc_mask = dec_mask = enc_dec_mask = None
+    else:
+        enc_mask = make_attention_mask(tokens_enc, tokens_enc)
+        enc_dec_mask = make_attention_mask(tokens_dec_in, tokens_enc)
+        dec_mask = make_attention_mask(tokens_dec_in, tokens_dec_in)
+        dec_mask = dec_mask * make_history_mask(tokens_dec_in)
 
     # Labels mask.
     labels = t5_decoder_out + ([-1] * padding_length_dec)
@@ -789,6 +1136,19 @@ def make_attention_mask_3d(source_block, target_block):
     return mask
 
 
+def make_segment_mask(source_segment_ids, target_segment_ids):
+    """
+    Returns a 2-dimensional (2-D) mask that only allows attention between
+    tokens of the same packed sample
+    :param source_segment_ids: 1-D array
+    :param target_segment_ids: 1-D array
+    """
+    mask = source_segment_ids[:, None] == target_segment_ids[None, :]
+    mask = mask.astype(np.int64)
+    # (source_length, target_length)
+    return mask
+
+
 def make_history_mask(block):
     length = block.shape[0]
     arange = np.arange(length)
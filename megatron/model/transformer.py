@@ -212,9 +212,15 @@ class CoreAttention(MegatronModule):
             coeff = self.layer_number
             self.norm_factor *= coeff
 
+        # The fused causal softmax ignores the attention mask. Packed
+        # samples are isolated by the mask, so use the masked softmax.
+        softmax_mask_type = self.attn_mask_type
+        if args.isolate_packed_samples:
+            softmax_mask_type = AttnMaskType.padding
+
         self.scale_mask_softmax = FusedScaleMaskSoftmax(
             self.fp16, self.bf16,
-            self.attn_mask_type,
+            softmax_mask_type,
             args.masked_softmax_fusion,
             attention_mask_func,
             self.attention_softmax_in_fp32,
@@ -335,19 +341,24 @@ class FlashSelfAttention(torch.nn.Module):
         self.softmax_scale = softmax_scale
         self.dropout_p = attention_dropout
 
-    def forward(self, q, k, v):
+    def forward(self, q, k, v, cu_seqlens=None):
         """Implements the multihead softmax attention.
         Arguments
         ---------
             q, k, v: The tensor containing the query, key, and value. (B, S, H, D)
+            cu_seqlens: Optional cumulative lengths of the independent
+                        sequences in the flattened (B * S) tokens, e.g. of
+                        packed samples. Defaults to one sequence per row.
         """
         assert q.dtype in [torch.float16, torch.bfloat16]
         assert q.is_cuda
         batch_size, seqlen = q.shape[0], q.shape[1]
         q, k, v = [rearrange(x, 'b s ... -> (b s) ...') for x in [q, k, v]]
+        # No sequence is longer than a row.
         max_s = seqlen
-        cu_seqlens = torch.arange(0, (batch_size + 1) * seqlen, step=seqlen, dtype=torch.int32,
-                                  device=q.device)
+        if cu_seqlens is None:
+            cu_seqlens = torch.arange(0, (batch_size + 1) * seqlen, step=seqlen, dtype=torch.int32,
+                                      device=q.device)
         output = flash_attn_unpadded_func(
             q, k, v, cu_seqlens, cu_seqlens, max_s, max_s,
             self.dropout_p if self.training else 0.0,
@@ -477,7 +488,7 @@ class ParallelAttention(MegatronModule):
             device=torch.cuda.current_device())
 
     def forward(self, hidden_states, attention_mask,
-                encoder_output=None, inference_params=None):
+                encoder_output=None, inference_params=None, cu_seqlens=None):
         # hidden_states: [sq, b, h]
 
         # =================================================
@@ -574,9 +585,9 @@ class ParallelAttention(MegatronModule):
                        for x in (query_layer, key_layer, value_layer)]
             if not self.sequence_parallel:
                 with tensor_parallel.get_cuda_rng_tracker().fork():
-                    context_layer = self.core_attention_flash(q, k, v)
+                    context_layer = self.core_attention_flash(q, k, v, cu_seqlens)
             else:
-                context_layer = self.core_attention_flash(q, k, v)
+                context_layer = self.core_attention_flash(q, k, v, cu_seqlens)
             context_layer = rearrange(context_layer, 'b s h d -> s b (h d)').contiguous()
 
         # =================
@@ -695,7 +706,7 @@ class ParallelTransformerLayer(MegatronModule):
 
     def forward(self, hidden_states, attention_mask,
                 encoder_output=None, enc_dec_attn_mask=None,
-                inference_params=None):
+                inference_params=None, cu_seqlens=None):
         # hidden_states: [s, b, h]
 
         # Layer norm at the beginning of the transformer layer.
@@ -705,7 +716,8 @@ class ParallelTransformerLayer(MegatronModule):
             self.self_attention(
                 layernorm_output,
                 attention_mask,
-                inference_params=inference_params)
+                inference_params=inference_params,
+                cu_seqlens=cu_seqlens)
 
         # Residual connection.
         if self.apply_residual_connection_post_layernorm:
@@ -820,7 +832,7 @@ class NoopTransformerLayer(MegatronModule):
 
     def forward(self, hidden_states, attention_mask,
                 encoder_output=None, enc_dec_attn_mask=None,
-                inference_params=None):
+                inference_params=None, cu_seqlens=None):
         return hidden_states.clone()
 
 
@@ -1063,7 +1075,8 @@ class ParallelTransformer(MegatronModule):
         return self.layers[layer_number]
 
     def _checkpointed_forward(self, hidden_states, attention_mask,
-                              encoder_output, enc_dec_attn_mask, is_first_microbatch):
+                              encoder_output, enc_dec_attn_mask, is_first_microbatch,
+                              cu_seqlens=None):
         """Forward method with activation checkpointing."""
         def custom(start, end, is_transformer_engine=False):
             def custom_forward(*args, **kwargs):
@@ -1095,7 +1108,8 @@ class ParallelTransformer(MegatronModule):
                     hidden_states = tensor_parallel.checkpoint(
                         custom(l, l + self.recompute_num_layers),
                         self.distribute_saved_activations,
-                        hidden_states, attention_mask, encoder_output, enc_dec_attn_mask)
+                        hidden_states, attention_mask, encoder_output, enc_dec_attn_mask,
+                        None, cu_seqlens)
 
                 l += self.recompute_num_layers
 
@@ -1116,14 +1130,16 @@ class ParallelTransformer(MegatronModule):
                         hidden_states = tensor_parallel.checkpoint(
                             custom(l, l + 1),
                             self.distribute_saved_activations,
-                            hidden_states, attention_mask, encoder_output, enc_dec_attn_mask)
+                            hidden_states, attention_mask, encoder_output, enc_dec_attn_mask,
+                            None, cu_seqlens)
                 else:
                     if self.transformer_impl == 'transformer_engine':
                         hidden_states = custom(l, l + 1, is_transformer_engine=True)(
                             hidden_states, attention_mask, encoder_output, enc_dec_attn_mask)
                     else:
                         hidden_states = custom(l, l + 1)(
-                            hidden_states, attention_mask, encoder_output, enc_dec_attn_mask)
+                            hidden_states, attention_mask, encoder_output, enc_dec_attn_mask,
+                            None, cu_seqlens)
         else:
             raise ValueError("Invalid activation recompute method.")
 
@@ -1141,7 +1157,7 @@ class ParallelTransformer(MegatronModule):
 
     def forward(self, hidden_states, attention_mask,
                 encoder_output=None, enc_dec_attn_mask=None,
-                inference_params=None):
+                inference_params=None, cu_seqlens=None):
         # hidden_states: [s, b, h]
 
         # Checks.
@@ -1199,7 +1215,8 @@ class ParallelTransformer(MegatronModule):
                                                                attention_mask,
                                                                encoder_output,
                                                                enc_dec_attn_mask,
-                                                               is_first_microbatch)
+                                                               is_first_microbatch,
+                                                               cu_seqlens)
                 else:
                     forward_kwargs = {
                         'encoder_output': encoder_output,
@@ -1210,6 +1227,8 @@ class ParallelTransformer(MegatronModule):
                     if self.transformer_impl == 'transformer_engine':
                         forward_kwargs['is_first_microbatch'] = is_first_microbatch
                         forward_kwargs['checkpoint_core_attention'] = self._checkpoint_core_attention()
+                    else:
+                        forward_kwargs['cu_seqlens'] = cu_seqlens
 
                     for index in range(self.num_layers):
                         layer = self._get_layer(index)
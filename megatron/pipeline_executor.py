@@ -1,9 +1,13 @@
+import hashlib
 import os
+import time
+from collections import OrderedDict, defaultdict, deque
 from functools import partial
 
 from dynapipe.pipe.instructions import * # noqa: F403
 from dynapipe.pipe.executor import PipelineExecutor
 
+import numpy as np
 import torch
 import torch.distributed as dist
 from torch.nn.parallel.distributed import DistributedDataParallel as torchDDP
@@ -76,27 +80,209 @@ def with_nvtx_stage_name(stage_name):
         return wrapper
     return decorator
 
+def _recv_size_class(numel):
+    """Round numel up to one of four size classes per power of two, so
+    receive buffers waste at most a quarter of their size."""
+    if numel <= 4096:
+        return 4096
+    step = 1 << ((numel - 1).bit_length() - 3)
+    return -(-numel // step) * step
+
+class RecvBufferPool(object):
+    """Reuses the buffers of received activations and gradients.
+
+    Buffers are flat tensors bucketed by dtype, device and size class, and
+    handed out as views of the requested shape. They are returned by
+    `release` once the backward pass has consumed them. Buffers are
+    allocated with torch.empty, so they come from whichever CUDA allocator
+    is active (including the dynapipe custom allocator).
+
+    Reusing a buffer is stream-safe: NCCL orders a new irecv after the
+    work already queued on the compute stream, which includes the kernels
+    that read the buffer's previous contents.
+    """
+
+    def __init__(self):
+        # (dtype, device, size class) -> free buffers
+        self._free = defaultdict(list)
+        # id(view) -> (view, bucket key, buffer)
+        self._in_use = {}
+        self.hits = 0
+        self.misses = 0
+        self.pool_bytes = 0
+        self.in_use_bytes = 0
+        self.peak_in_use_bytes = 0
+
+    def get(self, shape, dtype, device, requires_grad=False):
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        key = (dtype, device, _recv_size_class(numel))
+        free = self._free[key]
+        if free:
+            buffer = free.pop()
+            self.hits += 1
+        else:
+            buffer = torch.empty(key[2], dtype=dtype, device=device)
+            self.pool_bytes += buffer.numel() * buffer.element_size()
+            self.misses += 1
+        self.in_use_bytes += buffer.numel() * buffer.element_size()
+        self.peak_in_use_bytes = max(self.peak_in_use_bytes, self.in_use_bytes)
+        tensor = buffer[:numel].view(shape).requires_grad_(requires_grad)
+        self._in_use[id(tensor)] = (tensor, key, buffer)
+        return tensor
+
+    def release(self, tensors, in_flight=()):
+        """Return the buffers of tensors that came from the pool. Buffers
+        that alias one of the in_flight tensors (e.g. an encoder activation
+        passed through to the next stage, or a gradient that is still being
+        sent) are kept until release_all."""
+        in_flight = [t.data_ptr() for t in in_flight if t is not None]
+        for tensor in tensors:
+            if tensor is None or id(tensor) not in self._in_use:
+                continue
+            _, key, buffer = self._in_use[id(tensor)]
+            start = buffer.data_ptr()
+            end = start + buffer.numel() * buffer.element_size()
+            if any(start <= ptr < end for ptr in in_flight):
+                continue
+            del self._in_use[id(tensor)]
+            self._free[key].append(buffer)
+            self.in_use_bytes -= buffer.numel() * buffer.element_size()
+
+    def release_all(self):
+        for _, key, buffer in self._in_use.values():
+            self._free[key].append(buffer)
+        self._in_use.clear()
+        self.in_use_bytes = 0
+
+    def clear(self):
+        """Drop all buffers, e.g. before torch.cuda.empty_cache()."""
+        self.release_all()
+        self._free.clear()
+        self.pool_bytes = 0
+        self.peak_in_use_bytes = 0
+
+    def stats(self, reset_peak=False):
+        """Hit rate since creation and peak occupancy (the largest share
+        of the pool in use at once) since the last reset_peak."""
+        requests = self.hits + self.misses
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "in_use_buffers": len(self._in_use),
+            "free_buffers": sum(len(free) for free in self._free.values()),
+            "pool_bytes": self.pool_bytes,
+            "peak_occupancy": self.peak_in_use_bytes / self.pool_bytes
+                              if self.pool_bytes else 0.0,
+        }
+        if reset_peak:
+            self.peak_in_use_bytes = self.in_use_bytes
+        return stats
+
+class _IterationState(object):
+    """Per-iteration state of a MegatronPipelineExecutor. The containers
+    are created once and cleared between iterations."""
+    __slots__ = ("data_iterators", "pending_send_ops", "send_queue",
+                 "pending_recv_ops", "input_tensors", "output_tensors",
+                 "forward_data_store", "comm_groups")
+
+    def __init__(self):
+        # key -> _PendingSend, and the same sends in issue order
+        self.pending_send_ops = {}
+        self.send_queue = deque()
+        self.pending_recv_ops = {}
+        self.input_tensors = {}
+        self.output_tensors = {}
+        self.reset()
+
+    def reset(self, data_iterators=None):
+        self.data_iterators = data_iterators
+        self.pending_send_ops.clear()
+        self.send_queue.clear()
+        self.pending_recv_ops.clear()
+        self.input_tensors.clear()
+        self.output_tensors.clear()
+        # handed to the caller at the end of the iteration, so never reused
+        self.forward_data_store = []
+        # coalesced communication starts of the current execution plan
+        self.comm_groups = None
+
+class SendCompletionStats(object):
+    """How long activations stayed allocated after their send completed.
+
+    Sends are only polled at the head of the completion queue, so the held
+    time of an activation freed from the queue is an upper bound: the time
+    since the send was last seen incomplete (or issued). Activations freed
+    by a send finish instruction are freed right after the wait returns.
+    """
+    __slots__ = ("freed", "freed_at_finish", "held_seconds", "max_held_seconds")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.freed = 0
+        self.freed_at_finish = 0
+        self.held_seconds = 0.0
+        self.max_held_seconds = 0.0
+
+    def record(self, held_seconds, at_finish):
+        self.freed += 1
+        self.freed_at_finish += int(at_finish)
+        self.held_seconds += held_seconds
+        self.max_held_seconds = max(self.max_held_seconds, held_seconds)
+
+class _PendingSend(object):
+    """The ops of one send instruction. on_complete (if any) runs once when
+    they have all completed."""
+    __slots__ = ("key", "ops", "on_complete", "last_pending_time", "done")
+
+    def __init__(self, key, ops, on_complete):
+        self.key = key
+        self.ops = ops
+        self.on_complete = on_complete
+        self.last_pending_time = time.monotonic()
+        self.done = False
+
+def _free_output_tensors(state, output_key):
+    for (output_tensor, free) in state.output_tensors[output_key]:
+        if free:
+            deallocate_output_tensor(output_tensor)
+
+def _track_send(exec: PipelineExecutor, key, ops, on_complete=None):
+    pending = _PendingSend(key, ops, on_complete)
+    exec.state.pending_send_ops[key] = pending
+    exec.state.send_queue.append(pending)
+
+def _complete_send(exec: PipelineExecutor, pending, held_seconds, at_finish):
+    pending.done = True
+    if exec.state.pending_send_ops.get(pending.key) is pending:
+        del exec.state.pending_send_ops[pending.key]
+    if pending.on_complete is not None:
+        pending.on_complete()
+        exec.send_stats.record(held_seconds, at_finish)
+
+def _drain_send_queue(exec: PipelineExecutor):
+    """Complete sends in issue order, stopping at the first one that is
+    still in flight."""
+    queue = exec.state.send_queue
+    while queue:
+        pending = queue[0]
+        if not pending.done:
+            if not all(op.is_completed() for op in pending.ops):
+                pending.last_pending_time = time.monotonic()
+                return
+            _complete_send(exec, pending,
+                           time.monotonic() - pending.last_pending_time,
+                           at_finish=False)
+        queue.popleft()
+
 def with_check_send_finish_and_free_buffers(func):
     def check_and_free_wrapper(exec: PipelineExecutor, instr: PipeInstruction):
-        if not hasattr(exec, "pending_send_ops"):
-            exec.pending_send_ops = {}
-            return func(exec, instr)
-        for key, ops in exec.pending_send_ops.items():
-            remaining_ops = []
-            for op in ops:
-                if not op.is_completed():
-                    remaining_ops.append(op)
-                else:
-                    # free output buffer for send activation
-                    (microbatch, stage, instr_key) = key
-                    if instr_key == "act":
-                        # free output tensor if needed
-                        output_key = (microbatch, stage)
-                        output_tensors = exec.output_tensors[output_key]
-                        for (output_tensor, free) in output_tensors:
-                            if free:
-                                deallocate_output_tensor(output_tensor)
-            exec.pending_send_ops[key] = remaining_ops
+        if exec.state.send_queue:
+            _drain_send_queue(exec)
         return func(exec, instr)
     return check_and_free_wrapper
 
@@ -130,7 +316,7 @@ def _handle_load_input(exec: PipelineExecutor, instr: LoadInput):
 #             exec.buffer_slots[buffer_id] = tensor 
 #     return _handle_load_input
 
-def _create_forward_handler(forward_step_func, data_iterators, models):
+def _create_forward_handler(forward_step_func, models):
     args = get_args()
     timers = get_timers()
     fwd_bwd_timers = timers if args.timing_log_level > 1 else None
@@ -146,20 +332,13 @@ def _create_forward_handler(forward_step_func, data_iterators, models):
             # needs to call set_virtual_pipeline_model_parallel_rank before
             # forward and backward
             # first get the current model chunk id from the instruction
-            if not hasattr(exec, "_rev_chunk_index"):
-                exec._rev_chunk_index = {}
-                n_assigned_chunks = len(exec.execution_plan.assigned_stages)
-                for i, chunk in enumerate(exec.execution_plan.assigned_stages):
-                    if i >= n_assigned_chunks // 2:
-                        # backward chunk
-                        i = n_assigned_chunks - i - 1
-                    exec._rev_chunk_index[chunk] = i
-            chunk_id = exec._rev_chunk_index[instr.stage]
+            chunk_id = exec.get_chunk_id(instr.stage)
             model = models[chunk_id]
-            data_iterator = data_iterators[chunk_id]
+            data_iterator = exec.state.data_iterators[chunk_id]
             mpu.set_virtual_pipeline_model_parallel_rank(chunk_id)
         else:
             model = models[0]
+            data_iterators = exec.state.data_iterators
             if isinstance(data_iterators, list):
                 data_iterator = data_iterators[0]
             else:
@@ -179,21 +358,15 @@ def _create_forward_handler(forward_step_func, data_iterators, models):
         if len(input_tensor) == 0:
             # no input tensor, load from dataloader
             input_tensor = None
-        # create a bunch of local stores
-        if not hasattr(exec, "input_tensors"):
-            exec.input_tensors = {}
-        if not hasattr(exec, "output_tensors"):
-            exec.output_tensors = {}
+        state = exec.state
         key = (instr.microbatch, instr.stage)
-        exec.input_tensors[key] = input_tensor
-        if not hasattr(exec, "forward_data_store"):
-            exec.forward_data_store = []
-        outputs = forward_step(forward_step_func, data_iterator, model, input_tensor, exec.forward_data_store, fwd_bwd_timers, collect_non_loss_data=False)
+        state.input_tensors[key] = input_tensor
+        outputs = forward_step(forward_step_func, data_iterator, model, input_tensor, state.forward_data_store, fwd_bwd_timers, collect_non_loss_data=False)
         # output_tensors saves the output tensor and a flag indicating
         # whether the tensor should be freed after communication
         # the order of output_tensors follows Megatron-LM
         if isinstance(outputs, list):
-            exec.output_tensors[key] = list(zip(outputs, [True, False] if len(outputs) == 2 else [True]))
+            state.output_tensors[key] = list(zip(outputs, [True, False] if len(outputs) == 2 else [True]))
             if len(outputs) == 2:
                 # decoder stage, first output is decoder output, second is
                 # encoder activation. We need to swap them to match dynapipe's
@@ -201,7 +374,7 @@ def _create_forward_handler(forward_step_func, data_iterators, models):
                 new_outputs = [outputs[1], outputs[0]]
                 outputs = new_outputs
         else:
-            exec.output_tensors[key] = [(outputs, True)]
+            state.output_tensors[key] = [(outputs, True)]
 
         if not isinstance(outputs, list):
             outputs = [outputs]
@@ -223,25 +396,22 @@ def _create_backward_handler(optimizer, model=None):
     @with_check_send_finish_and_free_buffers
     def _handle_backward(exec: PipelineExecutor, instr: BackwardPass):
         if args.virtual_pipeline_model_parallel_size is not None:
-            assert hasattr(exec, "_rev_chunk_index")
-            chunk_id = exec._rev_chunk_index[instr.stage]
+            chunk_id = exec.get_chunk_id(instr.stage)
             mpu.set_virtual_pipeline_model_parallel_rank(chunk_id)
             ds_model = None
         elif model is not None:
             assert len(model) == 1
             ds_model = model[0]
-        assert hasattr(exec, "input_tensors")
-        assert hasattr(exec, "output_tensors")
+        state = exec.state
         if ds_model and args.deepspeed:
             ds_model.set_gradient_accumulation_boundary(exec.is_last_micro_batch)
         buffer_ids = instr.buffer_ids
         key = (instr.microbatch, exec.execution_plan.nstages - 1 - instr.stage)
-        input_tensor = exec.input_tensors[key]
-        exec.input_tensors[key] = None
-        output_tensor, _ = zip(*exec.output_tensors[key])
+        input_tensor = state.input_tensors.pop(key)
+        output_tensor, _ = zip(*state.output_tensors.pop(key))
         output_tensor = list(output_tensor)
-        exec.output_tensors[key] = None
         output_tensor_grad = [exec.buffer_slots[buffer_id] for buffer_id in buffer_ids if exec.buffer_slots[buffer_id] is not None]
+        received_tensors = output_tensor_grad + (input_tensor or [])
         # on first backward stage, output_tensor_grad should be None
         if instr.stage == exec.execution_plan.nstages // 2:
             output_tensor_grad = [None, None]
@@ -255,6 +425,10 @@ def _create_backward_handler(optimizer, model=None):
                             output_tensor_grad, fwd_bwd_timers, ds_model=ds_model)
         if not isinstance(input_tensor_grad, list):
             input_tensor_grad = [input_tensor_grad]
+        if exec.recv_buffer_pool is not None:
+            # received activations and gradients are consumed now
+            exec.recv_buffer_pool.release(received_tensors,
+                                          in_flight=input_tensor_grad + output_tensor)
         # swap them back
         if len(input_tensor_grad) == 2:
             new_input_tensor_grad = [input_tensor_grad[1], input_tensor_grad[0]]
@@ -277,6 +451,17 @@ _comm_instr_key_map = {
     RecvGradFinish: "grad",
 }
 
+_send_start_types = (SendActivationStart, SendGradStart)
+_comm_start_types = (SendActivationStart, SendGradStart,
+                     RecvActivationStart, RecvGradStart)
+_comm_start_to_finish = {
+    SendActivationStart: SendActivationFinish,
+    SendGradStart: SendGradFinish,
+    RecvActivationStart: RecvActivationFinish,
+    RecvGradStart: RecvGradFinish,
+}
+_comm_finish_types = tuple(_comm_start_to_finish.values())
+
 def _transpose_tensor_shape(tensor_shape):
     # Megatron-LM expect communicated tensors to be
     # (sequence length, microbatch size, hidden size)
@@ -284,8 +469,7 @@ def _transpose_tensor_shape(tensor_shape):
     # (microbatch size, sequence length, hidden size)
     return (tensor_shape[1], tensor_shape[0], tensor_shape[2])
 
-@with_check_send_finish_and_free_buffers
-def _handle_send_start(exec: PipelineExecutor, instr: CommunicationStartInstruction):
+def _create_send_ops(exec: PipelineExecutor, instr: CommunicationStartInstruction):
     output_tensors = [exec.buffer_slots[buffer_id] for buffer_id in instr.buffer_ids if exec.buffer_slots[buffer_id] is not None]
     if not isinstance(output_tensors, list):
         output_tensors = [output_tensors]
@@ -297,54 +481,26 @@ def _handle_send_start(exec: PipelineExecutor, instr: CommunicationStartInstruct
         " Expected {}, got {}".format(len(output_tensors), len(tensor_shapes)))
     output_tensors = output_tensors[:len(tensor_shapes)]
 
-    # p2p_ops = []
-    pending_ops = []
+    p2p_ops = []
     for (output_tensor, tensor_shape) in zip(output_tensors, tensor_shapes):
         if tensor_shape is None:
             continue
-        # dist.send(output_tensor, instr.peer)
-        # instead directly using isend, we use batch_isend_irecv so
-        # all communication ops are launched on a single stream.
-        # p2p_op = dist.P2POp(dist.isend, output_tensor, instr.peer)
-        # p2p_ops.append(p2p_op)
         peer_rank = mpu.get_global_rank_from_pipeline_rank(instr.peer)
-        op = dist.isend(output_tensor, peer_rank, group=mpu.get_pipeline_model_parallel_group())
-        pending_ops.append(op)
-    # pending_ops = dist.batch_isend_irecv(p2p_ops)
-    key = (instr.microbatch, instr.stage, _comm_instr_key_map[instr.__class__])
-    if not hasattr(exec, "pending_send_ops"):
-        exec.pending_send_ops = {}
-    exec.pending_send_ops[key] = pending_ops
-    # for op in pending_ops:
-    #     op.wait()
-    # torch.cuda.synchronize()
+        p2p_ops.append(dist.P2POp(dist.isend, output_tensor, peer_rank,
+                                  mpu.get_pipeline_model_parallel_group()))
+    return p2p_ops
 
 def _handle_send_finish(exec: PipelineExecutor, instr: CommunicationFinishInsturction):
-    # pass
     key = (instr.microbatch, instr.stage, _comm_instr_key_map[instr.__class__])
-    pending_ops = exec.pending_send_ops[key]
-    if not pending_ops:
-        return False
-    exec.pending_send_ops[key] = []
-    for op in pending_ops:
-        op.wait()
-    return True
-
-@with_nvtx_stage_name("send_forward_finish")
-def _handle_send_forward_finish(exec: PipelineExecutor, instr: CommunicationFinishInsturction):
-    # wait
-    needs_freeing = _handle_send_finish(exec, instr)
-    if not needs_freeing:
+    pending = exec.state.pending_send_ops.get(key)
+    if pending is None:
+        # already completed (and its outputs freed) from the send queue
         return
-    # free output tensor if needed
-    output_key = (instr.microbatch, instr.stage)
-    output_tensors = exec.output_tensors[output_key]
-    for (output_tensor, free) in output_tensors:
-        if free:
-            deallocate_output_tensor(output_tensor)
+    for op in pending.ops:
+        op.wait()
+    _complete_send(exec, pending, 0.0, at_finish=True)
 
-@with_check_send_finish_and_free_buffers
-def _handle_recv_start(exec: PipelineExecutor, instr: CommunicationStartInstruction):
+def _create_recv_ops(exec: PipelineExecutor, instr: CommunicationStartInstruction):
     args=get_args()
     dtype = args.params_dtype
     if args.fp32_residual_connection:
@@ -353,61 +509,293 @@ def _handle_recv_start(exec: PipelineExecutor, instr: CommunicationStartInstruct
     tensor_shapes = instr.buffer_shapes
     # transpose tensor shapes
     tensor_shapes = [_transpose_tensor_shape(s) for s in tensor_shapes]
-    input_tensors = [torch.empty(tensor_shape, dtype=dtype, requires_grad=requires_grad, device=torch.cuda.current_device()) for tensor_shape in tensor_shapes]
+    device = torch.cuda.current_device()
+    pool = exec.recv_buffer_pool
+    if pool is not None:
+        input_tensors = [pool.get(tensor_shape, dtype, device, requires_grad=requires_grad) for tensor_shape in tensor_shapes]
+    else:
+        input_tensors = [torch.empty(tensor_shape, dtype=dtype, requires_grad=requires_grad, device=device) for tensor_shape in tensor_shapes]
 
-    # p2p_ops = []
-    pending_ops = []
+    p2p_ops = []
     for (input_tensor, tensor_shape) in zip(input_tensors, tensor_shapes):
         if tensor_shape is None:
             continue
-        # dist.recv(input_tensor, instr.peer)
-        # p2p_op = dist.P2POp(dist.irecv, input_tensor, instr.peer)
-        # p2p_ops.append(p2p_op)
         peer_rank = mpu.get_global_rank_from_pipeline_rank(instr.peer)
-        op = dist.irecv(input_tensor, peer_rank, mpu.get_pipeline_model_parallel_group())
-        pending_ops.append(op)
-    # pending_ops = dist.batch_isend_irecv(p2p_ops)
-    key = (instr.microbatch, instr.stage, _comm_instr_key_map[instr.__class__])
-    if not hasattr(exec, "pending_recv_ops"):
-        exec.pending_recv_ops = {}
-    exec.pending_recv_ops[key] = pending_ops
-    # for op in pending_ops:
-    #     op.wait()
-    # torch.cuda.synchronize()
+        p2p_ops.append(dist.P2POp(dist.irecv, input_tensor, peer_rank,
+                                  mpu.get_pipeline_model_parallel_group()))
     # add the input tensors to the buffer slots
     for buffer_id, input_tensor in zip(instr.buffer_ids, input_tensors):
         exec.buffer_slots[buffer_id] = input_tensor
+    return p2p_ops
+
+def _coalesce_comm_starts(instructions):
+    """Group adjacent communication start instructions that can be launched
+    together by one batch_isend_irecv.
+
+    A coalesced group completes as a whole, so waiting for any of its
+    instructions waits for all of them. An instruction only joins a group
+    if the finish instructions of the group stay adjacent (no other kind
+    of instruction between them), so no finish waits for an op that the
+    peer can only match after this rank has done more work.
+
+    Returns {index of the first instruction: indices of the group}.
+    """
+    finish_index = {}
+    for i, instr in enumerate(instructions):
+        if isinstance(instr, _comm_finish_types):
+            finish_index[(type(instr), instr.microbatch, instr.stage)] = i
+
+    def get_finish_index(i):
+        instr = instructions[i]
+        return finish_index.get(
+            (_comm_start_to_finish[type(instr)], instr.microbatch, instr.stage))
+
+    groups = {}
+    i = 0
+    while i < len(instructions):
+        if not isinstance(instructions[i], _comm_start_types):
+            i += 1
+            continue
+        group = [i]
+        finishes = [get_finish_index(i)]
+        j = i + 1
+        while j < len(instructions) and \
+                isinstance(instructions[j], _comm_start_types):
+            finish = get_finish_index(j)
+            if finish is None or None in finishes:
+                break
+            first = min(finishes + [finish])
+            last = max(finishes + [finish])
+            if not all(isinstance(instructions[k], _comm_finish_types)
+                       for k in range(first, last + 1)):
+                break
+            group.append(j)
+            finishes.append(finish)
+            j += 1
+        groups[i] = group
+        i = j
+    return groups
+
+class _SharedWork(object):
+    """A work of a coalesced batch_isend_irecv, shared by the keys of all
+    instructions in the group. Waiting is idempotent, since some backends
+    (e.g. gloo) cannot wait for the same receive twice."""
+    __slots__ = ("_work", "_done")
+
+    def __init__(self, work):
+        self._work = work
+        self._done = False
+
+    def wait(self):
+        if not self._done:
+            self._work.wait()
+            self._done = True
+
+    def is_completed(self):
+        return self._done or self._work.is_completed()
+
+def _launch_comm_starts(exec: PipelineExecutor, instrs, batched):
+    """Launch the ops of communication start instructions, either one
+    isend/irecv per tensor or all of them in a single batch_isend_irecv,
+    and record the pending ops under each instruction's key."""
+    state = exec.state
+    p2p_ops = []
+    for instr in instrs:
+        if isinstance(instr, _send_start_types):
+            p2p_ops.append(_create_send_ops(exec, instr))
+        else:
+            p2p_ops.append(_create_recv_ops(exec, instr))
+    if batched:
+        all_ops = [op for instr_ops in p2p_ops for op in instr_ops]
+        works = dist.batch_isend_irecv(all_ops) if all_ops else []
+        works = [_SharedWork(work) for work in works]
+        pending_ops = [list(works) for _ in instrs]
+    else:
+        pending_ops = [[op.op(op.tensor, op.peer, op.group, op.tag)
+                        for op in instr_ops] for instr_ops in p2p_ops]
+    for instr, ops in zip(instrs, pending_ops):
+        key = (instr.microbatch, instr.stage, _comm_instr_key_map[instr.__class__])
+        if isinstance(instr, _send_start_types):
+            on_complete = None
+            if key[2] == "act":
+                # free the sent activations once the send completes
+                on_complete = partial(_free_output_tensors, state,
+                                      (instr.microbatch, instr.stage))
+            _track_send(exec, key, ops, on_complete)
+        else:
+            state.pending_recv_ops[key] = ops
+
+@with_check_send_finish_and_free_buffers
+def _handle_comm_start(exec: PipelineExecutor, instr: CommunicationStartInstruction):
+    if not exec.batch_p2p:
+        _launch_comm_starts(exec, [instr], batched=False)
+        return
+    state = exec.state
+    instructions = exec.execution_plan.instructions
+    assert instructions[exec.instr_index] is instr, \
+        "instr_index does not point at the executing instruction"
+    if state.comm_groups is None:
+        state.comm_groups = _coalesce_comm_starts(instructions)
+    group = state.comm_groups.get(exec.instr_index)
+    if group is None:
+        # already launched with an earlier instruction of its group
+        return
+    _launch_comm_starts(exec, [instructions[i] for i in group], batched=True)
 
 def _handle_recv_finish(exec: PipelineExecutor, instr: CommunicationFinishInsturction):
     # pass
     key = (instr.microbatch, instr.stage, _comm_instr_key_map[instr.__class__])
-    pending_ops = exec.pending_recv_ops[key]
-    exec.pending_recv_ops[key] = []
+    pending_ops = exec.state.pending_recv_ops.pop(key)
     for op in pending_ops:
         op.wait()
 
-def get_pipeline_executor(forward_step_func, data_iterator, model, optimizer):
-    executor = PipelineExecutor(dp_rank=mpu.get_data_parallel_rank(),
-                                pp_rank=mpu.get_pipeline_model_parallel_rank())
-    # register handlers
-    executor.register_handler(LoadInput, _handle_load_input)
-    executor.register_handler(ForwardPass, _create_forward_handler(forward_step_func, data_iterator, model))
-    executor.register_handler(BackwardPass, _create_backward_handler(optimizer, model=model))
-    # comm handlers
-    executor.register_handler(SendActivationStart, with_nvtx_stage_name("send_forward_start")(_handle_send_start))
-    executor.register_handler(SendGradStart, with_nvtx_stage_name("send_backward_start")(_handle_send_start))
-    executor.register_handler(RecvActivationStart, with_nvtx_stage_name("recv_forward_start")(_handle_recv_start))
-    executor.register_handler(RecvGradStart, with_nvtx_stage_name("recv_backward_start")(_handle_recv_start))
-    executor.register_handler(SendActivationFinish, _handle_send_forward_finish)
-    executor.register_handler(SendGradFinish, with_nvtx_stage_name("send_backward_finish")(_handle_send_finish))
-    executor.register_handler(RecvActivationFinish, with_nvtx_stage_name("recv_forward_finish")(_handle_recv_finish))
-    executor.register_handler(RecvGradFinish, with_nvtx_stage_name("recv_backward_finish")(_handle_recv_finish))
-    executor.check_all_handlers_registered()
-    return executor
-
-
-
-
-
-
-
+class MegatronPipelineExecutor(PipelineExecutor):
+    """A PipelineExecutor that is created once and reused across iterations.
+
+    The handlers are registered and checked in the constructor. The state
+    of an iteration lives in `state` and is reset by `run` before and after
+    each execution plan, so no tensors are kept alive between iterations.
+    """
+
+    def __init__(self, forward_step_func, model, optimizer, dp_rank=None,
+                 pp_rank=None, recv_buffer_pool=None, batch_p2p=False):
+        super().__init__(dp_rank=dp_rank, pp_rank=pp_rank)
+        self.state = _IterationState()
+        self.recv_buffer_pool = recv_buffer_pool
+        self.send_stats = SendCompletionStats()
+        # launch adjacent communication starts with one batch_isend_irecv
+        self.batch_p2p = batch_p2p
+        # assigned stages -> {stage: model chunk id}
+        self._chunk_indices = {}
+        # register handlers
+        self.register_handler(LoadInput, _handle_load_input)
+        self.register_handler(ForwardPass, _create_forward_handler(forward_step_func, model))
+        self.register_handler(BackwardPass, _create_backward_handler(optimizer, model=model))
+        # comm handlers
+        self.register_handler(SendActivationStart, with_nvtx_stage_name("send_forward_start")(_handle_comm_start))
+        self.register_handler(SendGradStart, with_nvtx_stage_name("send_backward_start")(_handle_comm_start))
+        self.register_handler(RecvActivationStart, with_nvtx_stage_name("recv_forward_start")(_handle_comm_start))
+        self.register_handler(RecvGradStart, with_nvtx_stage_name("recv_backward_start")(_handle_comm_start))
+        self.register_handler(SendActivationFinish, with_nvtx_stage_name("send_forward_finish")(_handle_send_finish))
+        self.register_handler(SendGradFinish, with_nvtx_stage_name("send_backward_finish")(_handle_send_finish))
+        self.register_handler(RecvActivationFinish, with_nvtx_stage_name("recv_forward_finish")(_handle_recv_finish))
+        self.register_handler(RecvGradFinish, with_nvtx_stage_name("recv_backward_finish")(_handle_recv_finish))
+        self.check_all_handlers_registered()
+
+    def get_chunk_id(self, stage):
+        """Model chunk executing the given stage in the interleaved schedule."""
+        assigned_stages = tuple(self.execution_plan.assigned_stages)
+        chunk_index = self._chunk_indices.get(assigned_stages)
+        if chunk_index is None:
+            chunk_index = {}
+            n_assigned_chunks = len(assigned_stages)
+            for i, chunk in enumerate(assigned_stages):
+                if i >= n_assigned_chunks // 2:
+                    # backward chunk
+                    i = n_assigned_chunks - i - 1
+                chunk_index[chunk] = i
+            self._chunk_indices[assigned_stages] = chunk_index
+        return chunk_index[stage]
+
+    def reset(self, data_iterators=None):
+        """Drop the state and buffers of the previous iteration."""
+        self.state.reset(data_iterators)
+        if self.recv_buffer_pool is not None:
+            self.recv_buffer_pool.release_all()
+        if self.buffer_slots:
+            self.buffer_slots = [None] * len(self.buffer_slots)
+
+    def run(self, execution_plan, data_iterators, iteration=None):
+        """Execute one iteration's plan, reading microbatches from
+        data_iterators. Returns the forward data store (the losses)."""
+        self.reset(data_iterators)
+        self.execute(execution_plan, iteration)
+        forward_data_store = self.state.forward_data_store
+        self.reset()
+        return forward_data_store
+
+def get_pipeline_executor(forward_step_func, model, optimizer):
+    args = get_args()
+    recv_buffer_pool = RecvBufferPool() if args.dynapipe_recv_buffer_pool else None
+    return MegatronPipelineExecutor(forward_step_func, model, optimizer,
+                                    dp_rank=mpu.get_data_parallel_rank(),
+                                    pp_rank=mpu.get_pipeline_model_parallel_rank(),
+                                    recv_buffer_pool=recv_buffer_pool,
+                                    batch_p2p=args.dynapipe_batch_p2p)
+
+
+class ExecutionPlanBroadcaster(object):
+    """Broadcasts the execution plan from the source rank of a tensor
+    parallel group to the other ranks, on the CPU over a gloo group.
+
+    Every rank keeps the last cache_size plans, keyed by the digest of
+    their serialized bytes. All ranks see the same sequence of digests, so
+    their caches stay in sync: when the source finds a plan in its cache,
+    only the digest is sent and the other ranks reuse the plan they
+    deserialized before.
+    """
+
+    def __init__(self, group, src_rank, cache_size=64):
+        self.group = group
+        self.src_rank = src_rank
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, digest):
+        plan = self._cache.get(digest)
+        if plan is not None:
+            self._cache.move_to_end(digest)
+            self.hits += 1
+        else:
+            self.misses += 1
+        return plan
+
+    def _insert(self, digest, plan):
+        if self.cache_size <= 0:
+            return
+        self._cache[digest] = plan
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def broadcast(self, execution_plan=None):
+        """Returns the source rank's execution_plan on every rank."""
+        # header: payload size, cached flag, 16-byte digest as two int64s
+        header = torch.empty(4, dtype=torch.int64)
+        if dist.get_rank() == self.src_rank:
+            assert execution_plan is not None
+            ep_bytes = execution_plan.serialize()
+            digest = hashlib.blake2b(ep_bytes, digest_size=16).digest()
+            cached = self._lookup(digest) is not None
+            if not cached:
+                self._insert(digest, execution_plan)
+            header[0] = len(ep_bytes)
+            header[1] = int(cached)
+            header[2:] = torch.from_numpy(np.frombuffer(digest, dtype=np.int64).copy())
+            dist.broadcast(header, self.src_rank, group=self.group)
+            if not cached:
+                ep_tensor = torch.frombuffer(bytearray(ep_bytes), dtype=torch.uint8)
+                dist.broadcast(ep_tensor, self.src_rank, group=self.group)
+            return execution_plan
+        dist.broadcast(header, self.src_rank, group=self.group)
+        size, cached = header[0].item(), header[1].item()
+        digest = header[2:].numpy().tobytes()
+        if cached:
+            execution_plan = self._lookup(digest)
+            assert execution_plan is not None, \
+                "execution plan cache out of sync with rank {}".format(self.src_rank)
+            return execution_plan
+        self.misses += 1
+        ep_tensor = torch.empty(size, dtype=torch.uint8)
+        dist.broadcast(ep_tensor, self.src_rank, group=self.group)
+        execution_plan = ExecutionPlan.deserialize(ep_tensor.numpy().tobytes())
+        self._insert(digest, execution_plan)
+        return execution_plan
+
+
+def get_execution_plan_broadcaster():
+    args = get_args()
+    return ExecutionPlanBroadcaster(mpu.get_tensor_model_parallel_group_gloo(),
+                                    mpu.get_tensor_model_parallel_src_rank(),
+                                    cache_size=args.dynapipe_plan_cache_size)
@@ -9,7 +9,6 @@ import sys
 import time
 # The earliest we can measure the start time.
 _TRAIN_START_TIME = time.time()
-import numpy as np
 import torch
 from torch.nn.parallel.distributed import DistributedDataParallel as torchDDP
 
@@ -38,6 +37,7 @@ from megatron.model import DistributedDataParallel as LocalDDP
 from megatron.utils import check_adlr_autoresume_termination
 from megatron.utils import unwrap_model
 from megatron.data.data_samplers import build_pretraining_data_loader
+from megatron.data.data_samplers import get_prefetch_stats
 from megatron.utils import calc_params_l2_norm
 from megatron.schedules import get_forward_backward_func
 from megatron.utils import report_memory
@@ -45,10 +45,9 @@ from megatron.model.vision.knn_monitor import compute_feature_bank
 from megatron.data.t5_dataset import T5UnsupervisedDataset
 from megatron.utils import average_losses_across_data_parallel_group
 
-from .pipeline_executor import get_pipeline_executor
+from .pipeline_executor import get_pipeline_executor, get_execution_plan_broadcaster
 
 from dynapipe.memory_opt.utils import reserve_full_memory
-from dynapipe.pipe.instructions import ExecutionPlan
 
 DEBUG_DUMP_MEMORY_STATS = os.getenv("DYNAPIPE_DEBUG_DUMP_MEMORY_STATS", 'False').lower() in ('true', '1', 't')
 DEBUG_DUMP_MEMORY_PREFIX = os.environ.get('DYNAPIPE_DEBUG_DUMP_MEMORY_PREFIX', None)
@@ -586,8 +585,11 @@ def train_step(forward_step_func, data_iterator,
 
 
 def dynapipe_train_step(data_iterator, forward_step_func,
-                     model, optimizer, opt_param_scheduler):
-    """Single training step."""
+                     model, optimizer, opt_param_scheduler, executor=None,
+                     plan_broadcaster=None):
+    """Single training step. executor is the MegatronPipelineExecutor and
+    plan_broadcaster the ExecutionPlanBroadcaster reused across iterations
+    (new ones are built if None)."""
     args = get_args()
     timers = get_timers()
 
@@ -682,28 +684,14 @@ def dynapipe_train_step(data_iterator, forward_step_func,
             execution_plan = None
     if args.tensor_model_parallel_size > 1:
         # broadcast execution plan across tp groups
-        if mpu.get_tensor_model_parallel_rank() == 0:
-            assert execution_plan is not None
-            execution_plan: ExecutionPlan
-            ep_bytes = execution_plan.serialize()
-            size = torch.LongTensor([len(ep_bytes)]).cuda()
-            torch.distributed.broadcast(size, mpu.get_tensor_model_parallel_src_rank(),
-                                        group=mpu.get_tensor_model_parallel_group())
-            ep_tensor = torch.frombuffer(np.fromstring(ep_bytes, dtype=np.uint8), dtype=torch.uint8).cuda()
-            torch.distributed.broadcast(ep_tensor, mpu.get_tensor_model_parallel_src_rank(),
-                                        group=mpu.get_tensor_model_parallel_group())
-        else:
-            size = torch.LongTensor([0]).cuda()
-            torch.distributed.broadcast(size, mpu.get_tensor_model_parallel_src_rank(),
-                                        group=mpu.get_tensor_model_parallel_group())
-            ep_tensor = torch.zeros(size.cpu().item(), dtype=torch.uint8).cuda()
-            torch.distributed.broadcast(ep_tensor, mpu.get_tensor_model_parallel_src_rank(),
-                                        group=mpu.get_tensor_model_parallel_group())
-            execution_plan = ExecutionPlan.deserialize(ep_tensor.cpu().numpy().tobytes())
+        if plan_broadcaster is None:
+            plan_broadcaster = get_execution_plan_broadcaster()
+        execution_plan = plan_broadcaster.broadcast(execution_plan)
     assert execution_plan is not None
-    executor = get_pipeline_executor(forward_step_func, microbatch_iterator, model, optimizer)
-    executor.execute(execution_plan, args.curr_iteration)
-    losses_reduced = executor.forward_data_store
+    if executor is None:
+        executor = get_pipeline_executor(forward_step_func, model, optimizer)
+    losses_reduced = executor.run(execution_plan, microbatch_iterator,
+                                  args.curr_iteration)
     timers('forward-backward').stop()
 
     loss_reduced = {}
@@ -938,6 +926,14 @@ def training_log(loss_dict, total_loss_dict, learning_rate, iteration,
         total_loss_dict[skipped_iters_key] = 0
         total_loss_dict[nan_iters_key] = 0
         print_rank_last(log_string)
+        if args.mmap_prefetch_lookahead > 0:
+            prefetch_stats = get_prefetch_stats()
+            if prefetch_stats is not None:
+                pages = prefetch_stats['hit_pages'] + prefetch_stats['miss_pages']
+                print_rank_0(' mmap prefetch: {} pages looked up, page cache '
+                             'hit rate {:.1%}, {:.2f} GB advised'.format(
+                                 pages, prefetch_stats['hit_pages'] / max(1, pages),
+                                 prefetch_stats['advised_bytes'] / 1e9))
         if report_memory_flag and learning_rate > 0.:
             # Report memory after optimizer state has been initialized.
             report_memory('(after {} iterations)'.format(iteration))
@@ -1039,6 +1035,15 @@ def dynapipe_train(forward_step_func, model, optimizer, opt_param_scheduler,
     # before training starts, launch an allreduce to init NCCL communicator
     torch.distributed.all_reduce(torch.zeros(1).cuda())
     torch.distributed.all_reduce(torch.zeros(1).cuda(), group=mpu.get_model_parallel_group())
+    if args.dynapipe_batch_p2p:
+        # the first batch_isend_irecv in a group must involve all its ranks,
+        # so run a collective on the pipeline group first
+        torch.distributed.all_reduce(torch.zeros(1).cuda(), group=mpu.get_pipeline_model_parallel_group())
+
+    # handlers are registered once and reused by every iteration
+    executor = get_pipeline_executor(forward_step_func, model, optimizer)
+    plan_broadcaster = get_execution_plan_broadcaster() \
+        if args.tensor_model_parallel_size > 1 else None
 
     if args.debug_dump_memory_trace:
         assert not DEBUG_DUMP_MEMORY_STATS, \
@@ -1079,7 +1084,9 @@ def dynapipe_train(forward_step_func, model, optimizer, opt_param_scheduler,
                         forward_step_func,
                         model,
                         optimizer,
-                        opt_param_scheduler)
+                        opt_param_scheduler,
+                        executor,
+                        plan_broadcaster)
         except StopIteration:
             # run out of data
             break
@@ -1088,7 +1095,26 @@ def dynapipe_train(forward_step_func, model, optimizer, opt_param_scheduler,
                 iteration % args.empty_unused_memory_interval == 0:
             # Empty unused memory.
             logger.info("Emptying cuda cache...")
+            if executor.recv_buffer_pool is not None:
+                executor.recv_buffer_pool.clear()
             torch.cuda.empty_cache()
+        if executor.recv_buffer_pool is not None and \
+                iteration % args.log_interval == 0:
+            stats = executor.recv_buffer_pool.stats(reset_peak=True)
+            logger.info("Receive buffer pool: {:.2f} GB, peak occupancy {:.1%}, "
+                        "hit rate {:.1%} ({} hits, {} misses)".format(
+                            stats["pool_bytes"] / 1e9, stats["peak_occupancy"],
+                            stats["hit_rate"], stats["hits"], stats["misses"]))
+        if args.timing_log_level > 1 and iteration % args.log_interval == 0:
+            send_stats = executor.send_stats
+            if send_stats.freed:
+                logger.info("Sent activations freed: {} ({} at send finish), "
+                            "held after send completion <= {:.3f} ms on "
+                            "average, {:.3f} ms max".format(
+                                send_stats.freed, send_stats.freed_at_finish,
+                                send_stats.held_seconds / send_stats.freed * 1e3,
+                                send_stats.max_held_seconds * 1e3))
+            send_stats.reset()
         if args.profile_with_nsys:
             from dynapipe.utils.logger import logger
             if iteration - orig_iteration == args.nsys_profile_warmup:
@@ -1457,7 +1483,7 @@ def build_train_valid_test_data_iterators(
 
     # Build iterators.
     dl_type = args.dataloader_type
-    assert dl_type in ['single', 'cyclic', 'ordered']
+    assert dl_type in ['single', 'cyclic', 'ordered', 'bucketed']
 
     if train_dataloader is not None:
         train_data_iterator = iter(train_dataloader) if dl_type != 'cyclic' \
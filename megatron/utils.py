@@ -193,6 +193,73 @@ def get_ltor_masks_and_position_ids(data,
     return attention_mask, loss_mask, position_ids
 
 
+def get_t5_attention_masks(tokens_enc, tokens_dec,
+                           enc_segment_ids=None, dec_segment_ids=None):
+    """Build T5 encoder, decoder and encoder-decoder attention masks from
+    padded token ids, on the device of the tokens. Token ids smaller than 1
+    are padding, as in the masks built by the T5 datasets. If segment ids of
+    packed samples are given, tokens only attend within their own sample.
+    Masked positions are True."""
+    enc_valid = tokens_enc >= 1
+    dec_valid = tokens_dec >= 1
+    enc_mask = enc_valid.unsqueeze(2) & enc_valid.unsqueeze(1)
+    enc_dec_mask = dec_valid.unsqueeze(2) & enc_valid.unsqueeze(1)
+    seq_length_dec = tokens_dec.size(1)
+    history_mask = torch.ones((seq_length_dec, seq_length_dec),
+                              dtype=torch.bool,
+                              device=tokens_dec.device).tril_()
+    dec_mask = dec_valid.unsqueeze(2) & dec_valid.unsqueeze(1) & history_mask
+    if enc_segment_ids is not None:
+        enc_mask &= enc_segment_ids.unsqueeze(2) == enc_segment_ids.unsqueeze(1)
+        enc_dec_mask &= \
+            dec_segment_ids.unsqueeze(2) == enc_segment_ids.unsqueeze(1)
+        dec_mask &= dec_segment_ids.unsqueeze(2) == dec_segment_ids.unsqueeze(1)
+    return ~enc_mask, ~dec_mask, ~enc_dec_mask
+
+
+def _get_segment_starts(segment_ids):
+    """True at the first token of every segment of every row."""
+    starts = torch.ones_like(segment_ids, dtype=torch.bool)
+    starts[:, 1:] = segment_ids[:, 1:] != segment_ids[:, :-1]
+    return starts
+
+
+def get_packed_attention_mask(segment_ids, causal=True):
+    """Block-diagonal attention mask [b, 1, s, s] for sequences of packed
+    samples, where `segment_ids` [b, s] numbers the sample of every token.
+    Masked positions are True."""
+    mask = segment_ids.unsqueeze(2) == segment_ids.unsqueeze(1)
+    if causal:
+        seq_length = segment_ids.size(1)
+        mask &= torch.ones((seq_length, seq_length), dtype=torch.bool,
+                           device=segment_ids.device).tril_()
+    return ~mask.unsqueeze(1)
+
+
+def get_packed_position_ids(segment_ids):
+    """Position ids that restart at the first token of every packed
+    sample."""
+    micro_batch_size, seq_length = segment_ids.size()
+    position_ids = torch.arange(seq_length, dtype=torch.long,
+                                device=segment_ids.device)
+    position_ids = position_ids.unsqueeze(0).expand(micro_batch_size, -1)
+    start_positions = torch.where(_get_segment_starts(segment_ids),
+                                  position_ids,
+                                  torch.zeros_like(position_ids))
+    start_positions = torch.cummax(start_positions, dim=1).values
+    return position_ids - start_positions
+
+
+def get_packed_cu_seqlens(segment_ids):
+    """Cumulative sequence lengths of the packed samples of all rows, in the
+    format of the variable length FlashAttention kernels. Padding at the end
+    of a row is treated as one more sample."""
+    starts = _get_segment_starts(segment_ids).view(-1)
+    total = torch.tensor([starts.numel()], dtype=torch.int32,
+                         device=segment_ids.device)
+    return torch.cat([torch.nonzero(starts).view(-1).int(), total])
+
+
 def print_rank_0(message):
     """If distributed is initialized, print only on rank 0."""
     if torch.distributed.is_initialized():
@@ -12,10 +12,13 @@ from megatron.core import tensor_parallel
 # from megatron.data.gpt_dataset import build_train_valid_test_datasets
 
 # for supervised training, we reuse the T5 dataset
+from megatron.data.data_manifest import verify_data_manifest
 from megatron.data.dataset_utils import build_train_valid_test_datasets
 from megatron.model import GPTModel, ModelType
 from megatron.training import pretrain
 from megatron.utils import get_ltor_masks_and_position_ids
+from megatron.utils import get_packed_attention_mask
+from megatron.utils import get_packed_position_ids, get_packed_cu_seqlens
 from megatron.utils import average_losses_across_data_parallel_group
 
 def model_provider(pre_process=True, post_process=True):
@@ -38,6 +41,8 @@ def get_batch(data_iterator):
 
     # Items and their type.
     keys = ['text']
+    if args.isolate_packed_samples:
+        keys.append('segment_ids')
     datatype = torch.int64
 
     # Broadcast data.
@@ -46,7 +51,7 @@ def get_batch(data_iterator):
     else:
         data = None
 
-    if get_args().tensor_model_parallel_size > 1:
+    if args.tensor_model_parallel_size > 1:
         data_b = tensor_parallel.broadcast_data(keys, data, datatype)
     else:
         data_b = {}
@@ -66,7 +71,16 @@ def get_batch(data_iterator):
         args.reset_attention_mask,
         args.eod_mask_loss)
 
-    return tokens, labels, loss_mask, attention_mask, position_ids
+    cu_seqlens = None
+    if args.isolate_packed_samples:
+        # Packed samples only attend within themselves.
+        segment_ids = data_b['segment_ids'].long()[:, :-1].contiguous()
+        attention_mask = get_packed_attention_mask(segment_ids)
+        position_ids = get_packed_position_ids(segment_ids)
+        if args.use_flash_attn:
+            cu_seqlens = get_packed_cu_seqlens(segment_ids)
+
+    return tokens, labels, loss_mask, attention_mask, position_ids, cu_seqlens
 
 def loss_func(loss_mask, output_tensor):
     args = get_args()
@@ -88,12 +102,12 @@ def forward_step(data_iterator, model):
 
     # Get the batch.
     timers('batch-generator', log_level=2).start()
-    tokens, labels, loss_mask, attention_mask, position_ids = get_batch(
-        data_iterator)
+    tokens, labels, loss_mask, attention_mask, position_ids, cu_seqlens = \
+        get_batch(data_iterator)
     timers('batch-generator').stop()
 
     output_tensor = model(tokens, position_ids, attention_mask,
-                          labels=labels)
+                          labels=labels, cu_seqlens=cu_seqlens)
 
     return output_tensor, partial(loss_func, loss_mask)
 
@@ -104,6 +118,11 @@ def train_valid_test_datasets_provider(train_val_test_num_samples):
 
     print_rank_0('> building train, validation, and test datasets '
                  'for GPT ...')
+    if args.data_manifest is not None:
+        # caches were built by tools/prepare_training_data.py
+        verify_data_manifest(args.data_manifest, args, 'gpt',
+                             train_val_test_num_samples)
+        print_rank_0(' > verified data manifest {}'.format(args.data_manifest))
     train_ds, valid_ds, test_ds = build_train_valid_test_datasets(
         data_prefix=args.data_path,
         data_impl=args.data_impl,
@@ -118,8 +137,11 @@ def train_valid_test_datasets_provider(train_val_test_num_samples):
         dataset_type='t5' if args.targets_data_path is None else 't5_supervised',
         num_epochs=args.train_epochs if args.targets_data_path else None,
         sort_samples=args.sort_dataset,
-        pack_samples=args.pack_dataset,
+        pack_samples=args.pack_dataset_strategy if args.pack_dataset else False,
         inputs_only=True,
+        isolate_packed_samples=args.isolate_packed_samples,
+        mapping_build_threads=args.mapping_build_threads,
+        offline_build=args.data_manifest is not None,
         )
     print_rank_0("> finished creating GPT datasets ...")
 
@@ -12,10 +12,13 @@ from megatron import (
     print_rank_0
 )
 from megatron.core import tensor_parallel
+from megatron.data.data_manifest import verify_data_manifest
 from megatron.data.dataset_utils import build_train_valid_test_datasets
 from megatron.model import T5Model, ModelType
 from megatron.training import pretrain
 from megatron.utils import average_losses_across_data_parallel_group
+from megatron.utils import get_t5_attention_masks
+from megatron.utils import get_packed_position_ids, get_packed_cu_seqlens
 
 
 """
@@ -72,8 +75,12 @@ def model_provider(pre_process=True, post_process=True,
 def get_batch(data_iterator):
     """Build the batch."""
 
-    keys = ['text_enc', 'text_dec', 'labels', 'loss_mask',
-            'enc_mask', 'dec_mask', 'enc_dec_mask']
+    args = get_args()
+    keys = ['text_enc', 'text_dec', 'labels', 'loss_mask']
+    if not args.compact_attention_mask:
+        keys += ['enc_mask', 'dec_mask', 'enc_dec_mask']
+    if args.isolate_packed_samples:
+        keys += ['enc_segment_ids', 'dec_segment_ids']
     datatype = torch.int64
 
     # Broadcast data.
@@ -81,7 +88,7 @@ def get_batch(data_iterator):
         data = next(data_iterator)
     else:
         data = None
-    if get_args().tensor_model_parallel_size > 1:
+    if args.tensor_model_parallel_size > 1:
         data_b = tensor_parallel.broadcast_data(keys, data, datatype)
     else:
         data_b = {}
@@ -94,12 +101,30 @@ def get_batch(data_iterator):
     labels = data_b['labels'].long()
     loss_mask = data_b['loss_mask'].float()
 
-    enc_mask = (data_b['enc_mask'] < 0.5)
-    dec_mask = (data_b['dec_mask'] < 0.5)
-    enc_dec_mask = (data_b['enc_dec_mask'] < 0.5)
+    enc_segment_ids = dec_segment_ids = None
+    packing_kwargs = {}
+    if args.isolate_packed_samples:
+        enc_segment_ids = data_b['enc_segment_ids'].long()
+        dec_segment_ids = data_b['dec_segment_ids'].long()
+        packing_kwargs['encoder_position_ids'] = \
+            get_packed_position_ids(enc_segment_ids)
+        packing_kwargs['decoder_position_ids'] = \
+            get_packed_position_ids(dec_segment_ids)
+        if args.use_flash_attn:
+            packing_kwargs['decoder_cu_seqlens'] = \
+                get_packed_cu_seqlens(dec_segment_ids)
+
+    if args.compact_attention_mask:
+        # Masks are not shipped by the data loader, build them on the GPU.
+        enc_mask, dec_mask, enc_dec_mask = get_t5_attention_masks(
+            tokens_enc, tokens_dec, enc_segment_ids, dec_segment_ids)
+    else:
+        enc_mask = (data_b['enc_mask'] < 0.5)
+        dec_mask = (data_b['dec_mask'] < 0.5)
+        enc_dec_mask = (data_b['enc_dec_mask'] < 0.5)
 
     return tokens_enc, tokens_dec, loss_mask, labels, \
-           enc_mask, dec_mask, enc_dec_mask
+           enc_mask, dec_mask, enc_dec_mask, packing_kwargs
 
 
 def loss_func(loss_mask, output_tensor):
@@ -124,8 +149,8 @@ def forward_step(data_iterator, model):
     # Get the batch.
     timers('batch generator', log_level=2).start()
     with torch.cuda.nvtx.range("batch_generator"):
-        tokens_enc, tokens_dec, loss_mask, lm_labels, enc_mask, dec_mask, enc_dec_mask \
-            = get_batch(data_iterator)
+        tokens_enc, tokens_dec, loss_mask, lm_labels, enc_mask, dec_mask, enc_dec_mask, \
+            packing_kwargs = get_batch(data_iterator)
     timers('batch generator').stop()
 
     # Forward model lm_labels
@@ -135,7 +160,8 @@ def forward_step(data_iterator, model):
                           dec_mask,
                           enc_dec_mask,
                           tokentype_ids=None,
-                          lm_labels=lm_labels)
+                          lm_labels=lm_labels,
+                          **packing_kwargs)
 
     return output_tensor, partial(loss_func, loss_mask)
 
@@ -146,6 +172,11 @@ def train_valid_test_datasets_provider(train_val_test_num_samples):
 
     print_rank_0('> building train, validation, and test datasets '
                  'for T5 ...')
+    if args.data_manifest is not None:
+        # caches were built by tools/prepare_training_data.py
+        verify_data_manifest(args.data_manifest, args, 't5',
+                             train_val_test_num_samples)
+        print_rank_0(' > verified data manifest {}'.format(args.data_manifest))
     train_ds, valid_ds, test_ds = build_train_valid_test_datasets(
         data_prefix=args.data_path,
         data_impl=args.data_impl,
@@ -160,7 +191,11 @@ def train_valid_test_datasets_provider(train_val_test_num_samples):
         dataset_type='t5' if args.targets_data_path is None else 't5_supervised',
         num_epochs=args.train_epochs if args.targets_data_path else None,
         sort_samples=args.sort_dataset,
-        pack_samples=args.pack_dataset,
+        pack_samples=args.pack_dataset_strategy if args.pack_dataset else False,
+        compact_attention_mask=args.compact_attention_mask,
+        isolate_packed_samples=args.isolate_packed_samples,
+        mapping_build_threads=args.mapping_build_threads,
+        offline_build=args.data_manifest is not None,
         )
     print_rank_0("> finished creating T5 datasets ...")
 
@@ -0,0 +1,74 @@
+import numpy as np
+
+from megatron.data import data_samplers
+from megatron.data.data_samplers import (
+    MegatronPretrainingBucketedSampler,
+    PrefetchingBatchSampler,
+)
+
+
+class _LengthDataset:
+    max_seq_length = 512
+    max_seq_length_dec = 128
+
+    def __init__(self, seq_lens, dec_seq_lens):
+        self.seq_lens = seq_lens
+        self.dec_seq_lens = dec_seq_lens
+
+    def __len__(self):
+        return len(self.seq_lens)
+
+    def get_seq_lens(self):
+        return self.seq_lens
+
+    def get_dec_seq_lens(self):
+        return self.dec_seq_lens
+
+
+def test_bucketed_sampler_covers_epoch_and_resumes(monkeypatch):
+    monkeypatch.setattr(data_samplers, "get_num_microbatches", lambda: 3)
+    rng = np.random.default_rng(0)
+    dataset = _LengthDataset(rng.integers(1, 900, 2000),
+                             rng.integers(1, 200, 2000))
+
+    def make_sampler(consumed_samples, rank):
+        return MegatronPretrainingBucketedSampler(
+            dataset, len(dataset), consumed_samples, 4, rank, 2, True,
+            bucket_width=64, shuffle_within_bucket=True, seed=1)
+
+    samplers = [iter(make_sampler(0, rank)) for rank in range(2)]
+    num_batches = len(make_sampler(0, 0))
+    samples = [idx for _ in range(num_batches)
+               for sampler in samplers for idx in next(sampler)]
+    assert len(set(samples)) == len(samples) == make_sampler(0, 0).epoch_samples
+
+    # most global batches come from a single length bucket
+    sampler = make_sampler(0, 0)
+    batches = sampler.get_batches(0)
+    single_bucket = [len(np.unique(sampler.bucket_ids[batch])) == 1
+                     for batch in batches]
+    assert np.mean(single_bucket) > 0.5
+
+    # resuming from consumed_samples continues with the same batches
+    resumed = iter(make_sampler(5 * 24, 1))
+    assert next(resumed) == batches[5][12:16].tolist()
+
+
+def test_prefetching_batch_sampler_prefetches_ahead():
+    class _PrefetchDataset:
+        def __init__(self):
+            self.prefetched = []
+
+        def prefetch(self, indices):
+            self.prefetched.append(indices.tolist())
+
+    dataset = _PrefetchDataset()
+    batches = [[0, 1], [[2, 3], [4]], range(5, 7), [7]]
+    sampler = PrefetchingBatchSampler(batches, dataset, lookahead=2)
+    yielded = []
+    for batch in sampler:
+        # batches up to two ahead of the yielded one were prefetched
+        assert len(dataset.prefetched) == min(len(yielded) + 3, len(batches))
+        yielded.append(batch)
+    assert yielded == batches
+    assert dataset.prefetched == [[0, 1], [2, 3, 4], [5, 6], [7]]
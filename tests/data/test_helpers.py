@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from megatron.data.dataset_utils import compile_helper
+
+
+def _make_index(num_docs, seed):
+    rng = np.random.default_rng(seed)
+    doc_idx = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(rng.integers(1, 4, num_docs), out=doc_idx[1:])
+    sizes = rng.integers(1, 50, doc_idx[-1]).astype(np.int32)
+    return doc_idx, sizes
+
+@pytest.mark.parametrize("sort_samples", [False, True])
+def test_parallel_supervised_mapping_matches_serial(sort_samples):
+    compile_helper()
+    from megatron.data import helpers
+    build_args = _make_index(1000, 0) + _make_index(1000, 1) + (
+        3, 2500, 512, 128, 1234, False, sort_samples)
+    expected = helpers.build_mapping_supervised(*build_args)
+    mapping = helpers.build_mapping_supervised_parallel(*build_args, 4)
+    for actual, reference in zip(mapping, expected):
+        assert actual.shape == reference.shape == (3000, 3)
+        if sort_samples:
+            # samples with equal lengths may be ordered differently
+            assert np.array_equal(actual[:, 2], reference[:, 2])
+            assert np.array_equal(np.sort(actual[:, 0]), np.sort(reference[:, 0]))
+        else:
+            assert np.array_equal(actual, reference)
@@ -0,0 +1,153 @@
+import filecmp
+import mmap
+import pickle
+
+import numpy as np
+import pytest
+import torch
+
+from megatron.data import indexed_dataset
+
+
+@pytest.mark.parametrize("impl", ["mmap", "lazy"])
+def test_add_batch_matches_add_item(tmp_path, impl):
+    rng = np.random.default_rng(0)
+    docs = [[rng.integers(0, 30000, rng.integers(1, 20)).tolist()
+             for _ in range(rng.integers(1, 5))] for _ in range(200)]
+
+    builder = indexed_dataset.make_builder(
+        str(tmp_path / "item.bin"), impl, vocab_size=30000)
+    for doc in docs:
+        for sentence in doc:
+            builder.add_item(torch.IntTensor(sentence))
+        builder.end_document()
+    builder.finalize(str(tmp_path / "item.idx"))
+
+    builder = indexed_dataset.make_builder(
+        str(tmp_path / "batch.bin"), impl, vocab_size=30000)
+    batcher = indexed_dataset.DocumentBatcher(builder, max_tokens=500)
+    for doc in docs:
+        batcher.add_sentences(doc)
+    batcher.flush()
+    builder.finalize(str(tmp_path / "batch.idx"))
+
+    for suffix in [".bin", ".idx"]:
+        assert filecmp.cmp(tmp_path / ("item" + suffix),
+                           tmp_path / ("batch" + suffix), shallow=False)
+    dataset = indexed_dataset.make_dataset(str(tmp_path / "batch"), impl)
+    assert dataset[3].tolist() == [t for doc in docs for t in doc][3]
+
+
+def test_cached_dataset_prefetch_matches_lazy_reads(tmp_path):
+    rng = np.random.default_rng(1)
+    builder = indexed_dataset.make_builder(str(tmp_path / "data.bin"), "lazy")
+    for _ in range(300):
+        builder.add_item(torch.IntTensor(rng.integers(0, 1000, rng.integers(1, 30))))
+        builder.end_document()
+    builder.finalize(str(tmp_path / "data.idx"))
+
+    lazy = indexed_dataset.make_dataset(str(tmp_path / "data"), "lazy")
+    cached = indexed_dataset.make_dataset(str(tmp_path / "data"), "cached")
+    # runs of adjacent items are read together
+    indices = list(range(10, 40)) + [45, 47] + list(range(100, 200))
+    cached.prefetch(indices)
+    cached = pickle.loads(pickle.dumps(cached))
+    for i in indices:
+        assert np.array_equal(cached[i], lazy[i])
+    assert all(np.array_equal(x, lazy[i])
+               for i, x in zip(range(5, 9), lazy[5:9]))
+
+
+def test_mmap_gather_and_get_many(tmp_path):
+    rng = np.random.default_rng(2)
+    builder = indexed_dataset.make_builder(
+        str(tmp_path / "data.bin"), "mmap", vocab_size=1000)
+    batcher = indexed_dataset.DocumentBatcher(builder)
+    for _ in range(100):
+        batcher.add_sentences([rng.integers(0, 1000, rng.integers(1, 20)).tolist()])
+    batcher.flush()
+    builder.finalize(str(tmp_path / "data.idx"))
+
+    dataset = indexed_dataset.make_dataset(str(tmp_path / "data"), "mmap",
+                                           skip_warmup=True)
+    indices = [7, 3, 3, 99, 0]
+    pointers, sizes = dataset._index.get_many(indices)
+    assert [dataset._index[i] for i in indices] == list(zip(pointers, sizes))
+    tokens, offsets = dataset.gather(indices)
+    assert offsets[-1] == len(tokens)
+    for i, index in enumerate(indices):
+        assert np.array_equal(tokens[offsets[i]:offsets[i + 1]], dataset[index])
+
+
+@pytest.mark.skipif(mmap.PAGESIZE != 4096, reason="page counts assume 4 KiB pages")
+def test_mmap_prefetch_spans(tmp_path):
+    # 40 items of 1000 uint16 tokens, 2000 bytes each
+    builder = indexed_dataset.make_builder(
+        str(tmp_path / "data.bin"), "mmap", vocab_size=1000)
+    batcher = indexed_dataset.DocumentBatcher(builder)
+    for i in range(40):
+        batcher.add_sentences([[i] * 1000])
+    batcher.flush()
+    builder.finalize(str(tmp_path / "data.idx"))
+    dataset = indexed_dataset.make_dataset(str(tmp_path / "data"), "mmap",
+                                           skip_warmup=True)
+
+    assert dataset.prefetch_stats() == \
+        {'hit_pages': 0, 'miss_pages': 0, 'advised_bytes': 0}
+    # items 0 and 1 share the first page, items 20-21 (bytes 40000-44000)
+    # span two other pages; empty spans are skipped
+    dataset.prefetch_spans([1, 20, 0, 5], [2, 22, 1, 5])
+    dataset._prefetcher.wait()
+    stats = dataset.prefetch_stats()
+    assert stats['hit_pages'] + stats['miss_pages'] == 1 + 2
+    assert stats['advised_bytes'] % mmap.PAGESIZE == 0
+    assert stats['advised_bytes'] <= 3 * mmap.PAGESIZE
+    if indexed_dataset._get_mincore() is None:
+        assert stats['miss_pages'] == 3
+
+    # the data is still readable, and the pages are now resident
+    assert np.array_equal(dataset.get_span(20, 22), np.repeat([20, 21], 1000))
+    dataset.prefetch_spans([20], [22])
+    dataset._prefetcher.wait()
+    if indexed_dataset._get_mincore() is not None:
+        assert dataset.prefetch_stats()['hit_pages'] == stats['hit_pages'] + 2
+
+    prefetcher = dataset._prefetcher
+    prefetcher.close()
+    assert not prefetcher._thread.is_alive()
+
+
+@pytest.mark.parametrize("max_size", [100, 40000, 70000])
+def test_mmap_index_v2_matches_v1(tmp_path, max_size):
+    rng = np.random.default_rng(3)
+    docs = [[rng.integers(0, 1000, rng.integers(1, 20)).tolist()
+             for _ in range(rng.integers(1, 5))] for _ in range(100)]
+    docs[5][-1] = [1] * max_size
+
+    datasets = []
+    for version in [1, 2]:
+        prefix = str(tmp_path / "v{}".format(version))
+        builder = indexed_dataset.make_builder(
+            prefix + ".bin", "mmap", vocab_size=1000, index_version=version)
+        batcher = indexed_dataset.DocumentBatcher(builder)
+        for doc in docs:
+            batcher.add_sentences(doc)
+        batcher.flush()
+        builder.finalize(prefix + ".idx")
+        datasets.append(indexed_dataset.make_dataset(prefix, "mmap",
+                                                     skip_warmup=True))
+
+    v1, v2 = datasets
+    assert v2.sizes.dtype == (np.uint16 if max_size < 65536 else np.uint32)
+    assert np.array_equal(v1.sizes, v2.sizes)
+    assert np.array_equal(v1.doc_idx, v2.doc_idx)
+    assert np.array_equal(v1._index._pointers, v2._index._pointers)
+    for i in range(len(v1)):
+        assert np.array_equal(v1[i], v2[i])
+        assert np.array_equal(v1.get_span(i, i + 1), v2.get_span(i, i + 1))
+    # spans, including the document with the long item
+    for start, stop in zip(v1.doc_idx[:-1], v1.doc_idx[1:]):
+        assert np.array_equal(v1.get_span(start, stop), v2.get_span(start, stop))
+        for a, b in zip(v1[start:stop], v2[start:stop]):
+            assert np.array_equal(a, b)
+    assert len(v2.get_span(0, len(v2))) == v1.sizes.sum()
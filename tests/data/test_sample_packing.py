@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from megatron.data.dataset_utils import compile_helper
+from megatron.data.sample_packing import (
+    PACKING_STRATEGIES,
+    PackedSamples,
+    get_samples_mapping_lengths,
+    run_pack_samples,
+)
+
+
+def _make_mapping(seq_lens):
+    mapping = np.zeros((len(seq_lens), 3), dtype=np.uint32)
+    mapping[:, 0] = np.arange(len(seq_lens))
+    mapping[:, 1] = np.arange(len(seq_lens)) + 1
+    mapping[:, 2] = seq_lens
+    return mapping
+
+def _reference_next_fit(enc_lens, dec_lens, max_enc, max_dec):
+    sequences, current = [], []
+    curr_enc, curr_dec = 0, 0
+    for idx, (enc, dec) in enumerate(zip(enc_lens, dec_lens)):
+        enc, dec = min(enc, max_enc), min(dec, max_dec)
+        if curr_enc + enc > max_enc or curr_dec + dec > max_dec:
+            sequences.append(current)
+            current, curr_enc, curr_dec = [], 0, 0
+        current.append(idx)
+        curr_enc += enc
+        curr_dec += dec
+    if current:
+        sequences.append(current)
+    return sequences
+
+def test_next_fit_matches_reference():
+    rng = np.random.default_rng(0)
+    enc_lens = rng.integers(0, 700, 1000)
+    dec_lens = rng.integers(0, 300, 1000)
+    packed, stats = run_pack_samples(_make_mapping(enc_lens), 512,
+                                     _make_mapping(dec_lens), 126)
+    expected = _reference_next_fit(enc_lens, dec_lens, 512, 126)
+    assert len(packed) == len(expected) == stats['num_sequences']
+    for idx, sequence in enumerate(expected):
+        assert list(packed[idx]) == sequence
+    assert 0 < stats['enc_efficiency'] <= 1
+    assert 0 < stats['dec_efficiency'] <= 1
+
+def test_packed_samples_save_load(tmp_path):
+    packed, _ = run_pack_samples(_make_mapping([3, 4, 5, 6]), 8)
+    prefix = str(tmp_path / 'packed')
+    packed.save(prefix)
+    loaded = PackedSamples.load(prefix)
+    assert np.array_equal(loaded.offsets, packed.offsets)
+    assert np.array_equal(loaded.sample_indices, packed.sample_indices)
+    assert list(loaded.sequence_lengths(np.array([3, 4, 5, 6]))) == [7, 5, 6]
+
+@pytest.mark.parametrize("strategy", sorted(PACKING_STRATEGIES.keys()))
+def test_packing_strategies_respect_budgets(strategy):
+    compile_helper()
+    rng = np.random.default_rng(1)
+    enc_lens = rng.integers(1, 700, 2000)
+    dec_lens = rng.integers(1, 300, 2000)
+    packed, stats = run_pack_samples(_make_mapping(enc_lens), 512,
+                                     _make_mapping(dec_lens), 126,
+                                     strategy=strategy)
+    assert sorted(packed.sample_indices.tolist()) == list(range(2000))
+    assert packed.sequence_lengths(np.minimum(enc_lens, 512)).max() <= 512
+    assert packed.sequence_lengths(np.minimum(dec_lens, 126)).max() <= 126
+    next_fit, _ = run_pack_samples(_make_mapping(enc_lens), 512,
+                                   _make_mapping(dec_lens), 126)
+    assert len(packed) <= len(next_fit)
+
+def test_samples_mapping_lengths_are_read_in_windows(tmp_path):
+    seq_lens = np.random.default_rng(2).integers(0, 1000, 1001)
+    filename = str(tmp_path / 'mapping.npy')
+    np.save(filename, _make_mapping(seq_lens))
+    mapping = np.load(filename, mmap_mode='r')
+    lengths = get_samples_mapping_lengths(mapping, window_size=100)
+    assert lengths.dtype == np.int64 and lengths.flags['C_CONTIGUOUS']
+    assert np.array_equal(lengths, seq_lens)
+
+def test_unknown_packing_strategy():
+    with pytest.raises(ValueError):
+        run_pack_samples(_make_mapping([1, 2]), 8, strategy='no_such_strategy')
@@ -0,0 +1,29 @@
+import numpy as np
+
+from megatron.data.t5_dataset import build_supervised_training_sample
+
+
+def test_packed_samples_are_isolated():
+    # two packed samples, separated by the token 3
+    input_tokens = np.array([11, 12, 3, 13, 14, 15])
+    enc_segment_ids = np.array([1, 1, 2, 2, 2, 2])
+    target_tokens = np.array([21, 3, 22])
+    dec_segment_ids = np.array([1, 2, 2])
+    sample = build_supervised_training_sample(
+        input_tokens, target_tokens, 8, 6, 0, bos_id=1, eos_id=2,
+        enc_segment_ids=enc_segment_ids, dec_segment_ids=dec_segment_ids)
+
+    assert sample["enc_segment_ids"].tolist() == [1, 1, 2, 2, 2, 2, 0, 0]
+    # <bos> belongs to the first sample, the decoder inputs are shifted
+    assert sample["text_dec"].tolist() == [1, 21, 3, 22, 0, 0]
+    assert sample["dec_segment_ids"].tolist() == [1, 1, 2, 2, 0, 0]
+
+    enc_mask = sample["enc_mask"]
+    assert enc_mask[0, :2].tolist() == [1, 1] and enc_mask[0, 2:].sum() == 0
+    assert enc_mask[3, :2].sum() == 0 and enc_mask[3, 2:6].tolist() == [1] * 4
+    dec_mask = sample["dec_mask"]
+    assert dec_mask[1, :2].tolist() == [1, 1]
+    assert dec_mask[3, :4].tolist() == [0, 0, 1, 1]
+    enc_dec_mask = sample["enc_dec_mask"]
+    assert enc_dec_mask[1].tolist() == [1, 1, 0, 0, 0, 0, 0, 0]
+    assert enc_dec_mask[2].tolist() == [0, 0, 1, 1, 1, 1, 0, 0]
@@ -0,0 +1,207 @@
+import argparse
+import datetime
+import os
+import socket
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+pytest.importorskip("dynapipe")
+
+from dynapipe.pipe.instructions import (
+    ForwardPass,
+    RecvActivationFinish,
+    RecvActivationStart,
+    RecvGradFinish,
+    RecvGradStart,
+    SendActivationFinish,
+    SendActivationStart,
+    SendGradFinish,
+    SendGradStart,
+)
+
+from megatron import global_vars
+from megatron import pipeline_executor
+
+NUM_STAGES = 3
+NUM_MICROBATCHES = 3
+# (microbatch size, sequence length, hidden size), as in execution plans
+SHAPE = (1, 4, 2)
+ACT_BUFFERS = [0, 1]
+GRAD_BUFFERS = [2]
+
+
+def _instr(cls, microbatch, stage, buffer_ids, peer=None):
+    # set the fields the handlers read, whatever the constructor takes
+    instr = cls.__new__(cls)
+    instr.microbatch = microbatch
+    instr.stage = stage
+    instr.buffer_ids = buffer_ids
+    instr.buffer_shapes = [SHAPE] * len(buffer_ids)
+    instr.peer = peer
+    return instr
+
+
+def _value(kind, microbatch, sender, index):
+    return {"act": 0, "grad": 1000}[kind] + 100 * microbatch + 10 * sender + index
+
+
+def _make_plan(rank):
+    """Each rank sends two activation tensors (like a T5 decoder stage) to
+    the next stage and one gradient to the previous one. The next receive
+    is started right after each send so the two can be coalesced."""
+    last = NUM_STAGES - 1
+    instructions = []
+    for phase, start, finish, peer, buffers, receives in [
+            ("act", (SendActivationStart, RecvActivationStart),
+             (SendActivationFinish, RecvActivationFinish), 1, ACT_BUFFERS,
+             rank > 0),
+            ("grad", (SendGradStart, RecvGradStart),
+             (SendGradFinish, RecvGradFinish), -1, GRAD_BUFFERS,
+             rank < last)]:
+        sends = rank < last if phase == "act" else rank > 0
+        if receives:
+            instructions.append(_instr(start[1], 0, rank, buffers, rank - peer))
+        for microbatch in range(NUM_MICROBATCHES):
+            if sends and microbatch > 0:
+                instructions.append(_instr(finish[0], microbatch - 1, rank, buffers))
+            if receives:
+                instructions.append(_instr(finish[1], microbatch, rank, buffers))
+            # stands in for the compute that fills the buffers to send
+            instructions.append(_instr(ForwardPass, microbatch, rank, buffers))
+            if sends:
+                instructions.append(_instr(start[0], microbatch, rank, buffers, rank + peer))
+            if receives and microbatch + 1 < NUM_MICROBATCHES:
+                instructions.append(_instr(start[1], microbatch + 1, rank, buffers, rank - peer))
+        if sends:
+            instructions.append(_instr(finish[0], NUM_MICROBATCHES - 1, rank, buffers))
+    return instructions
+
+
+def _init_process_group(rank, port, world_size):
+    os.environ["MASTER_ADDR"] = "localhost"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(seconds=60))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def _run_plan(rank, port, batch_p2p):
+    _init_process_group(rank, port, NUM_STAGES)
+    global_vars.set_args(argparse.Namespace(
+        params_dtype=torch.float32, fp32_residual_connection=False))
+    pipeline_executor.mpu.get_global_rank_from_pipeline_rank = lambda rank: rank
+    pipeline_executor.mpu.get_pipeline_model_parallel_group = lambda: None
+    torch.cuda.current_device = lambda: "cpu"
+
+    instructions = _make_plan(rank)
+    executor = SimpleNamespace(
+        state=pipeline_executor._IterationState(), buffer_slots=[None] * 3,
+        execution_plan=SimpleNamespace(instructions=instructions),
+        instr_index=0, recv_buffer_pool=None, batch_p2p=batch_p2p,
+        send_stats=pipeline_executor.SendCompletionStats())
+    if batch_p2p and 0 < rank < NUM_STAGES - 1:
+        # a middle stage sends and receives at the same time
+        groups = pipeline_executor._coalesce_comm_starts(instructions)
+        assert any(len(group) > 1 for group in groups.values())
+
+    received = []
+    for index, instr in enumerate(instructions):
+        executor.instr_index = index
+        kind = "act" if instr.buffer_ids == ACT_BUFFERS else "grad"
+        seq_first_shape = (SHAPE[1], SHAPE[0], SHAPE[2])
+        if isinstance(instr, ForwardPass):
+            for i, buffer_id in enumerate(instr.buffer_ids):
+                executor.buffer_slots[buffer_id] = torch.full(
+                    seq_first_shape, float(_value(kind, instr.microbatch, rank, i)))
+            executor.state.output_tensors[(instr.microbatch, rank)] = [
+                (executor.buffer_slots[buffer_id], False)
+                for buffer_id in instr.buffer_ids]
+        elif isinstance(instr, pipeline_executor._comm_start_types):
+            pipeline_executor._handle_comm_start(executor, instr)
+        elif isinstance(instr, (SendActivationFinish, SendGradFinish)):
+            pipeline_executor._handle_send_finish(executor, instr)
+        else:
+            pipeline_executor._handle_recv_finish(executor, instr)
+            sender = rank - 1 if kind == "act" else rank + 1
+            for i, buffer_id in enumerate(instr.buffer_ids):
+                expected = _value(kind, instr.microbatch, sender, i)
+                assert torch.all(executor.buffer_slots[buffer_id] == expected), \
+                    "rank {} got the wrong data for {} of microbatch {}".format(
+                        rank, kind, instr.microbatch)
+            received.append((kind, instr.microbatch))
+    expected_received = [("act", microbatch) for microbatch in range(NUM_MICROBATCHES) if rank > 0] + \
+        [("grad", microbatch) for microbatch in range(NUM_MICROBATCHES) if rank < NUM_STAGES - 1]
+    assert received == expected_received
+    assert not executor.state.pending_send_ops
+    # every sent activation was released exactly once
+    assert executor.send_stats.freed == \
+        (NUM_MICROBATCHES if rank < NUM_STAGES - 1 else 0)
+    assert not executor.state.pending_recv_ops
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+@pytest.mark.parametrize("batch_p2p", [False, True])
+def test_comm_starts_deliver_in_order_without_deadlock(batch_p2p):
+    # a deadlock shows up as a gloo timeout in one of the ranks
+    mp.start_processes(_run_plan, args=(_free_port(), batch_p2p),
+                       nprocs=NUM_STAGES, start_method="fork")
+
+
+def test_coalesce_keeps_finishes_adjacent():
+    starts = [_instr(SendActivationStart, 0, 1, ACT_BUFFERS, 2),
+              _instr(RecvActivationStart, 1, 1, ACT_BUFFERS, 0)]
+    finishes = [_instr(SendActivationFinish, 0, 1, ACT_BUFFERS),
+                _instr(RecvActivationFinish, 1, 1, ACT_BUFFERS)]
+    compute = _instr(ForwardPass, 1, 1, ACT_BUFFERS)
+
+    groups = pipeline_executor._coalesce_comm_starts(starts + finishes)
+    assert groups == {0: [0, 1]}
+    # waiting for the receive at the send's finish could deadlock if the
+    # peer needs the compute in between to match it
+    groups = pipeline_executor._coalesce_comm_starts(
+        starts + [finishes[0], compute, finishes[1]])
+    assert groups == {0: [0], 1: [1]}
+
+
+class _Plan(object):
+    def __init__(self, name):
+        self.name = name
+
+    def serialize(self):
+        return self.name.encode()
+
+    @classmethod
+    def deserialize(cls, ep_bytes):
+        return cls(ep_bytes.decode())
+
+
+def _run_plan_broadcast(rank, port):
+    _init_process_group(rank, port, 2)
+    pipeline_executor.ExecutionPlan = _Plan
+    broadcaster = pipeline_executor.ExecutionPlanBroadcaster(
+        dist.group.WORLD, 0, cache_size=2)
+    plans = []
+    for name in ["a", "b", "a", "c", "b"]:
+        plan = broadcaster.broadcast(_Plan(name) if rank == 0 else None)
+        assert plan.name == name
+        plans.append(plan)
+    # "a" is sent as a digest the second time, "b" was evicted by "c"
+    assert (broadcaster.hits, broadcaster.misses) == (1, 4)
+    if rank == 1:
+        assert plans[2] is plans[0]
+    dist.destroy_process_group()
+
+
+def test_plan_broadcast_reuses_cached_plans():
+    mp.start_processes(_run_plan_broadcast, args=(_free_port(),), nprocs=2,
+                       start_method="fork")
@@ -0,0 +1,89 @@
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+
+"""Benchmark for the supervised samples mapping builders.
+
+Builds the input and target index arrays (`doc_idx` and `sizes`, as stored
+in an mmap index file) of a synthetic multi-million document dataset and
+times `helpers.build_mapping_supervised` against
+`helpers.build_mapping_supervised_parallel`, checking that both produce
+the same mapping.
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+import time
+
+import numpy as np
+
+from megatron.data.dataset_utils import compile_helper
+
+
+def build_synthetic_index(num_docs, mean_sentences, mean_length, seed):
+    rng = np.random.default_rng(seed)
+    num_sentences = np.maximum(rng.poisson(mean_sentences, num_docs), 1)
+    doc_idx = np.zeros(num_docs + 1, dtype=np.int64)
+    np.cumsum(num_sentences, out=doc_idx[1:])
+    sizes = np.maximum(rng.poisson(mean_length, doc_idx[-1]), 1).astype(np.int32)
+    return doc_idx, sizes
+
+
+def check_sorted(input_mapping, target_mapping):
+    keys = input_mapping[:, 2].astype(np.int64) * (1 << 32) + target_mapping[:, 2]
+    return bool(np.all(keys[1:] >= keys[:-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-docs', type=int, default=4000000)
+    parser.add_argument('--num-epochs', type=int, default=2)
+    parser.add_argument('--sentences-per-doc', type=int, default=4,
+                        help='Mean number of sentences per document.')
+    parser.add_argument('--sentence-length', type=int, default=32,
+                        help='Mean number of tokens per sentence.')
+    parser.add_argument('--num-threads', type=int, nargs='+',
+                        default=[2, 4, 8, 16])
+    parser.add_argument('--sort-samples', action='store_true')
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    compile_helper()
+    from megatron.data import helpers
+
+    print('> building synthetic index of {} documents ...'.format(
+        args.num_docs))
+    doc_idx, sizes = build_synthetic_index(
+        args.num_docs, args.sentences_per_doc, args.sentence_length, args.seed)
+    target_doc_idx, target_sizes = build_synthetic_index(
+        args.num_docs, 1, args.sentence_length, args.seed + 1)
+    build_args = (doc_idx, sizes, target_doc_idx, target_sizes,
+                  args.num_epochs, np.iinfo(np.int64).max - 1, 512, 128,
+                  args.seed, False, args.sort_samples)
+
+    start_time = time.time()
+    expected = helpers.build_mapping_supervised(*build_args)
+    serial_time = time.time() - start_time
+    print('> serial builder: {:.2f} seconds'.format(serial_time))
+
+    for num_threads in args.num_threads:
+        start_time = time.time()
+        mapping = helpers.build_mapping_supervised_parallel(
+            *build_args, num_threads)
+        elapsed = time.time() - start_time
+        if args.sort_samples:
+            # ties may be ordered differently, compare the sorted contents
+            same = check_sorted(*mapping) and all(
+                np.array_equal(np.sort(x[:, 0]), np.sort(y[:, 0]))
+                for x, y in zip(mapping, expected))
+        else:
+            same = all(np.array_equal(x, y)
+                       for x, y in zip(mapping, expected))
+        print('> {} threads: {:.2f} seconds ({:.2f}x), {}'.format(
+            num_threads, elapsed, serial_time / elapsed,
+            'same mapping' if same else 'MAPPING DIFFERS'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+
+"""Microbenchmark for the per-iteration overhead of the pipeline executor.
+
+Reports the time needed to get an executor ready for an iteration, by
+building and registering a new one (as every iteration used to) and by
+resetting a persistent MegatronPipelineExecutor, and the per-instruction
+dispatch overhead of the handler wrappers with a number of sends still in
+flight. No model is run, so this only measures the Python bookkeeping.
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+import time
+from types import SimpleNamespace
+
+from megatron import global_vars
+from megatron.pipeline_executor import (
+    MegatronPipelineExecutor,
+    _handle_load_input,
+    _track_send,
+)
+
+
+class _InFlightOp(object):
+    """A send that never completes during the benchmark."""
+
+    def is_completed(self):
+        return False
+
+
+def _forward_step_func(data_iterator, model):
+    raise RuntimeError('the benchmark does not run forward passes')
+
+
+def benchmark_setup(num_iters, persistent):
+    executor = MegatronPipelineExecutor(_forward_step_func, [None], None,
+                                        dp_rank=0, pp_rank=0)
+    start_time = time.perf_counter()
+    for _ in range(num_iters):
+        if persistent:
+            executor.reset()
+        else:
+            executor = MegatronPipelineExecutor(_forward_step_func, [None],
+                                                None, dp_rank=0, pp_rank=0)
+    return (time.perf_counter() - start_time) / num_iters
+
+
+def benchmark_dispatch(num_instructions, pending_sends):
+    executor = MegatronPipelineExecutor(_forward_step_func, [None], None,
+                                        dp_rank=0, pp_rank=0)
+    executor.buffer_slots = [None] * 4
+    for microbatch in range(pending_sends):
+        _track_send(executor, (microbatch, 0, 'grad'), [_InFlightOp()])
+    instructions = [SimpleNamespace(microbatch=i, stage=0, buffer_ids=[i % 4])
+                    for i in range(num_instructions)]
+    start_time = time.perf_counter()
+    for instr in instructions:
+        _handle_load_input(executor, instr)
+    return (time.perf_counter() - start_time) / num_instructions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-iters', type=int, default=1000,
+                        help='Number of executor setups to time.')
+    parser.add_argument('--num-instructions', type=int, default=100000,
+                        help='Number of instructions to dispatch.')
+    parser.add_argument('--pending-sends', type=int, nargs='+',
+                        default=[0, 4, 16, 64],
+                        help='Numbers of in-flight sends to benchmark '
+                        'the dispatch with.')
+    args = parser.parse_args()
+
+    megatron_args = argparse.Namespace(
+        timing_log_level=0, timing_log_option='minmax',
+        virtual_pipeline_model_parallel_size=None, deepspeed=False)
+    global_vars.set_args(megatron_args)
+    global_vars._set_timers(megatron_args)
+
+    rebuild = benchmark_setup(args.num_iters, persistent=False)
+    reset = benchmark_setup(args.num_iters, persistent=True)
+    print('executor setup per iteration: rebuild {:.1f} us, '
+          'reset {:.1f} us'.format(rebuild * 1e6, reset * 1e6))
+    for pending_sends in args.pending_sends:
+        dispatch = benchmark_dispatch(args.num_instructions, pending_sends)
+        print('dispatch with {} sends in flight: {:.2f} us/instruction'.format(
+            pending_sends, dispatch * 1e6))
+
+
+if __name__ == '__main__':
+    main()
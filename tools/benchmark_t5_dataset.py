@@ -0,0 +1,148 @@
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+
+"""Microbenchmark for T5SupervisedDataset sample construction.
+
+Builds a synthetic supervised dataset and reports the number of samples
+per second a single data loader worker can produce, using the per-sentence
+list based path the dataset used before, the current per-sample numpy path
+and the batched `__getitems__` path.
+"""
+
+import argparse
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+from megatron.data import indexed_dataset
+from megatron.data.dataset_utils import compile_helper
+from megatron.data.t5_dataset import (
+    T5SupervisedDataset,
+    pad_and_convert_to_numpy,
+)
+from megatron.global_vars import rebuild_tokenizer
+
+
+def build_synthetic_dataset(prefix, num_docs, mean_length, vocab_size, seed):
+    rng = np.random.default_rng(seed)
+    lengths = np.maximum(rng.poisson(mean_length, num_docs), 1)
+    builder = indexed_dataset.make_builder(
+        indexed_dataset.data_file_path(prefix), impl='mmap',
+        vocab_size=vocab_size)
+    for length in lengths:
+        builder.add_item(torch.IntTensor(
+            rng.integers(1, vocab_size, length).astype(np.int32)))
+        builder.end_document()
+    builder.finalize(indexed_dataset.index_file_path(prefix))
+
+
+def legacy_get_sample(dataset, idx):
+    """The list based __getitem__ + collate path, kept for comparison."""
+    input_start, input_end, _ = dataset.input_samples_mapping[idx]
+    target_start, target_end, _ = dataset.target_samples_mapping[idx]
+    input_sample = [dataset.input_indexed_dataset[index]
+                    for index in range(input_start, input_end)]
+    target_sample = [dataset.target_indexed_dataset[index]
+                     for index in range(target_start, target_end)]
+    input_tokens = [token for sentence in input_sample for token in sentence]
+    target_tokens = [token for sentence in target_sample for token in sentence]
+    input_tokens = input_tokens[:dataset.max_seq_length]
+    target_tokens = target_tokens[:dataset.max_seq_length_dec - 2]
+    return pad_and_convert_to_numpy(
+        input_tokens, [], [], dataset.pad_id, dataset.max_seq_length,
+        dataset.max_seq_length_dec, target_tokens, [], dataset.bos_id,
+        dataset.eos_id, dataset.sentinel_tokens)
+
+
+def get_sample(dataset, idx):
+    sample = dataset[idx]
+    return dataset.constructor_fn(sample['text_enc'], None,
+                                  sample['text_dec'], None,
+                                  dataset.max_seq_length,
+                                  dataset.max_seq_length_dec)
+
+
+def benchmark(fn, dataset, indices):
+    start_time = time.time()
+    for idx in indices:
+        fn(dataset, idx)
+    return len(indices) / (time.time() - start_time)
+
+
+def benchmark_batched(dataset, indices, batch_size):
+    start_time = time.time()
+    for start in range(0, len(indices) - batch_size + 1, batch_size):
+        dataset.get_padded_batch(indices[start:start + batch_size],
+                                 dataset.max_seq_length,
+                                 dataset.max_seq_length_dec)
+    return (len(indices) // batch_size * batch_size) / \
+        (time.time() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workdir', type=str, default=None,
+                        help='Directory for the synthetic dataset. '
+                        'Defaults to a temporary directory.')
+    parser.add_argument('--num-docs', type=int, default=100000)
+    parser.add_argument('--input-length', type=int, default=256,
+                        help='Mean number of input tokens per sample.')
+    parser.add_argument('--target-length', type=int, default=64,
+                        help='Mean number of target tokens per sample.')
+    parser.add_argument('--seq-length', type=int, default=512)
+    parser.add_argument('--decoder-seq-length', type=int, default=128)
+    parser.add_argument('--num-iters', type=int, default=5000,
+                        help='Number of samples to fetch per path.')
+    parser.add_argument('--micro-batch-size', type=int, default=8,
+                        help='Batch size of the batched path.')
+    parser.add_argument('--vocab-file', type=str,
+                        default=os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir, 'vocabs',
+                                             't5-base-vocab.txt'))
+    parser.add_argument('--seed', type=int, default=1234)
+    args = parser.parse_args()
+
+    os.environ.setdefault('LOCAL_RANK', '0')
+    compile_helper()
+    rebuild_tokenizer(argparse.Namespace(
+        rank=0, tokenizer_type='BertWordPieceCase',
+        vocab_file=args.vocab_file, vocab_extra_ids=100,
+        make_vocab_size_divisible_by=128, tensor_model_parallel_size=1))
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    input_prefix = os.path.join(workdir, 'bench_inputs')
+    target_prefix = os.path.join(workdir, 'bench_targets')
+    if not indexed_dataset.MMapIndexedDataset.exists(input_prefix):
+        print('> building synthetic dataset in {} ...'.format(workdir))
+        build_synthetic_dataset(input_prefix, args.num_docs,
+                                args.input_length, 30000, args.seed)
+        build_synthetic_dataset(target_prefix, args.num_docs,
+                                args.target_length, 30000, args.seed + 1)
+
+    dataset = T5SupervisedDataset(
+        'bench',
+        indexed_dataset.MMapIndexedDataset(input_prefix, skip_warmup=True),
+        indexed_dataset.MMapIndexedDataset(target_prefix, skip_warmup=True),
+        input_prefix, 1, None, args.seq_length, args.decoder_seq_length,
+        args.seed, offline_build=True)
+
+    indices = np.random.default_rng(args.seed).integers(
+        0, len(dataset), args.num_iters)
+    # Warm up the page cache so both paths read from memory.
+    benchmark(get_sample, dataset, indices)
+    legacy = benchmark(legacy_get_sample, dataset, indices)
+    current = benchmark(get_sample, dataset, indices)
+    batched = benchmark_batched(dataset, indices, args.micro_batch_size)
+    print('> samples/sec per worker: legacy {:.1f}, current {:.1f} '
+          '({:.2f}x), batched {:.1f} ({:.2f}x)'.format(
+              legacy, current, current / legacy,
+              batched, batched / legacy))
+
+
+if __name__ == '__main__':
+    main()
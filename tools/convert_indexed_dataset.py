@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import argparse
+import shutil
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+
+import numpy as np
+
+from megatron.data import indexed_dataset
+
+
+def convert_to_mmap(input_prefix, output_prefix, items_per_batch, index_version=1):
+    """Rewrite a lazy/cached indexed dataset in the mmap format, copying
+    items_per_batch items per write."""
+    dataset = indexed_dataset.IndexedDataset(input_prefix)
+    assert np.all(np.diff(dataset.dim_offsets) == 1), \
+           f'ERROR: {input_prefix} has multi-dimensional items, which the mmap format does not support'
+    dataset.read_data(dataset.path)
+
+    builder = indexed_dataset.MMapIndexedDatasetBuilder(
+        indexed_dataset.data_file_path(output_prefix), dtype=dataset.dtype,
+        index_version=index_version)
+    doc_ends = dataset.doc_idx[1:]
+    doc = 0
+    for start in range(0, len(dataset), items_per_batch):
+        stop = min(start + items_per_batch, len(dataset))
+        next_doc = np.searchsorted(doc_ends, stop, side='right')
+        builder.add_batch(
+            dataset.data_buffer[dataset.data_offsets[start]:dataset.data_offsets[stop]],
+            dataset.sizes[start:stop],
+            doc_ends[doc:next_doc] - start)
+        doc = next_doc
+    # document ends not covered by the loop (only when the dataset is empty)
+    builder.add_batch([], [], doc_ends[doc:] - len(dataset))
+    builder.finalize(indexed_dataset.index_file_path(output_prefix))
+
+
+def rewrite_mmap_index(input_prefix, output_prefix, index_version):
+    """Copy an mmap dataset, rewriting its .idx in the given version. The
+    .bin is the same in every version."""
+    index = indexed_dataset.MMapIndexedDataset.Index(
+        indexed_dataset.index_file_path(input_prefix), skip_warmup=True)
+    shutil.copyfile(indexed_dataset.data_file_path(input_prefix),
+                    indexed_dataset.data_file_path(output_prefix))
+    with indexed_dataset.MMapIndexedDataset.Index.writer(
+            indexed_dataset.index_file_path(output_prefix), index.dtype,
+            index_version) as writer:
+        writer.write(index.sizes, index.doc_idx)
+
+
+def main(args):
+    impl = indexed_dataset.infer_dataset_impl(args.input)
+    assert impl in ('cached', 'mmap'), \
+           f'ERROR: {args.input} is not an indexed dataset'
+
+    start_time = time.time()
+    if impl == 'mmap':
+        rewrite_mmap_index(args.input, args.output_prefix, args.index_version)
+    else:
+        convert_to_mmap(args.input, args.output_prefix, args.items_per_batch,
+                        args.index_version)
+    print('Converted {} to {} in {:.2f} seconds'.format(
+        args.input, args.output_prefix, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a lazy/cached indexed dataset to the mmap format, '
+        'or rewrite the index of an mmap dataset in another version.')
+
+    group = parser.add_argument_group(title='input data')
+    group.add_argument('--input', type=str, required=True,
+                       help='Path to the lazy/cached dataset without suffix')
+
+    group = parser.add_argument_group(title='output data')
+    group.add_argument('--output-prefix', type=str, required=True,
+                       help='Path to binary output file without suffix')
+    group.add_argument('--index-version', type=int, default=1, choices=[1, 2],
+                       help='mmap .idx format version to write')
+
+    group = parser.add_argument_group(title='runtime')
+    group.add_argument('--items-per-batch', type=int, default=1 << 20,
+                       help='Number of items copied per write')
+
+    args = parser.parse_args()
+
+    assert os.path.isdir(os.path.dirname(os.path.abspath(args.output_prefix))), \
+           f'ERROR: {os.path.dirname(args.output_prefix)} is not a directory or does not exist'
+
+    main(args)
@@ -0,0 +1,153 @@
+# Copyright (c) 2022, NVIDIA CORPORATION. All rights reserved.
+
+"""Build the dataset caches of a training job ahead of time.
+
+Takes the arguments of pretrain_t5.py / pretrain_gpt.py (plus --model) and
+builds, on a CPU machine, every .npy cache the job would otherwise build on
+start: the supervised index maps, the packed-sample layouts and, for the
+ordered dataloader with dynamic batching, the batch boundaries. The data
+prefixes of a blend are built in parallel by a process pool. The caches
+are listed in a manifest; pass it to the training job with --data-manifest
+to verify it and skip all building and barriers on start.
+
+    WORLD_SIZE=64 python tools/prepare_training_data.py --model t5 \\
+        <data and batch arguments of the training job> \\
+        --data-manifest /path/to/manifest.json
+"""
+
+import multiprocessing
+import os
+import sys
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             os.path.pardir)))
+import time
+
+from megatron import get_args
+from megatron.arguments import parse_args, validate_args
+from megatron.data.data_manifest import get_data_prefixes, write_data_manifest
+from megatron.data.dataset_utils import (
+    build_train_valid_test_datasets,
+    compile_helper,
+    get_datasets_weights_and_num_samples,
+)
+from megatron.global_vars import set_global_variables
+
+
+TOKENIZER_DEFAULTS = {
+    't5': 'BertWordPieceLowerCase',
+    'gpt': 'GPT2BPETokenizer',
+}
+
+
+def add_prepare_args(parser):
+    group = parser.add_argument_group(title='prepare training data')
+    group.add_argument('--model', type=str, required=True,
+                       choices=sorted(TOKENIZER_DEFAULTS.keys()),
+                       help='Training script the data is prepared for.')
+    group.add_argument('--prepare-workers', type=int, default=None,
+                       help='Number of processes building the caches of '
+                       'different data prefixes. Defaults to the number '
+                       'of data prefixes.')
+    return parser
+
+
+def get_train_valid_test_num_samples(args):
+    """Dataset sizes, as computed by build_train_valid_test_data_iterators."""
+    if args.train_samples:
+        train_samples = args.train_samples
+    else:
+        train_samples = args.train_iters * args.global_batch_size
+    eval_iters = (args.train_iters // args.eval_interval + 1) * \
+                 args.eval_iters
+    test_iters = args.eval_iters
+    return [train_samples,
+            eval_iters * args.global_batch_size,
+            test_iters * args.global_batch_size]
+
+
+def build_data_prefix(job):
+    """Build the caches of one data prefix, as the dataset provider of the
+    training script would."""
+    data_prefix, train_valid_test_num_samples, build_batch_boundaries = job
+    args = get_args()
+    start_time = time.time()
+    train_ds, _, _ = build_train_valid_test_datasets(
+        data_prefix=[data_prefix],
+        data_impl=args.data_impl,
+        splits_string=args.split,
+        train_valid_test_num_samples=train_valid_test_num_samples,
+        max_seq_length=args.encoder_seq_length,
+        max_seq_length_dec=args.decoder_seq_length,
+        masked_lm_prob=args.mask_prob,
+        short_seq_prob=args.short_seq_prob,
+        seed=args.seed,
+        skip_warmup=True,
+        dataset_type='t5_supervised',
+        num_epochs=args.train_epochs,
+        sort_samples=args.sort_dataset,
+        pack_samples=args.pack_dataset_strategy if args.pack_dataset else False,
+        targets_data_path=args.targets_data_path,
+        offline_build=True,
+        inputs_only=args.model == 'gpt',
+        mapping_build_threads=args.mapping_build_threads,
+    )
+    if build_batch_boundaries and train_ds is not None:
+        from megatron.data.data_samplers import MegatronPretrainingOrderedSampler
+        sampler = MegatronPretrainingOrderedSampler(
+            train_ds,
+            total_samples=len(train_ds),
+            consumed_samples=0,
+            micro_batch_size=args.micro_batch_size,
+            data_parallel_rank=0,
+            data_parallel_size=args.data_parallel_size,
+            data_sharding=args.data_sharding,
+            dynamic_batchsize=True,
+            tokens_per_global_batch=args.tokens_per_global_batch,
+            use_dynapipe=args.use_dynapipe,
+        )
+        # saves the batch boundaries next to the dataset
+        len(sampler)
+    print('> built caches of {} in {:.2f} seconds'.format(
+        data_prefix, time.time() - start_time), flush=True)
+
+
+def main():
+    args = parse_args(extra_args_provider=add_prepare_args)
+    validate_args(args, {'tokenizer_type': TOKENIZER_DEFAULTS[args.model]})
+    set_global_variables(args)
+    if args.targets_data_path is None:
+        raise ValueError('only supervised datasets (--targets-data-path) can '
+                         'be prepared offline')
+    # caches are built by "local rank 0" of this process
+    os.environ['LOCAL_RANK'] = '0'
+    compile_helper()
+
+    train_valid_test_num_samples = get_train_valid_test_num_samples(args)
+    data_prefixes = get_data_prefixes(args.data_path)
+    if len(data_prefixes) == 1:
+        jobs = [(data_prefixes[0], train_valid_test_num_samples,
+                 args.dataloader_type == 'ordered' and args.dynamic_batchsize)]
+    else:
+        _, _, prefixes_num_samples = get_datasets_weights_and_num_samples(
+            args.data_path, train_valid_test_num_samples)
+        # the ordered sampler does not support blended datasets
+        jobs = [(prefix, num_samples, False) for prefix, num_samples
+                in zip(data_prefixes, prefixes_num_samples)]
+
+    num_workers = args.prepare_workers or len(jobs)
+    print('> preparing {} data prefixes with {} processes ...'.format(
+        len(jobs), num_workers), flush=True)
+    # workers inherit the global args and tokenizer
+    with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+        pool.map(build_data_prefix, jobs)
+
+    if args.data_manifest is None:
+        args.data_manifest = '{}_manifest.json'.format(data_prefixes[0])
+    manifest = write_data_manifest(args.data_manifest, args, args.model,
+                                   train_valid_test_num_samples)
+    print('> wrote manifest of {} files to {}'.format(
+        len(manifest['files']), args.data_manifest))
+
+
+if __name__ == '__main__':
+    main()
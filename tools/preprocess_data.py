@@ -3,6 +3,8 @@
 """Processing data for pretraining."""
 
 import argparse
+import copy
+import functools
 import json
 import multiprocessing
 import os
@@ -11,7 +13,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
                                              os.path.pardir)))
 import time
 
-import torch
+import numpy as np
 try:
     import nltk
     nltk_available = True
@@ -45,7 +47,8 @@ class Encoder(object):
 
     def initializer(self):
         # Use Encoder class as a container for global data
-        Encoder.tokenizer = build_tokenizer(self.args)
+        Encoder.tokenizers = [build_tokenizer(config)
+                              for config in self.args.tokenizer_configs]
         if self.args.split_sentences:
             if not nltk_available:
                 print("NLTK is not available to split sentences.")
@@ -65,19 +68,31 @@ class Encoder(object):
             Encoder.splitter = IdentitySplitter()
 
     def encode(self, json_line):
+        """Parse and split a line once and tokenize it with every tokenizer.
+        Returns one dict of documents per tokenizer."""
         data = json.loads(json_line)
-        ids = {}
+        docs = [{} for _ in Encoder.tokenizers]
         for key in self.args.json_keys:
             text = data[key]
-            doc_ids = []
-            for sentence in Encoder.splitter.tokenize(text):
-                sentence_ids = Encoder.tokenizer.tokenize(sentence)
-                if len(sentence_ids) > 0:
-                    doc_ids.append(sentence_ids)
-            if len(doc_ids) > 0 and self.args.append_eod:
-                doc_ids[-1].append(Encoder.tokenizer.eod)
-            ids[key] = doc_ids
-        return ids, len(json_line)
+            sentences = Encoder.splitter.tokenize(text)
+            for ids, config, tokenizer in zip(docs, self.args.tokenizer_configs,
+                                              Encoder.tokenizers):
+                doc_ids = []
+                for sentence in sentences:
+                    sentence_ids = tokenizer.tokenize(sentence)
+                    if len(sentence_ids) > 0:
+                        doc_ids.append(sentence_ids)
+                if len(doc_ids) > 0 and config.append_eod:
+                    doc_ids[-1].append(tokenizer.eod)
+                ids[key] = doc_ids
+        return docs, len(json_line)
+
+def str_to_bool(value):
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise argparse.ArgumentTypeError('expected true or false, got {}'.format(value))
 
 def get_args():
     parser = argparse.ArgumentParser()
@@ -97,25 +112,35 @@ def get_args():
                        help='Is a part of supervised dataset.')
 
     group = parser.add_argument_group(title='tokenizer')
-    group.add_argument('--tokenizer-type', type=str, required=True,
+    group.add_argument('--tokenizer-type', type=str, nargs='+', required=True,
                        choices=['BertWordPieceLowerCase','BertWordPieceCase',
                                 'GPT2BPETokenizer', 'SentencePieceTokenizer'],
-                       help='What type of tokenizer to use.')
-    group.add_argument('--vocab-file', type=str, default=None,
-                       help='Path to the vocab file')
-    group.add_argument('--merge-file', type=str, default=None,
-                       help='Path to the BPE merge file (if necessary).')
-    group.add_argument('--append-eod', action='store_true',
-                       help='Append an <eod> token to the end of a document.')
+                       help='What type of tokenizer to use. Several tokenizers '
+                       'encode the input in a single pass, each into its own '
+                       '--output-prefix.')
+    group.add_argument('--vocab-file', type=str, nargs='+', default=None,
+                       help='Path to the vocab file, one per tokenizer')
+    group.add_argument('--merge-file', type=str, nargs='+', default=None,
+                       help='Path to the BPE merge file (if necessary), one '
+                       'per tokenizer. Use "none" for tokenizers without one.')
+    group.add_argument('--append-eod', type=str_to_bool, nargs='*', default=None,
+                       help='Append an <eod> token to the end of a document. '
+                       'Without values it applies to all tokenizers, '
+                       'otherwise give true or false for each tokenizer.')
     group.add_argument('--lang', type=str, default='english',
                        help='Language to use for NLTK-powered sentence splitting.')
 
 
     group = parser.add_argument_group(title='output data')
-    group.add_argument('--output-prefix', type=str, required=True,
-                       help='Path to binary output file without suffix')
+    group.add_argument('--output-prefix', type=str, nargs='+', required=True,
+                       help='Path to binary output file without suffix, one '
+                       'per tokenizer')
     group.add_argument('--dataset-impl', type=str, default='mmap',
                        choices=['lazy', 'cached', 'mmap'])
+    group.add_argument('--index-version', type=int, default=1, choices=[1, 2],
+                       help='mmap .idx format version. Version 2 stores '
+                       'sizes in the narrowest integer type that fits and '
+                       'derives the pointers from them on load.')
 
     group = parser.add_argument_group(title='runtime')
     group.add_argument('--workers', type=int, required=True,
@@ -124,10 +149,22 @@ def get_args():
                        help='Chunk size assigned to each worker process')
     group.add_argument('--log-interval', type=int, default=100,
                        help='Interval between progress updates')
+    group.add_argument('--num-shards', type=int, default=None,
+                       help='Split the input into this many byte ranges, '
+                       'encode and write each of them in its own worker '
+                       'process and merge the shards at the end. The '
+                       'output is the same as without sharding.')
     args = parser.parse_args()
     args.keep_empty = False
 
-    if args.tokenizer_type.lower().startswith('bert'):
+    if args.num_shards is not None:
+        if args.num_shards < 1:
+            raise ValueError('--num-shards must be positive')
+        if args.n_samples is not None:
+            raise ValueError('--n-samples is not supported with --num-shards')
+
+    if any(tokenizer_type.lower().startswith('bert')
+           for tokenizer_type in args.tokenizer_type):
         if not args.split_sentences:
             print("Bert tokenizer detected, are you sure you don't want to split sentences?")
 
@@ -137,121 +174,286 @@ def get_args():
     args.tensor_model_parallel_size = 1
     args.vocab_extra_ids = 0
 
-    return args
+    # one namespace with scalar tokenizer and output arguments per tokenizer
+    num_tokenizers = len(args.tokenizer_type)
+    def per_tokenizer(name, values, default):
+        if values is None:
+            return [default] * num_tokenizers
+        if len(values) != num_tokenizers:
+            raise ValueError('--{} needs one value per --tokenizer-type, got '
+                             '{} for {} tokenizers'.format(
+                                 name, len(values), num_tokenizers))
+        return values
+    if args.append_eod == []:
+        args.append_eod = [True] * num_tokenizers
+    merge_files = per_tokenizer('merge-file', args.merge_file, None)
+    args.tokenizer_configs = []
+    for tokenizer_type, vocab_file, merge_file, append_eod, output_prefix in zip(
+            args.tokenizer_type,
+            per_tokenizer('vocab-file', args.vocab_file, None),
+            [None if f is None or f.lower() == 'none' else f for f in merge_files],
+            per_tokenizer('append-eod', args.append_eod, False),
+            per_tokenizer('output-prefix', args.output_prefix, None)):
+        config = copy.copy(args)
+        config.tokenizer_type = tokenizer_type
+        config.vocab_file = vocab_file
+        config.merge_file = merge_file
+        config.append_eod = append_eod
+        config.output_prefix = output_prefix
+        args.tokenizer_configs.append(config)
+    if len(set(args.output_prefix)) != num_tokenizers:
+        raise ValueError('every tokenizer needs its own --output-prefix')
 
-import random
-from tqdm import tqdm
+    return args
 
-def index_sample(iterable, n):
+def build_line_index(filename, chunk_size=1 << 28):
+    """Byte offsets of the starts of the lines of a file, followed by the
+    file size, from a vectorized newline scan over an mmap of the file."""
+    size = os.path.getsize(filename)
+    if size == 0:
+        return np.zeros(1, dtype=np.int64)
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    starts = [np.zeros(1, dtype=np.int64)]
+    for begin in range(0, size, chunk_size):
+        newlines = np.flatnonzero(data[begin:begin + chunk_size] == ord('\n'))
+        starts.append(newlines.astype(np.int64) + (begin + 1))
+    del data
+    offsets = np.concatenate(starts)
+    if offsets[-1] != size:
+        # the last line has no trailing newline
+        offsets = np.append(offsets, size)
+    return offsets
+
+def get_line_index(filename, index_filename):
+    """Load the line index of filename, or build and save it if it is
+    missing or was built for a file of a different size."""
+    if os.path.exists(index_filename):
+        offsets = np.load(index_filename)
+        if offsets[-1] == os.path.getsize(filename):
+            print("Loaded line index from {}.".format(index_filename))
+            return offsets
+    start_time = time.time()
+    offsets = build_line_index(filename)
+    tmp_filename = "{}.tmp{}".format(index_filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        np.save(f, offsets)
+    os.replace(tmp_filename, index_filename)
+    print("Indexed {} lines in {:.2f}s, saved to {}.".format(
+        len(offsets) - 1, time.time() - start_time, index_filename))
+    return offsets
+
+def index_sample(num_lines, n):
     """
-    Returns @param n random items from @param iterable.
+    Returns the sorted indices of @param n random lines out of @param num_lines.
     """
-    reservoir = []
-    for t, item in tqdm(enumerate(iterable)):
-        if t < n:
-            reservoir.append(t)
-        else:
-            m = random.randint(0,t)
-            if m < n:
-                reservoir[m] = t
-    return set(reservoir)
-
-def subsampled_stream_iterator(indices: set, iterable):
-    if indices is None:
-        yield from iterable
-        return
-    for i, item in enumerate(iterable):
-        if i in indices:
-            yield item
+    if n >= num_lines:
+        return np.arange(num_lines, dtype=np.int64)
+    return np.sort(np.random.default_rng().choice(num_lines, n, replace=False))
+
+def read_lines_at(filename, offsets, indices):
+    """Yields the lines with the given (sorted) indices, seeking to each."""
+    with open(filename, 'rb') as f:
+        for index in indices:
+            f.seek(offsets[index])
+            yield f.read(offsets[index + 1] - offsets[index]).decode('utf-8')
+
+def get_output_filenames(output_prefix, key, level):
+    return ("{}_{}_{}.bin".format(output_prefix, key, level),
+            "{}_{}_{}.idx".format(output_prefix, key, level))
+
+def write_documents(args, tokenizers, encoded_docs, output_prefixes, level,
+                    log_prefix=""):
+    """Write the documents encoded by each tokenizer for every json key to
+    an indexed dataset under that tokenizer's output prefix. Returns the
+    number of documents and of input bytes processed."""
+    outputs = []
+    for tokenizer, output_prefix in zip(tokenizers, output_prefixes):
+        output_idx_files = {}
+        builders = {}
+        batchers = {}
+        for key in args.json_keys:
+            output_bin_file, output_idx_files[key] = get_output_filenames(
+                output_prefix, key, level)
+            builders[key] = indexed_dataset.make_builder(output_bin_file,
+                                                   impl=args.dataset_impl,
+                                                   vocab_size=tokenizer.vocab_size,
+                                                   index_version=args.index_version)
+            batchers[key] = indexed_dataset.DocumentBatcher(builders[key])
+        outputs.append((tokenizer, output_idx_files, builders, batchers))
+
+    proc_start = time.time()
+    total_bytes_processed = 0
+    num_docs = 0
+    for i, (docs, bytes_processed) in enumerate(encoded_docs, start=1):
+        num_docs = i
+        total_bytes_processed += bytes_processed
+        for doc, (tokenizer, _, _, batchers) in zip(docs, outputs):
+            for key, sentences in doc.items():
+                if len(sentences) == 0:
+                    print(f"WARNING: {log_prefix}encountered empty document {i}.")
+                    if args.is_supervised:
+                        try:
+                            pad_token = tokenizer.pad
+                        except:
+                            pad_token = tokenizer.eod
+                        batchers[key].add_sentences([[pad_token]])
+                    continue
+                batchers[key].add_sentences(sentences)
+        if i % args.log_interval == 0:
+            current = time.time()
+            elapsed = current - proc_start
+            mbs = total_bytes_processed/elapsed/1024/1024
+            print(f"{log_prefix}Processed {i} documents",
+                  f"({i/elapsed} docs/s, {mbs} MB/s).",
+                  file=sys.stderr)
+    print(f"{log_prefix}Done! Now finalizing.")
+
+    for _, output_idx_files, builders, batchers in outputs:
+        for key in args.json_keys:
+            batchers[key].flush()
+            builders[key].finalize(output_idx_files[key])
+    return num_docs, total_bytes_processed
+
+def get_shard_offsets(filename, num_shards):
+    """Byte offsets splitting a file into num_shards ranges of whole lines."""
+    size = os.path.getsize(filename)
+    offsets = [0]
+    with open(filename, 'rb') as f:
+        for shard in range(1, num_shards):
+            offset = max(shard * size // num_shards, offsets[-1])
+            if offset > 0:
+                # move to the start of the line following byte offset - 1
+                f.seek(offset - 1)
+                f.readline()
+                offset = min(f.tell(), size)
+            offsets.append(offset)
+    offsets.append(size)
+    return offsets
+
+def read_lines(filename, start, end):
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        position = start
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line.decode('utf-8')
+
+def encode_shard(args, level, shard):
+    """Encode and write the lines of one byte range of the input, in a
+    worker process set up by Encoder.initializer."""
+    index, start, end = shard
+    shard_start = time.time()
+    encoder = Encoder(args)
+    output_prefixes = ["{}_shard{}".format(output_prefix, index)
+                       for output_prefix in args.output_prefix]
+    num_docs, num_bytes = write_documents(
+        args, Encoder.tokenizers, map(encoder.encode, read_lines(args.input, start, end)),
+        output_prefixes, level, log_prefix=f"[shard {index}] ")
+    return index, output_prefixes, num_docs, num_bytes, time.time() - shard_start
+
+def main_sharded(args, tokenizers, level):
+    startup_start = time.time()
+    offsets = get_shard_offsets(args.input, args.num_shards)
+    shards = [(index, start, end) for index, (start, end)
+              in enumerate(zip(offsets[:-1], offsets[1:])) if start < end]
+    print(f"Encoding {len(shards)} shards with {args.workers} workers.")
+    encoder = Encoder(args)
+    pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
+    results = pool.map(functools.partial(encode_shard, args, level), shards,
+                       chunksize=1)
+    pool.close()
+    pool.join()
+
+    encode_elapsed = time.time() - startup_start
+    total_docs = 0
+    total_bytes = 0
+    for index, _, num_docs, num_bytes, elapsed in results:
+        total_docs += num_docs
+        total_bytes += num_bytes
+        print(f"Shard {index}: {num_docs} documents in {elapsed:.2f}s",
+              f"({num_docs/elapsed} docs/s, {num_bytes/elapsed/1024/1024} MB/s).")
+    print(f"Encoded {total_docs} documents in {encode_elapsed:.2f}s",
+          f"({total_docs/encode_elapsed} docs/s,",
+          f"{total_bytes/encode_elapsed/1024/1024} MB/s).")
+
+    merge_start = time.time()
+    merged_bytes = 0
+    for i, (tokenizer, output_prefix) in enumerate(zip(tokenizers, args.output_prefix)):
+        for key in args.json_keys:
+            output_bin_file, output_idx_file = get_output_filenames(
+                output_prefix, key, level)
+            builder = indexed_dataset.make_builder(output_bin_file,
+                                                   impl=args.dataset_impl,
+                                                   vocab_size=tokenizer.vocab_size,
+                                                   index_version=args.index_version)
+            for _, shard_prefixes, _, _, _ in results:
+                shard_path = "{}_{}_{}".format(shard_prefixes[i], key, level)
+                merged_bytes += os.path.getsize(indexed_dataset.data_file_path(shard_path))
+                builder.merge_file_(shard_path)
+            builder.finalize(output_idx_file)
+            for _, shard_prefixes, _, _, _ in results:
+                for filename in get_output_filenames(shard_prefixes[i], key, level):
+                    os.remove(filename)
+    merge_elapsed = time.time() - merge_start
+    print(f"Merged {len(results)} shards in {merge_elapsed:.2f}s",
+          f"({merged_bytes/max(merge_elapsed, 1e-6)/1024/1024} MB/s).")
 
 def main():
     args = get_args()
     startup_start = time.time()
 
-    print("Opening", args.input)
-    fin = open(args.input, 'r', encoding='utf-8')
-
     if nltk_available and args.split_sentences:
         nltk.download("punkt", quiet=True)
 
+    level = "document"
+    if args.split_sentences:
+        level = "sentence"
+
+    tokenizers = [build_tokenizer(config) for config in args.tokenizer_configs]
+    for tokenizer, output_prefix in zip(tokenizers, args.output_prefix):
+        print(f"Vocab size: {tokenizer.vocab_size}")
+        print(f"Output prefix: {output_prefix}")
+
+    if args.num_shards is not None:
+        main_sharded(args, tokenizers, level)
+        return
+
     if args.n_samples is not None:
         import pickle
         print("Subsampling...")
-        output_dirname = os.path.dirname(args.output_prefix)
-        output_fn = os.path.basename(args.output_prefix)
+        output_dirname = os.path.dirname(args.output_prefix[0])
+        output_fn = os.path.basename(args.output_prefix[0])
         if output_fn.endswith('_t5') or output_fn.endswith('_gpt'):
             output_fn = output_fn.rsplit('_', maxsplit=1)[0]
         sample_fn = os.path.join(output_dirname, "{}_s{}.idx".format(output_fn, args.n_samples))
+        line_index_fn = os.path.join(output_dirname, "{}_lines.npy".format(output_fn))
+        offsets = get_line_index(args.input, line_index_fn)
         if os.path.exists(sample_fn):
             print("Loading sampled index from {}...".format(sample_fn))
             with open(sample_fn, 'rb') as f:
-                indices = pickle.load(f)
+                indices = np.sort(np.fromiter(pickle.load(f), dtype=np.int64))
         else:
-            indices = index_sample(fin, args.n_samples)
+            indices = index_sample(len(offsets) - 1, args.n_samples)
             print("Writing sampled index to {}...".format(sample_fn))
             with open(sample_fn, 'wb') as f:
-                pickle.dump(indices, f)
-            fin.seek(0)
+                pickle.dump(set(indices.tolist()), f)
         print("Subsampled", len(indices), "lines.")
+        lines = read_lines_at(args.input, offsets, indices)
     else:
-        indices = None
+        print("Opening", args.input)
+        lines = open(args.input, 'r', encoding='utf-8')
 
     encoder = Encoder(args)
-    tokenizer = build_tokenizer(args)
     pool = multiprocessing.Pool(args.workers, initializer=encoder.initializer)
-    encoded_docs = pool.imap(encoder.encode, subsampled_stream_iterator(indices, fin), args.chunk_size)
-    #encoded_docs = map(encoder.encode, fin)
-
-    level = "document"
-    if args.split_sentences:
-        level = "sentence"
-
-    print(f"Vocab size: {tokenizer.vocab_size}")
-    print(f"Output prefix: {args.output_prefix}")
-    output_bin_files = {}
-    output_idx_files = {}
-    builders = {}
-    for key in args.json_keys:
-        output_bin_files[key] = "{}_{}_{}.bin".format(args.output_prefix,
-                                                      key, level)
-        output_idx_files[key] = "{}_{}_{}.idx".format(args.output_prefix,
-                                                      key, level)
-        builders[key] = indexed_dataset.make_builder(output_bin_files[key],
-                                               impl=args.dataset_impl,
-                                               vocab_size=tokenizer.vocab_size)
+    encoded_docs = pool.imap(encoder.encode, lines, args.chunk_size)
 
     startup_end = time.time()
-    proc_start = time.time()
-    total_bytes_processed = 0
     print("Time to startup:", startup_end - startup_start)
 
-    for i, (doc, bytes_processed) in enumerate(encoded_docs, start=1):
-        total_bytes_processed += bytes_processed
-        for key, sentences in doc.items():
-            if len(sentences) == 0:
-                print(f"WARNING: encountered empty document {i}.")
-                if args.is_supervised:
-                    try:
-                        pad_token = tokenizer.pad
-                    except:
-                        pad_token = tokenizer.eod
-                    builders[key].add_item(torch.IntTensor([pad_token]))
-                    builders[key].end_document()
-                continue
-            for sentence in sentences:
-                builders[key].add_item(torch.IntTensor(sentence))
-            builders[key].end_document()
-        if i % args.log_interval == 0:
-            current = time.time()
-            elapsed = current - proc_start
-            mbs = total_bytes_processed/elapsed/1024/1024
-            print(f"Processed {i} documents",
-                  f"({i/elapsed} docs/s, {mbs} MB/s).",
-                  file=sys.stderr)
-    print("Done! Now finalizing.")
-
-    for key in args.json_keys:
-        builders[key].finalize(output_idx_files[key])
+    write_documents(args, tokenizers, encoded_docs, args.output_prefix, level)
 
 if __name__ == '__main__':
     main()
@@ -10,7 +10,6 @@ import sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
                                              os.path.pardir)))
 import time
-import torch
 from megatron.tokenizer import build_tokenizer
 from megatron.data import indexed_dataset
 
@@ -87,6 +86,7 @@ def main():
     builder = indexed_dataset.make_builder(output_bin_file,
                                            impl=args.dataset_impl,
                                            vocab_size=tokenizer.vocab_size)
+    batcher = indexed_dataset.DocumentBatcher(builder)
 
     startup_end = time.time()
     proc_start = time.time()
@@ -95,9 +95,8 @@ def main():
 
     for i, (sentence, bytes_processed) in enumerate(encoded_sentences, start=1):
         total_bytes_processed += bytes_processed
-        builder.add_item(torch.IntTensor(sentence))
         # documents contain only one sentence.
-        builder.end_document()
+        batcher.add_sentences([sentence])
         if i % args.log_interval == 0:
             current = time.time()
             elapsed = current - proc_start
@@ -106,6 +105,7 @@ def main():
                   f"({i/elapsed} sentences/s, {mbs} MB/s).",
                   file=sys.stderr)
 
+    batcher.flush()
     builder.finalize(output_idx_file)
 
 if __name__ == '__main__':
@@ -95,6 +95,7 @@ class Encoder(object):
                     sentence_lens.append(len(sentence_ids))
             if len(doc_ids) > 0 and self.args.append_eod:
                 doc_ids.append(Encoder.tokenizer.eod)
+                sentence_lens[-1] += 1
             ids[key] = doc_ids
             lens[key] = sentence_lens
         return ids, lens, len(json_line)
@@ -153,6 +154,7 @@ class Partition(object):
         output_bin_files = {}
         output_idx_files = {}
         builders = {}
+        batchers = {}
 
         for key in self.args.json_keys:
             output_bin_files[key] = "{}_{}_{}.bin".format(output_prefix,
@@ -162,6 +164,7 @@ class Partition(object):
             builders[key] = indexed_dataset.make_builder(output_bin_files[key],
                                                    impl=self.args.dataset_impl,
                                                    vocab_size=tokenizer.vocab_size)
+            batchers[key] = indexed_dataset.DocumentBatcher(builders[key])
 
         startup_end = time.time()
         proc_start = time.time()
@@ -170,11 +173,13 @@ class Partition(object):
         for i, (doc, sentence_lens, bytes_processed) in enumerate(encoded_docs, start=1):
             total_bytes_processed += bytes_processed
             for key in doc.keys():
-                builders[key].add_doc(doc[key], sentence_lens[key])
+                batchers[key].add_document(doc[key], sentence_lens[key])
             self.print_processing_stats(i, proc_start, total_bytes_processed)
         
         fin.close()
-        builders[key].finalize(output_idx_files[key])
+        for key in self.args.json_keys:
+            batchers[key].flush()
+            builders[key].finalize(output_idx_files[key])
 
 
 def get_args():